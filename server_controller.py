@@ -12,6 +12,9 @@ import os
 import webbrowser
 import socket
 import subprocess
+import shutil
+import hashlib
+import mimetypes
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
     QLabel, QPushButton, QSpinBox, QTextEdit, QGroupBox, QMessageBox,
@@ -20,19 +23,2383 @@ from PyQt5.QtWidgets import (
 )
 from PyQt5.QtCore import Qt, QThread, pyqtSignal, QTimer
 from PyQt5.QtGui import QFont, QColor, QPalette, QTextCursor
-from flask import Flask, render_template, request, jsonify, send_from_directory, session, redirect, url_for, Response, make_response
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, Response, make_response
 from flask_cors import CORS
 import yt_dlp
 import instaloader
 import json
-from datetime import datetime
+import copy
+import sqlite3
+import uuid
+import glob
+from datetime import datetime, timedelta
 import re
+import time
+import threading
+import heapq
+import itertools
+import bisect
+import unicodedata
+from collections import OrderedDict, deque
 import cv2
+import requests
 from PIL import Image
-from functools import wraps
+from functools import wraps, lru_cache
+from contextlib import contextmanager
+from email.utils import formatdate, parsedate_to_datetime
+from concurrent.futures import Future, ThreadPoolExecutor
 
 # 🎯 포맷 이력 관리 파일 (학습 시스템)
 FORMAT_HISTORY_FILE = 'format_history.json'
+FORMAT_HISTORY_JOURNAL = 'format_history.journal'  # 추가 전용 변경 기록 (JSON Lines)
+FORMAT_HISTORY_COMPACT_EVERY = 500                  # 기록 N건마다 스냅샷으로 압축
+FORMAT_HISTORY_MAX_AGE_DAYS = 90                    # 이 기간 동안 갱신 없는 항목은 삭제
+
+# 🗃️ 사용자 라이브러리 DB (갤러리 메타데이터/재생 목록/즐겨찾기 - SQLite WAL)
+LIBRARY_DB_FILE = 'library.db'
+LIBRARY_DB_TIMEOUT = 10              # 다른 스레드가 쓰는 중일 때 최대 대기 (초)
+LIBRARY_SCHEMA_VERSION = 4           # PRAGMA user_version (2: metadata kind 통합, 3: 항목마다 고정 item_id, 4: video_id 채움)
+
+# 📚 서버 전체 video_id 카탈로그 (제목/썸네일/길이/채널/로컬 파일)
+MEDIA_CATALOG_FILE = 'media_catalog.json'
+MEDIA_CATALOG_SAVE_DELAY = 2         # 변경 후 N초 모아서 한 번에 저장
+
+# 🔗 URL 정규화 (YouTube watch/shorts/embed/youtu.be, 인스타그램 shortcode)
+URL_CANONICAL_CACHE_SIZE = 4096      # canonicalize_url LRU 항목 수
+YOUTUBE_ID_PATTERNS = (
+    re.compile(r'youtube(?:-nocookie)?\.com/(?:watch\?(?:[^#]*&)?v=|shorts/|embed/|live/|v/)([A-Za-z0-9_-]{11})'),
+    re.compile(r'youtu\.be/([A-Za-z0-9_-]{11})'),
+)
+INSTAGRAM_SHORTCODE_PATTERN = re.compile(r'instagram\.com/(?:[^/?#]+/)?(?:p|reels?|tv)/([A-Za-z0-9_-]+)')
+
+# 🔗 해석된 스트림 URL 캐시 설정
+STREAM_URL_CACHE_SIZE = 512          # 최대 항목 수 (LRU)
+STREAM_URL_EXPIRY_MARGIN = 120       # 만료 2분 전부터는 다시 해석
+STREAM_URL_DEFAULT_TTL = 30 * 60     # expire= 파라미터가 없을 때 기본 30분
+
+# 📥 다운로드 스케줄러 설정
+DOWNLOAD_WORKERS = 2                 # 동시 다운로드 수 (업로드 대역폭 보호)
+DOWNLOAD_PRIORITIES = {'now_playing': 0, 'prefetch': 1, 'bulk': 2}  # 숫자가 작을수록 먼저
+DOWNLOAD_HISTORY_SIZE = 50           # 완료/취소된 작업 기록 보관 수
+
+# 🎵 다운로드 중인 오디오(.part) 서빙 설정
+PARTIAL_AUDIO_MIN_BYTES = 512 * 1024 # 이만큼 받으면 클라이언트를 로컬 URL로 전환
+PARTIAL_AUDIO_WAIT = 3               # 아직 안 받은 구간 요청 시 최대 대기 (초) → 넘으면 원본으로 리다이렉트
+PARTIAL_AUDIO_STALL = 15             # 서빙 중 다운로드가 이 시간 이상 멈추면 응답 종료
+
+# 🔁 서버 중계(relay) 설정 - 원본을 한 번만 받아 브라우저로 전달하면서 temp_audio에 저장
+RELAY_CHUNK_SIZE = 256 * 1024        # 중계 청크 (256KB)
+RELAY_FILL_CHUNK = 2 * 1024 * 1024   # 빈 구간 채우기 요청 크기 (2MB)
+RELAY_FILL_IDLE = 5                  # 재생 중계가 이 시간(초) 동안 없을 때만 빈 구간 채우기
+RELAY_TIMEOUT = 30                   # 원본 연결 타임아웃 (초)
+
+# 📦 공용 영상 저장소 (static/videos/blobs/<플랫폼>_<영상 ID>_<포맷>.<ext>)
+VIDEO_BLOBS_DIR = 'blobs'
+VIDEO_BLOB_EXTENSIONS = ('.mp4', '.webm', '.mkv', '.mov')
+
+# 🎞️ 갤러리 영상 HLS 패키징 (선택 - 기본 꺼짐, GUI 설정에서 켬 / ffmpeg가 있을 때만, 백그라운드)
+HLS_PACKAGING_ENABLED = False
+HLS_DIRNAME = 'hls'                  # static/videos/hls/<키>/index.m3u8 + <해상도>p/ + poster.jpg
+HLS_SEGMENT_SECONDS = 4
+HLS_RENDITIONS = (                   # (짧은 변 px, 영상 kbps, 음성 kbps) - 원본보다 큰 해상도는 생략
+    (1080, 5000, 192),
+    (720, 2800, 128),
+    (480, 1200, 96),
+)
+HLS_PACKAGE_WORKERS = 1              # 동시 변환 수 (재인코딩이라 CPU 사용 큼)
+HLS_PACKAGE_TIMEOUT = 60 * 60        # 해상도 1개 변환 최대 시간 (초)
+HLS_MIME_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.ts': 'video/mp2t',
+    '.jpg': 'image/jpeg'
+}
+
+# 🎵 temp_audio 캐시 파일 확장자 (같은 video_id가 여러 개면 앞쪽 우선)
+AUDIO_CACHE_EXTENSIONS = ('m4a', 'webm', 'opus', 'mp3', 'mp4')
+AUDIO_CACHE_SIDECAR = '.index.json'  # 길이/코덱 등 분석 결과 (캐시 적중 시 파일 파싱 생략)
+AUDIO_CACHE_BUDGET_GB = 5            # temp_audio 최대 용량 (넘으면 오래 안 들은 파일부터 삭제)
+AUDIO_CACHE_EVICT_INTERVAL = 5 * 60  # 용량 점검 주기 (초) - 다운로드 완료 시에도 점검
+AUDIO_CACHE_RECENT_GRACE = 60 * 60   # 최근 1시간 안에 재생한 파일은 삭제 안 함
+
+# 🍎 Safari/iOS용 변형 (webm/opus → m4a 스트림 복사, 재인코딩 없음 + moov를 앞쪽으로)
+SAFARI_AUDIO_SUFFIX = '.safari.m4a'  # temp_audio/<video_id>.safari.m4a
+SAFARI_REMUX_SOURCES = ('webm', 'opus')
+SAFARI_REMUX_WORKERS = 1             # 동시에 실행할 ffmpeg 수
+SAFARI_REMUX_TIMEOUT = 120           # 변환 1건 최대 시간 (초)
+
+# 📤 파일 전송 - sendfile을 못 쓸 때 청크 크기
+FILE_STREAM_CHUNK_SIZE = 256 * 1024
+MAX_BYTE_RANGES = 16                 # 한 요청의 Range 구간 수 상한 (넘으면 전체 파일 응답)
+
+# 🗄️ 브라우저 캐시 정책 (apply_cache_policy)
+CACHE_MEDIA_REVALIDATE = 'private, no-cache'                    # 미디어 - URL이 내용에 묶여 있지 않으므로(재다운로드/재패키징 시 같은 이름) ETag로 재검증 (로그인 필요 → private)
+CACHE_STATIC_IMMUTABLE = 'public, max-age=31536000, immutable'  # ?v=<내용 해시>가 붙은 정적 파일
+CACHE_REVALIDATE = 'no-cache'                                   # HTML / API / 해시 없는 정적 파일 - 매번 재검증
+CACHE_MEDIA_PREFIXES = ('/temp_audio/', '/api/video/', '/api/hls/')
+STATIC_ASSET_EXTENSIONS = ('.js', '.css')                        # 내용 해시 URL 대상
+
+# 🍎 오디오 확장자별 MIME type (Safari는 정확한 타입 필수)
+AUDIO_MIME_TYPES = {
+    '.m4a': 'audio/mp4',      # Safari 필수!
+    '.mp4': 'audio/mp4',
+    '.mp3': 'audio/mpeg',
+    '.webm': 'audio/webm',
+    '.opus': 'audio/ogg',
+    '.ogg': 'audio/ogg'
+}
+
+# ============================================================================
+# 🔗 스트림 URL 캐시
+# ============================================================================
+
+class StreamUrlCache:
+    """해석된 googlevideo URL 캐시 (video_id + 포맷 + 기기 클래스, 만료 인식 LRU)"""
+    
+    # 서명된 URL의 만료 시각: ?expire=1700000000 또는 /expire/1700000000/
+    EXPIRE_PATTERN = re.compile(r'[?&/]expire[=/](\d+)')
+    
+    def __init__(self, max_entries=STREAM_URL_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (video_id, format, device): entry
+        self.lock = threading.Lock()
+    
+    def parse_expiry(self, stream_url):
+        """URL의 expire= 값으로 캐시 만료 시각 계산 (여유 시간 차감)"""
+        match = self.EXPIRE_PATTERN.search(stream_url or '')
+        if match:
+            return int(match.group(1)) - STREAM_URL_EXPIRY_MARGIN
+        return time.time() + STREAM_URL_DEFAULT_TTL
+    
+    def get(self, video_id, format_string, device):
+        """캐시 조회 (만료된 항목은 제거)"""
+        key = (video_id, format_string, device)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry['expires_at'] <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return dict(entry)
+    
+    def lookup(self, video_id, format_options, device):
+        """학습된 포맷 순서대로 캐시 확인 (처음 찾은 항목 반환)"""
+        for format_string in format_options:
+            entry = self.get(video_id, format_string, device)
+            if entry:
+                return entry
+        return None
+    
+    def put(self, video_id, format_string, device, stream_url, info):
+        """해석 결과 저장 (용량 초과 시 가장 오래 안 쓴 항목부터 제거)"""
+        expires_at = self.parse_expiry(stream_url)
+        if expires_at <= time.time():
+            return
+        
+        key = (video_id, format_string, device)
+        entry = {
+            'url': stream_url,
+            'format': format_string,
+            'title': info.get('title', 'Unknown'),
+            'duration': info.get('duration', 0),
+            'thumbnail': info.get('thumbnail', ''),
+            'expires_at': expires_at
+        }
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def invalidate(self, video_id):
+        """video_id의 모든 항목 제거 (403 등으로 URL이 죽었을 때 재해석용)"""
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == video_id]:
+                del self.entries[key]
+
+# ============================================================================
+# 🔗 URL 정규화 (영상 ID 추출은 모두 여기서)
+# ============================================================================
+
+@lru_cache(maxsize=URL_CANONICAL_CACHE_SIZE)
+def canonicalize_url(url):
+    """URL → (플랫폼, 영상 ID, 정규 URL) - 모르는 URL은 (None, None, url)"""
+    if not url:
+        return None, None, url
+    for pattern in YOUTUBE_ID_PATTERNS:
+        match = pattern.search(url)
+        if match:
+            return 'youtube', match.group(1), f'https://www.youtube.com/watch?v={match.group(1)}'
+    match = INSTAGRAM_SHORTCODE_PATTERN.search(url)
+    if match:
+        return 'instagram', match.group(1), f'https://www.instagram.com/p/{match.group(1)}/'
+    return None, None, url
+
+def extract_video_id(url, platform='youtube'):
+    """URL의 영상 ID (platform=None이면 플랫폼 무관, 없으면 None)"""
+    url_platform, media_id, _ = canonicalize_url(url)
+    return media_id if platform is None or url_platform == platform else None
+
+# ============================================================================
+# 💾 파일 저장 헬퍼
+# ============================================================================
+
+def write_json_atomic(path, data, indent=None):
+    """임시 파일에 쓴 뒤 rename (쓰는 도중 종료돼도 기존 파일이 깨지지 않음)"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+class CachedJsonFile:
+    """작은 JSON 파일 (users.json 등) - 메모리 캐시로 읽고, 변경은 잠금 안에서 원자적으로 저장"""
+    
+    def __init__(self, path, default):
+        self.path = path
+        self.default = default
+        self.lock = threading.RLock()
+        self.data = None
+    
+    def load(self):
+        """캐시된 내용 (처음 1회만 파일 읽음, 깨진 파일은 빈 값으로 덮지 않고 예외)"""
+        with self.lock:
+            if self.data is None:
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        self.data = json.load(f)
+                except FileNotFoundError:
+                    self.data = copy.deepcopy(self.default)
+            return self.data
+    
+    def get(self):
+        """읽기 전용 복사본"""
+        with self.lock:
+            return copy.deepcopy(self.load())
+    
+    @contextmanager
+    def edit(self):
+        """with 블록 안에서 수정 → 바뀌었으면 저장 (예외 시 저장 안 함)"""
+        with self.lock:
+            data = copy.deepcopy(self.load())
+            yield data
+            if data != self.data:
+                write_json_atomic(self.path, data, indent=2)
+                self.data = data
+
+# ============================================================================
+# 📤 파일 전송 헬퍼 (sendfile - 커널에서 소켓으로 바로 복사)
+# ============================================================================
+
+def file_range_body(environ, path, start, length):
+    """파일 구간 응답 본문 - 가능하면 sendfile, 아니면 청크 읽기 (Response(direct_passthrough=True)와 함께 사용)"""
+    sock = environ.get('werkzeug.socket')
+    if sock is not None and length > 0:
+        def send():
+            yield b''  # werkzeug는 빈 청크에서 상태줄/헤더만 먼저 전송
+            with open(path, 'rb') as f:
+                try:
+                    sock.sendfile(f, start, length)  # TLS 소켓이면 내부에서 일반 전송으로 대체
+                except OSError:
+                    pass  # 클라이언트가 연결을 끊음 (탐색/건너뛰기)
+        return send()
+    
+    # 다른 WSGI 서버가 제공하는 file_wrapper (전체 파일일 때만 - 구간 지정 불가)
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if file_wrapper and start == 0 and length == os.path.getsize(path):
+        return file_wrapper(open(path, 'rb'), FILE_STREAM_CHUNK_SIZE)
+    
+    def generate():
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = length
+            while remaining > 0:
+                chunk = f.read(min(FILE_STREAM_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+    return generate()
+
+def parse_byte_ranges(range_header, file_size):
+    """Range 헤더 → [(start, end), ...] (겹치는 구간 병합) - 형식 오류/구간 과다면 None, 만족 불가면 []"""
+    unit, _, spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec:
+        return None
+    
+    ranges = []
+    for part in spec.split(','):
+        first, dash, last = part.strip().partition('-')
+        # ASCII 숫자만 허용 (isdigit()은 '²' 같은 문자도 통과시키지만 int()는 실패)
+        if (not dash or not (first or last) or not (first + last).isascii()
+                or (first and not first.isdigit()) or (last and not last.isdigit())):
+            return None
+        if not first:  # bytes=-N (마지막 N바이트)
+            if int(last) == 0:
+                continue
+            start, end = max(file_size - int(last), 0), file_size - 1
+        else:
+            start = int(first)
+            end = min(int(last), file_size - 1) if last else file_size - 1
+            if last and int(last) < start:
+                return None
+        if start < file_size:
+            ranges.append((start, end))
+    
+    if len(ranges) > MAX_BYTE_RANGES:
+        return None
+    
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def single_byte_range(range_header, file_size):
+    """스트리밍 응답용 (start, end, status) - Range 없음/형식 오류/다중 구간이면 전체(200), 만족 불가면 None"""
+    ranges = parse_byte_ranges(range_header, file_size) if range_header else None
+    if ranges == []:
+        return None
+    if ranges and len(ranges) == 1:
+        return ranges[0][0], ranges[0][1], 206
+    return 0, file_size - 1, 200
+
+def multipart_range_body(environ, path, parts, boundary, mimetype, file_size):
+    """multipart/byteranges 본문 + 전체 길이 - 구간 본문은 file_range_body(sendfile) 재사용"""
+    headers = [
+        f"--{boundary}\r\nContent-Type: {mimetype}\r\nContent-Range: bytes {start}-{end}/{file_size}\r\n\r\n".encode('ascii')
+        for start, end in parts
+    ]
+    closing = f"--{boundary}--\r\n".encode('ascii')
+    total = sum(len(header) + (end - start + 1) + 2 for header, (start, end) in zip(headers, parts)) + len(closing)
+    
+    def generate():
+        for header, (start, end) in zip(headers, parts):
+            yield header
+            yield from file_range_body(environ, path, start, end - start + 1)
+            yield b'\r\n'
+        yield closing
+    return generate(), total
+
+# ============================================================================
+# 🎯 포맷 이력 저장소 (메모리 + 추가 전용 저널)
+# ============================================================================
+
+class FormatHistoryStore:
+    """포맷 학습 이력 - 메모리에 보관, 변경은 저널에 한 줄씩 추가, 주기적으로 스냅샷 압축"""
+    
+    def __init__(self, snapshot_file=FORMAT_HISTORY_FILE, journal_file=FORMAT_HISTORY_JOURNAL):
+        self.snapshot_file = snapshot_file
+        self.journal_file = journal_file
+        self.lock = threading.RLock()
+        self.history = {}
+        self.priors = {}  # (device, content): {format: [성공 수, 실패 수]} - 처음 보는 영상용 전체 통계
+        self.journal = None
+        self.pending_events = 0
+        self.compacting = False
+        self.load()
+    
+    def load(self):
+        """스냅샷 + 저널 재생으로 복원 후 바로 압축"""
+        with self.lock:
+            try:
+                if os.path.exists(self.snapshot_file):
+                    with open(self.snapshot_file, 'r', encoding='utf-8') as f:
+                        self.history = json.load(f)
+            except Exception as e:
+                print(f"⚠️ 포맷 이력 로드 실패: {e}")
+                self.history = {}
+            self.migrate_stats()
+            
+            if os.path.exists(self.journal_file):
+                try:
+                    with open(self.journal_file, 'r', encoding='utf-8') as f:
+                        for line in f:
+                            try:
+                                self.apply(json.loads(line))
+                            except ValueError:
+                                continue  # 중간에 끊긴 마지막 줄 등은 무시
+                except Exception as e:
+                    print(f"⚠️ 포맷 이력 저널 재생 실패: {e}")
+            
+            # 갱신 시각이 없는 예전 항목은 지금부터 만료 기간 계산
+            now = datetime.now().isoformat()
+            for entry in self.history.values():
+                if not entry.get('last_updated'):
+                    entry['last_updated'] = now
+            
+            self.compact()
+    
+    @staticmethod
+    def content_type(video_id):
+        """이력 키로 컨텐츠 종류 구분 ('video_' 접두사 = 비디오, 나머지 = 오디오)"""
+        return 'video' if video_id.startswith('video_') else 'audio'
+    
+    def add_prior(self, video_id, device, format_string, successes=0, failures=0):
+        """포맷별 전체 성공/실패 통계 누적"""
+        key = (device or 'desktop', self.content_type(video_id))
+        counts = self.priors.setdefault(key, {}).setdefault(format_string, [0, 0])
+        counts[0] += successes
+        counts[1] += failures
+    
+    def count(self, video_id, entry, device, format_string, successes=0, failures=0):
+        """항목별 (기기, 포맷) 성공/실패 수 + 전체 통계에 같은 값 누적"""
+        device = device or 'desktop'
+        counts = entry.setdefault('format_stats', {}).setdefault(device, {}).setdefault(format_string, [0, 0])
+        counts[0] += successes
+        counts[1] += failures
+        self.add_prior(video_id, device, format_string, successes, failures)
+    
+    def migrate_stats(self):
+        """format_stats가 없는 예전 항목은 남아 있는 필드로 한 번만 추정해 채움"""
+        for entry in self.history.values():
+            if 'format_stats' in entry:
+                continue
+            stats = entry['format_stats'] = {}
+            device_stats = stats.setdefault(entry.get('device') or 'desktop', {})
+            if entry.get('success_format'):
+                device_stats.setdefault(entry['success_format'], [0, 0])[0] += max(entry.get('success_count', 0), 1)
+            for format_string in entry.get('failed_formats', []):
+                device_stats.setdefault(format_string, [0, 0])[1] += 1
+    
+    def rebuild_priors(self):
+        """현재 이력 전체로 포맷별 통계 재계산 (압축 시 만료 항목 반영) - apply가 더한 값을 그대로 합산"""
+        self.priors = {}
+        for video_id, entry in self.history.items():
+            for device, formats in entry.get('format_stats', {}).items():
+                for format_string, (successes, failures) in formats.items():
+                    self.add_prior(video_id, device, format_string, successes, failures)
+    
+    def rank_formats(self, default_formats, device, content):
+        """전체 통계(라플라스 보정 성공률) 순으로 기본 포맷 정렬 - 동률이면 기본 순서 유지"""
+        with self.lock:
+            stats = self.priors.get((device, content), {})
+            
+            def score(item):
+                index, format_string = item
+                successes, failures = stats.get(format_string, (0, 0))
+                return (-(successes + 1) / (successes + failures + 2), index)
+            
+            return [fmt for _, fmt in sorted(enumerate(default_formats), key=score)]
+    
+    def apply(self, event):
+        """이벤트 1건을 메모리 이력에 반영"""
+        video_id = event['id']
+        format_string = event['format']
+        entry = self.history.get(video_id)
+        
+        if event['op'] == 'success':
+            if entry is None:
+                entry = self.history[video_id] = {
+                    'success_format': None,
+                    'failed_formats': [],
+                    'last_updated': None,
+                    'success_count': 0,
+                    'device': event.get('device', 'desktop')
+                }
+            entry['success_format'] = format_string
+            entry['success_count'] = entry.get('success_count', 0) + 1
+            entry['last_updated'] = event['ts']
+            entry['device'] = event.get('device', 'desktop')
+            
+            # 성공하면 failed_formats에서 제거
+            if format_string in entry.get('failed_formats', []):
+                entry['failed_formats'].remove(format_string)
+            
+            self.count(video_id, entry, entry['device'], format_string, successes=1)
+        else:
+            if entry is None:
+                entry = self.history[video_id] = {
+                    'success_format': None,
+                    'failed_formats': [],
+                    'last_updated': None,
+                    'success_count': 0
+                }
+            entry.setdefault('failed_formats', [])
+            if format_string not in entry['failed_formats']:
+                entry['failed_formats'].append(format_string)
+            entry['last_updated'] = event['ts']
+            
+            self.count(video_id, entry, event.get('device') or entry.get('device'), format_string, failures=1)
+        
+        return entry
+    
+    def record(self, op, video_id, format_string, device=None):
+        """성공/실패 기록 - 메모리 반영 + 저널 1줄 추가 (O(1))"""
+        event = {'op': op, 'id': video_id, 'format': format_string, 'ts': datetime.now().isoformat()}
+        if device:
+            event['device'] = device
+        
+        with self.lock:
+            entry = dict(self.apply(event))
+            try:
+                if self.journal is None:
+                    self.journal = open(self.journal_file, 'a', encoding='utf-8')
+                self.journal.write(json.dumps(event, ensure_ascii=False) + '\n')
+                self.journal.flush()
+            except Exception as e:
+                print(f"⚠️ 포맷 이력 저널 기록 실패: {e}")
+            
+            self.pending_events += 1
+            if self.pending_events >= FORMAT_HISTORY_COMPACT_EVERY and not self.compacting:
+                self.compacting = True
+                threading.Thread(target=self.compact, daemon=True).start()
+        
+        return entry
+    
+    def compact(self):
+        """오래된 항목 정리 후 스냅샷 저장, 저널 비우기"""
+        with self.lock:
+            try:
+                cutoff = (datetime.now() - timedelta(days=FORMAT_HISTORY_MAX_AGE_DAYS)).isoformat()
+                expired = [vid for vid, entry in self.history.items()
+                           if (entry.get('last_updated') or '') < cutoff]
+                for vid in expired:
+                    del self.history[vid]
+                self.rebuild_priors()
+                
+                write_json_atomic(self.snapshot_file, self.history, indent=2)
+                
+                if self.journal is not None:
+                    self.journal.close()
+                    self.journal = None
+                open(self.journal_file, 'w').close()
+                self.pending_events = 0
+                
+                if expired:
+                    print(f"🧹 포맷 이력 정리: {len(expired)}개 만료 항목 삭제")
+            except Exception as e:
+                print(f"⚠️ 포맷 이력 압축 실패: {e}")
+            finally:
+                self.compacting = False
+    
+    def get(self, video_id):
+        """video_id 이력 조회 (복사본)"""
+        with self.lock:
+            entry = self.history.get(video_id)
+            return copy.deepcopy(entry) if entry else None
+    
+    def snapshot(self):
+        """전체 이력 복사본"""
+        with self.lock:
+            return copy.deepcopy(self.history)
+    
+    def replace(self, history):
+        """전체 이력 교체 (즉시 스냅샷 저장)"""
+        with self.lock:
+            self.history = copy.deepcopy(history)
+            self.migrate_stats()
+            self.compact()
+
+# ============================================================================
+# 🤝 요청 병합 (single-flight)
+# ============================================================================
+
+class SingleFlight:
+    """같은 키로 동시에 들어온 작업을 하나로 합침 (진행 중인 Future 결과 공유)"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = {}  # key: Future
+    
+    def do(self, key, fn, *args, **kwargs):
+        """진행 중인 같은 작업이 있으면 그 결과를 기다리고, 없으면 직접 실행"""
+        with self.lock:
+            future = self.inflight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self.inflight[key] = future
+        
+        if not is_leader:
+            return future.result()
+        
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+
+# ============================================================================
+# 📥 다운로드 스케줄러 (우선순위 큐 + 작업자 수 제한)
+# ============================================================================
+
+class DownloadCancelled(Exception):
+    """취소된 다운로드 작업 (progress hook에서 발생시켜 yt-dlp 중단)"""
+
+
+class DownloadJob:
+    """다운로드 작업 1건 (상태 + 진행률 + 취소 플래그)"""
+    
+    PRIORITY_NAMES = {level: name for name, level in DOWNLOAD_PRIORITIES.items()}
+    
+    def __init__(self, key, fn, priority):
+        self.key = key
+        self.fn = fn
+        self.priority = priority
+        self.state = 'queued'  # queued → running → done / failed / cancelled
+        self.cancel_event = threading.Event()
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.downloaded_bytes = 0
+        self.total_bytes = 0
+        self.total_bytes_exact = False  # total_bytes가 추정치(total_bytes_estimate)가 아닌 정확한 크기인지
+        self.speed = None
+        self.eta = None
+        self.error = None
+        self.result = None  # 작업 함수 반환값 (오디오 다운로드는 로컬 URL)
+        self.filename = None  # yt-dlp 최종 파일 경로
+        self.tmpfilename = None  # 받는 중인 .part 경로
+        self.source_url = None  # 받고 있는 원본 URL (아직 안 받은 구간 리다이렉트용)
+        self.version = 0  # 상태가 바뀔 때마다 증가 (진행률 구독용)
+        self.updated = threading.Condition()
+    
+    def touch(self):
+        """상태 변경 알림 (SSE 구독자 깨우기)"""
+        with self.updated:
+            self.version += 1
+            self.updated.notify_all()
+    
+    def wait_for_update(self, version, timeout):
+        """version 이후 변경이 있을 때까지 대기 (최대 timeout초) - 현재 version 반환"""
+        with self.updated:
+            self.updated.wait_for(lambda: self.version != version, timeout)
+            return self.version
+    
+    def check_cancelled(self):
+        """취소 요청이 있으면 DownloadCancelled 발생"""
+        if self.cancel_event.is_set():
+            raise DownloadCancelled(self.key)
+    
+    def progress_hook(self, d):
+        """yt-dlp progress hook - 진행률 갱신 + 취소 확인"""
+        self.check_cancelled()
+        if d.get('status') == 'downloading':
+            self.filename = d.get('filename')
+            self.tmpfilename = d.get('tmpfilename')
+            self.source_url = (d.get('info_dict') or {}).get('url')
+            self.downloaded_bytes = d.get('downloaded_bytes') or 0
+            self.total_bytes = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+            self.total_bytes_exact = bool(d.get('total_bytes'))
+            self.speed = d.get('speed')
+            self.eta = d.get('eta')
+            self.touch()
+    
+    def to_dict(self):
+        """API/GUI 표시용 상태"""
+        return {
+            'key': self.key,
+            'priority': self.PRIORITY_NAMES.get(self.priority, 'bulk'),
+            'state': self.state,
+            'downloaded_bytes': self.downloaded_bytes,
+            'total_bytes': self.total_bytes,
+            'speed': self.speed,
+            'eta': self.eta,
+            'error': self.error,
+            'result': self.result if isinstance(self.result, str) else None,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at
+        }
+
+
+class DownloadScheduler:
+    """우선순위 다운로드 큐 (재생 중 > 미리 받기 > 일괄, 같은 키 병합, 우선순위 상향, 취소)"""
+    
+    def __init__(self, workers=DOWNLOAD_WORKERS, log=print):
+        self.workers = max(1, workers)
+        self.log = log
+        self.cond = threading.Condition()
+        self.queue = []  # heap: (priority, 순번, job) - 우선순위 상향 시 새 항목 추가, 옛 항목은 꺼낼 때 무시
+        self.sequence = itertools.count()
+        self.jobs = {}  # key: 대기/진행 중 작업
+        self.history = deque(maxlen=DOWNLOAD_HISTORY_SIZE)
+        self.live_workers = 0
+        self.stopped = False
+    
+    def submit(self, key, fn, priority='bulk'):
+        """작업 예약 - 같은 키가 이미 있으면 우선순위만 올림. (job, 새로 예약 여부) 반환"""
+        level = DOWNLOAD_PRIORITIES.get(priority, DOWNLOAD_PRIORITIES['bulk'])
+        with self.cond:
+            job = self.jobs.get(key)
+            if job and not job.cancel_event.is_set():
+                if level < job.priority:
+                    job.priority = level
+                    if job.state == 'queued':
+                        heapq.heappush(self.queue, (level, next(self.sequence), job))
+                        self.cond.notify()
+                    self.log(f"⬆️ 다운로드 우선순위 상향: {key} ({priority})")
+                return job, False
+            
+            job = DownloadJob(key, fn, level)
+            self.jobs[key] = job
+            heapq.heappush(self.queue, (level, next(self.sequence), job))
+            self.ensure_workers()
+            self.cond.notify()
+            return job, True
+    
+    def cancel(self, key, priority=None):
+        """작업 취소 (priority 지정 시 그보다 중요한 작업은 건드리지 않음)"""
+        with self.cond:
+            job = self.jobs.get(key)
+            if not job or job.cancel_event.is_set():
+                return False
+            if priority is not None and job.priority < DOWNLOAD_PRIORITIES.get(priority, 0):
+                return False
+            
+            job.cancel_event.set()
+            if job.state == 'queued':
+                self.finish(job, 'cancelled')
+            return True
+    
+    def set_workers(self, workers):
+        """동시 다운로드 수 변경 (줄이면 진행 중 작업이 끝난 작업자부터 종료)"""
+        with self.cond:
+            self.workers = max(1, workers)
+            self.ensure_workers()
+            self.cond.notify_all()
+    
+    def stop(self):
+        """모든 작업 취소 + 작업자 종료"""
+        with self.cond:
+            self.stopped = True
+            for job in list(self.jobs.values()):
+                job.cancel_event.set()
+                if job.state == 'queued':
+                    self.finish(job, 'cancelled')
+            self.cond.notify_all()
+    
+    def is_active(self, key):
+        """대기/진행 중인 작업이 있는지 확인"""
+        with self.cond:
+            return key in self.jobs
+    
+    def find(self, key):
+        """대기/진행 중 작업, 없으면 가장 최근에 끝난 같은 키 작업"""
+        with self.cond:
+            job = self.jobs.get(key)
+            if job:
+                return job
+            for job in reversed(self.history):
+                if job.key == key:
+                    return job
+            return None
+    
+    def status(self):
+        """큐 깊이 + 작업별 상태"""
+        with self.cond:
+            active = sorted(self.jobs.values(), key=lambda job: (job.state != 'running', job.priority, job.created_at))
+            return {
+                'workers': self.workers,
+                'running': sum(1 for job in active if job.state == 'running'),
+                'queued': sum(1 for job in active if job.state == 'queued'),
+                'jobs': [job.to_dict() for job in active],
+                'recent': [job.to_dict() for job in reversed(self.history)]
+            }
+    
+    def ensure_workers(self):
+        """설정된 수만큼 작업자 스레드 유지 (cond 잠금 상태에서 호출)"""
+        while not self.stopped and self.live_workers < self.workers:
+            self.live_workers += 1
+            threading.Thread(target=self.worker_loop, daemon=True).start()
+    
+    def finish(self, job, state, error=None):
+        """작업 종료 처리 (cond 잠금 상태에서 호출)"""
+        job.state = state
+        job.error = error
+        job.finished_at = time.time()
+        if self.jobs.get(job.key) is job:
+            del self.jobs[job.key]
+        self.history.append(job)
+        job.touch()
+    
+    def next_job(self):
+        """가장 우선순위 높은 대기 작업 꺼내기 (cond 잠금 상태에서 호출)"""
+        while self.queue:
+            level, _, job = heapq.heappop(self.queue)
+            if job.state == 'queued' and level == job.priority:
+                return job
+        return None
+    
+    def worker_loop(self):
+        """작업자 스레드: 큐에서 하나씩 꺼내 실행"""
+        while True:
+            with self.cond:
+                while True:
+                    if self.stopped or self.live_workers > self.workers:
+                        self.live_workers -= 1
+                        return
+                    job = self.next_job()
+                    if job:
+                        break
+                    self.cond.wait()
+                job.state = 'running'
+                job.started_at = time.time()
+            job.touch()
+            
+            try:
+                job.check_cancelled()
+                job.result = job.fn(job)
+                state, error = ('failed', '모든 포맷 실패') if job.result is False else ('done', None)
+            except DownloadCancelled:
+                state, error = 'cancelled', None
+            except Exception as e:
+                state, error = ('cancelled', None) if job.cancel_event.is_set() else ('failed', str(e))
+            
+            with self.cond:
+                self.finish(job, state, error)
+            
+            if state == 'cancelled':
+                self.log(f"🛑 다운로드 취소: {job.key}")
+
+# ============================================================================
+# 📚 미디어 카탈로그 (video_id → 제목/썸네일/길이/채널/로컬 파일)
+# ============================================================================
+
+class MediaCatalog:
+    """서버 전체 video_id 카탈로그 - 추출/다운로드/공유 때마다 갱신, 저장은 모아서 원자적으로"""
+    
+    FIELDS = ('title', 'thumbnail', 'duration', 'channel', 'audio_file', 'video_file')
+    
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.entries = {}  # video_id: {title, thumbnail, duration, channel, audio_file, video_file, updated_at}
+        self.save_timer = None
+        self.loaded_from_file = self.load()
+    
+    def load(self):
+        """카탈로그 파일 로드 (없으면 False)"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if isinstance(data, dict):
+            self.entries = data
+        return True
+    
+    def get(self, video_id):
+        """카탈로그 항목 (없으면 None)"""
+        with self.lock:
+            entry = self.entries.get(video_id)
+            return dict(entry) if entry else None
+    
+    def update(self, video_id, **fields):
+        """빈 값은 무시하고 병합 (더 나은 정보만 덮어씀)"""
+        if not video_id or video_id == 'unknown':
+            return
+        values = {key: value for key, value in fields.items()
+                  if key in self.FIELDS and value not in (None, '', 0, 'Unknown')}
+        if not values:
+            return
+        
+        with self.lock:
+            entry = self.entries.setdefault(video_id, {})
+            changed = any(entry.get(key) != value for key, value in values.items())
+            if changed:
+                entry.update(values)
+                entry['updated_at'] = datetime.now().isoformat()
+        if changed:
+            self.schedule_save()
+    
+    def update_from_info(self, info, **extra):
+        """yt-dlp info로 갱신"""
+        if not info:
+            return
+        self.update(
+            info.get('id'),
+            title=info.get('title'),
+            thumbnail=info.get('thumbnail'),
+            duration=info.get('duration'),
+            channel=info.get('channel') or info.get('uploader'),
+            **extra
+        )
+    
+    def discard_field(self, video_id, field):
+        """삭제된 로컬 파일 정보 제거"""
+        with self.lock:
+            entry = self.entries.get(video_id)
+            if not entry or field not in entry:
+                return
+            del entry[field]
+        self.schedule_save()
+    
+    def schedule_save(self):
+        """변경을 모아서 MEDIA_CATALOG_SAVE_DELAY초 뒤 한 번 저장"""
+        with self.lock:
+            if self.save_timer:
+                return
+            self.save_timer = threading.Timer(MEDIA_CATALOG_SAVE_DELAY, self.flush)
+            self.save_timer.daemon = True
+            self.save_timer.start()
+    
+    def flush(self):
+        """즉시 저장"""
+        with self.save_lock:
+            with self.lock:
+                if self.save_timer:
+                    self.save_timer.cancel()
+                    self.save_timer = None
+                data = copy.deepcopy(self.entries)
+            try:
+                write_json_atomic(self.path, data)
+            except OSError as e:
+                print(f"⚠️ 카탈로그 저장 실패: {e}")
+
+# ============================================================================
+# 🗃️ 사용자 라이브러리 DB (항목 단위 조회/추가/삭제 - 파일 전체를 읽고 쓰지 않음)
+# ============================================================================
+
+class LibraryView:
+    """캐시된 목록 1개 - 저장 순서 행 + 필드 값 → 행 색인 (item_id/video_id/filename/url/item_key 조회 O(1))"""
+    
+    LOOKUP_FIELDS = ('item_id', 'item_key', 'video_id', 'filename', 'url')
+    
+    def __init__(self, rows):
+        self.rows = []  # [(row id, {컬럼: 값, 'position': 정렬 값}, 항목), ...] 저장 순서
+        self.index = {field: {} for field in self.LOOKUP_FIELDS}
+        for row in rows:
+            self.add(row)
+    
+    def add(self, row, front=False):
+        if front:
+            self.rows.insert(0, row)
+        else:
+            self.rows.append(row)
+        for field, index in self.index.items():
+            value = row[1].get(field)
+            if value is not None:
+                matches = index.setdefault(value, [])
+                if front:
+                    matches.insert(0, row)
+                else:
+                    matches.append(row)
+    
+    def remove(self, row_ids):
+        self.__init__([row for row in self.rows if row[0] not in row_ids])
+    
+    def match(self, fields):
+        """조건에 맞는 행 (저장 순서) - 색인 필드 값이 있으면 색인으로, 없으면 전체에서 거름"""
+        if any(field not in LibraryStore.COLUMNS for field in fields):
+            raise ValueError(f"조회할 수 없는 필드: {list(fields)}")
+        candidates = self.rows
+        for field in self.LOOKUP_FIELDS:
+            if fields.get(field) is not None:
+                candidates = self.index[field].get(fields[field], [])
+                break
+        return [row for row in candidates if all(row[1].get(key) == value for key, value in fields.items())]
+
+class LibraryStore:
+    """갤러리 메타데이터/재생 목록/즐겨찾기 - SQLite(WAL), 스레드마다 연결 1개, 목록은 메모리 캐시+색인
+    
+    metadata 항목은 kind로 구분: 'video' = 갤러리 영상 (filename 필수), 'audio' = 음원 정보 (item_key = video_id)
+    """
+    
+    TABLES = {'metadata': 'library_items', 'playlist': 'playlist_entries', 'favorites': 'favorites'}
+    COLUMNS = ('item_id', 'item_key', 'kind', 'video_id', 'url', 'filename')
+    
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.user_locks = {}  # username: RLock (변경은 사용자마다 직렬화)
+        self.cache = {}  # (collection, username): LibraryView - DB와 함께 갱신
+        conn = self.connect()
+        with conn:
+            for table in self.TABLES.values():
+                # position: 정렬 순서 (맨 앞 추가 = 최솟값-1 → 다른 행은 건드리지 않음)
+                # item_key: 음원 metadata의 키 (그 외 항목은 NULL)
+                conn.execute(f"""CREATE TABLE IF NOT EXISTS {table} (
+                    id INTEGER PRIMARY KEY,
+                    username TEXT NOT NULL,
+                    position REAL NOT NULL,
+                    item_id TEXT,
+                    item_key TEXT,
+                    kind TEXT,
+                    video_id TEXT,
+                    url TEXT,
+                    filename TEXT,
+                    data TEXT NOT NULL
+                )""")
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_position ON {table} (username, position)")
+            conn.execute("""CREATE TABLE IF NOT EXISTS migrations (
+                username TEXT NOT NULL,
+                source TEXT NOT NULL,
+                migrated_at TEXT NOT NULL,
+                PRIMARY KEY (username, source)
+            )""")
+        self.migrate_schema(conn)
+    
+    def migrate_schema(self, conn):
+        """PRAGMA user_version → LIBRARY_SCHEMA_VERSION"""
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= LIBRARY_SCHEMA_VERSION:
+            return
+        with conn:
+            if version < 2:
+                # v2: metadata 종류(kind) 컬럼 + 음원 항목에도 video_id 저장 (조회는 메모리 색인)
+                for table in self.TABLES.values():
+                    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+                    if 'kind' not in columns:
+                        conn.execute(f"ALTER TABLE {table} ADD COLUMN kind TEXT")
+                    for name in ('video_id', 'url', 'filename'):
+                        conn.execute(f"DROP INDEX IF EXISTS {table}_{name}")
+                conn.execute("DROP INDEX IF EXISTS library_items_item_key")
+                rows = conn.execute("SELECT id, item_key, data FROM library_items").fetchall()
+                for row_id, item_key, data in rows:
+                    item = json.loads(data)
+                    kind = self.item_kind('metadata', item_key)
+                    if kind == 'audio':
+                        item['video_id'] = item_key
+                    conn.execute("UPDATE library_items SET kind = ?, video_id = ?, data = ? WHERE id = ?",
+                                 (kind, item.get('video_id'), json.dumps(item, ensure_ascii=False), row_id))
+            if version < 3:
+                # v3: 항목마다 고정 item_id (목록 순서/인덱스와 무관하게 항목 지정)
+                for table in self.TABLES.values():
+                    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+                    if 'item_id' not in columns:
+                        conn.execute(f"ALTER TABLE {table} ADD COLUMN item_id TEXT")
+                    for row_id, data in conn.execute(f"SELECT id, data FROM {table} WHERE item_id IS NULL").fetchall():
+                        item = json.loads(data)
+                        item['item_id'] = item.get('item_id') or uuid.uuid4().hex
+                        conn.execute(f"UPDATE {table} SET item_id = ?, data = ? WHERE id = ?",
+                                     (item['item_id'], json.dumps(item, ensure_ascii=False), row_id))
+            if version < 4:
+                # v4: URL/파일명에서 video_id 1회 추출해 저장 (이후 GET 경로는 정규식 없음)
+                for table in self.TABLES.values():
+                    for row_id, data in conn.execute(f"SELECT id, data FROM {table} WHERE video_id IS NULL").fetchall():
+                        item = self.with_video_id(json.loads(data))
+                        if item.get('video_id'):
+                            conn.execute(f"UPDATE {table} SET video_id = ?, data = ? WHERE id = ?",
+                                         (item['video_id'], json.dumps(item, ensure_ascii=False), row_id))
+            conn.execute(f"PRAGMA user_version = {LIBRARY_SCHEMA_VERSION}")
+    
+    def connect(self):
+        """현재 스레드의 연결 (WAL: 읽기는 쓰기와 동시에 진행)"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=LIBRARY_DB_TIMEOUT)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+    
+    def user_lock(self, username):
+        """사용자 잠금 - 조회 후 변경(읽기-수정-쓰기)은 with로 묶어서 사용"""
+        with self.lock:
+            return self.user_locks.setdefault(username, threading.RLock())
+    
+    @staticmethod
+    def item_kind(collection, item_key=None):
+        if collection != 'metadata':
+            return None
+        return 'audio' if item_key else 'video'
+    
+    @staticmethod
+    def with_video_id(item):
+        """video_id가 없으면 URL(정규화) 또는 저장소 파일명에서 채움"""
+        if not item.get('video_id'):
+            video_id = extract_video_id(item.get('url'), platform=None) or VideoBlobStore.media_id(item.get('filename'))
+            if video_id:
+                item['video_id'] = video_id
+        return item
+    
+    def row(self, collection, item, item_key=None):
+        """(컬럼 값 dict, 저장할 항목) - item_id가 없으면 새로 부여, video_id는 항상 채워서 저장"""
+        kind = self.item_kind(collection, item_key)
+        item = dict(item, item_id=item.get('item_id') or uuid.uuid4().hex)
+        if kind == 'audio':
+            item['video_id'] = item_key
+        self.with_video_id(item)
+        fields = {'item_id': item['item_id'], 'item_key': item_key, 'kind': kind, 'video_id': item.get('video_id'),
+                  'url': item.get('url'), 'filename': item.get('filename')}
+        return fields, item
+    
+    def insert_row(self, conn, collection, username, position, item, item_key=None):
+        """INSERT 후 (row id, 컬럼 값, 항목)"""
+        fields, item = self.row(collection, item, item_key)
+        cursor = conn.execute(
+            f"INSERT INTO {self.TABLES[collection]} (username, position, {', '.join(self.COLUMNS)}, data) "
+            f"VALUES (?, ?, {', '.join('?' * len(self.COLUMNS))}, ?)",
+            (username, position) + tuple(fields[column] for column in self.COLUMNS) + (json.dumps(item, ensure_ascii=False),)
+        )
+        return cursor.lastrowid, dict(fields, position=position), item
+    
+    @staticmethod
+    def slot(rows, before=None, after=None):
+        """(목록 내 위치, position 값) - before/after item_id 옆, 둘 다 없으면 맨 앞 (앞뒤 값의 중간 → 다른 행은 그대로)"""
+        if before is not None or after is not None:
+            ids = [row[1]['item_id'] for row in rows]
+            target = before if before is not None else after
+            if target not in ids:
+                raise ValueError(f"없는 항목: {target}")
+            index = ids.index(target) + (0 if before is not None else 1)
+        else:
+            index = 0
+        low = rows[index - 1][1]['position'] if index > 0 else None
+        high = rows[index][1]['position'] if index < len(rows) else None
+        if low is None and high is None:
+            return index, 0.0
+        if low is None:
+            return index, high - 1
+        if high is None:
+            return index, low + 1
+        return index, (low + high) / 2
+    
+    def renumber(self, conn, collection, rows):
+        """position 값 사이에 더 끼울 자리가 없을 때 0, 1, 2, ...로 다시 매김"""
+        conn.executemany(f"UPDATE {self.TABLES[collection]} SET position = ? WHERE id = ?",
+                         [(float(position), row[0]) for position, row in enumerate(rows)])
+        return [(row[0], dict(row[1], position=float(position)), row[2]) for position, row in enumerate(rows)]
+    
+    def view(self, collection, username):
+        """캐시된 목록 (없으면 DB에서 1회 읽음) - 사용자 잠금 안에서 호출"""
+        view = self.cache.get((collection, username))
+        if view is None:
+            rows = self.connect().execute(
+                f"SELECT id, position, {', '.join(self.COLUMNS)}, data FROM {self.TABLES[collection]} "
+                f"WHERE username = ? ORDER BY position, id", (username,)
+            )
+            view = LibraryView([(row[0], dict(zip(self.COLUMNS, row[2:-1]), position=row[1]), json.loads(row[-1]))
+                                for row in rows])
+            self.cache[(collection, username)] = view
+        return view
+    
+    def load(self, collection, username, **fields):
+        """[(item_key, 항목), ...] - 저장 순서대로, 조건(kind 등)이 있으면 맞는 것만 (항목은 복사본)"""
+        with self.user_lock(username):
+            view = self.view(collection, username)
+            rows = view.match(fields) if fields else view.rows
+            return [(row[1]['item_key'], copy.deepcopy(row[2])) for row in rows]
+    
+    def replace(self, collection, username, items, **fields):
+        """목록 전체 교체 (기존 save_* 호환) - 조건(kind 등)이 있으면 맞는 행만 교체"""
+        with self.user_lock(username):
+            conn = self.connect()
+            with conn:
+                old_ids = [row[0] for row in self.view(collection, username).match(fields)]
+                conn.executemany(f"DELETE FROM {self.TABLES[collection]} WHERE id = ?", [(row_id,) for row_id in old_ids])
+                for position, (item_key, item) in enumerate(items):
+                    self.insert_row(conn, collection, username, position, item, item_key)
+            self.cache.pop((collection, username), None)
+    
+    def insert(self, collection, username, item, front=True, item_key=None):
+        """항목 1개 추가 (맨 앞/맨 뒤) - 추가한 항목 반환 (item_id 포함)"""
+        with self.user_lock(username):
+            view = self.view(collection, username)
+            if not view.rows:
+                position = 0.0
+            else:
+                position = view.rows[0][1]['position'] - 1 if front else view.rows[-1][1]['position'] + 1
+            conn = self.connect()
+            with conn:
+                row = self.insert_row(conn, collection, username, position, item, item_key)
+            view.add(row, front=front)
+            return copy.deepcopy(row[2])
+    
+    def apply(self, collection, username, ops):
+        """여러 변경을 트랜잭션 1개로 적용 - 바뀐 행만 쓰고, 하나라도 실패하면(ValueError) 아무것도 반영 안 됨
+        
+        {'op': 'insert', 'item': 항목, 'before'/'after': item_id}
+        {'op': 'move', 'item_id': ..., 'before'/'after': item_id}  (before/after가 없으면 맨 앞)
+        {'op': 'delete', 'item_id': ...}
+        반환: (추가한 항목 목록, 삭제한 항목 목록)
+        """
+        table = self.TABLES[collection]
+        with self.user_lock(username):
+            rows = list(self.view(collection, username).rows)
+            inserted, deleted = [], []
+            conn = self.connect()
+            with conn:
+                for op in ops:
+                    action = op.get('op')
+                    if action in ('move', 'delete'):
+                        index = next((i for i, row in enumerate(rows) if row[1]['item_id'] == op.get('item_id')), None)
+                        if index is None:
+                            raise ValueError(f"없는 항목: {op.get('item_id')}")
+                        row = rows.pop(index)
+                        if action == 'delete':
+                            conn.execute(f"DELETE FROM {table} WHERE id = ?", (row[0],))
+                            deleted.append(row[2])
+                            continue
+                    elif action != 'insert':
+                        raise ValueError(f"알 수 없는 작업: {action}")
+                    
+                    index, position = self.slot(rows, op.get('before'), op.get('after'))
+                    if position in [row[1]['position'] for row in rows[max(index - 1, 0):index + 1]]:
+                        rows = self.renumber(conn, collection, rows)  # float 간격 소진
+                        index, position = self.slot(rows, op.get('before'), op.get('after'))
+                    if action == 'insert':
+                        row = self.insert_row(conn, collection, username, position, op.get('item') or {})
+                        inserted.append(copy.deepcopy(row[2]))
+                    else:
+                        conn.execute(f"UPDATE {table} SET position = ? WHERE id = ?", (position, row[0]))
+                        row = (row[0], dict(row[1], position=position), row[2])
+                    rows.insert(index, row)
+            self.cache[(collection, username)] = LibraryView(rows)
+            return inserted, deleted
+    
+    def reorder(self, collection, username, item_ids):
+        """item_ids 순서대로 재배치 (목록에 없는 항목은 그 뒤에 기존 순서로) - position이 바뀐 행만 갱신, 갱신 수 반환"""
+        with self.user_lock(username):
+            view = self.view(collection, username)
+            ordered = []
+            for item_id in dict.fromkeys(item_ids):
+                ordered.extend(view.index['item_id'].get(item_id, []))
+            listed = {row[0] for row in ordered}
+            ordered += [row for row in view.rows if row[0] not in listed]
+            changed = [(float(position), row[0]) for position, row in enumerate(ordered) if row[1]['position'] != position]
+            conn = self.connect()
+            with conn:
+                conn.executemany(f"UPDATE {self.TABLES[collection]} SET position = ? WHERE id = ?", changed)
+            self.cache[(collection, username)] = LibraryView(
+                [(row[0], dict(row[1], position=float(position)), row[2]) for position, row in enumerate(ordered)]
+            )
+            return len(changed)
+    
+    def put_keyed(self, collection, username, item_key, item):
+        """키가 있는 항목 추가/교체 (음원 metadata)"""
+        with self.user_lock(username):
+            old_ids = {row[0] for row in self.view(collection, username).match({'item_key': item_key})}
+            conn = self.connect()
+            with conn:
+                conn.executemany(f"DELETE FROM {self.TABLES[collection]} WHERE id = ?", [(row_id,) for row_id in old_ids])
+            if old_ids:
+                self.view(collection, username).remove(old_ids)
+            self.insert(collection, username, item, front=False, item_key=item_key)
+    
+    def find(self, collection, username, **fields):
+        """조건에 맞는 첫 항목 (없으면 None)"""
+        with self.user_lock(username):
+            rows = self.view(collection, username).match(fields)
+            return copy.deepcopy(rows[0][2]) if rows else None
+    
+    def exists(self, collection, username, **fields):
+        with self.user_lock(username):
+            return bool(self.view(collection, username).match(fields))
+    
+    def delete(self, collection, username, **fields):
+        """조건에 맞는 항목 삭제 - 삭제한 항목 목록 반환"""
+        with self.user_lock(username):
+            view = self.view(collection, username)
+            rows = view.match(fields)
+            if not rows:
+                return []
+            conn = self.connect()
+            with conn:
+                conn.executemany(f"DELETE FROM {self.TABLES[collection]} WHERE id = ?", [(row[0],) for row in rows])
+            view.remove({row[0] for row in rows})
+            return [row[2] for row in rows]
+    
+    def count(self, collection, username, **fields):
+        with self.user_lock(username):
+            view = self.view(collection, username)
+            return len(view.match(fields)) if fields else len(view.rows)
+    
+    def usernames(self):
+        """라이브러리에 항목이 있는 모든 사용자"""
+        union = ' UNION '.join(f"SELECT DISTINCT username FROM {table}" for table in self.TABLES.values())
+        return [row[0] for row in self.connect().execute(union)]
+    
+    def is_migrated(self, username, source):
+        return self.connect().execute(
+            "SELECT 1 FROM migrations WHERE username = ? AND source = ?", (username, source)
+        ).fetchone() is not None
+    
+    def import_json(self, collection, username, data, source):
+        """기존 JSON 파일 내용 가져오기 (1회) - {키: 항목} / [항목] 모두 지원, 가져온 항목 수 반환"""
+        if isinstance(data, dict):
+            items = [(key, value) for key, value in data.items() if isinstance(value, dict)]
+        else:
+            items = [(None, item) for item in data if isinstance(item, dict)]
+        kinds = {self.item_kind(collection, item_key) for item_key, _ in items}
+        with self.user_lock(username):
+            conn = self.connect()
+            with conn:
+                # 같은 종류 행만 교체 (metadata.json이 음원/갤러리 어느 형태였든 다른 종류는 유지)
+                for kind in kinds:
+                    conn.execute(f"DELETE FROM {self.TABLES[collection]} WHERE username = ? AND kind IS ?",
+                                 (username, kind))
+                for position, (item_key, item) in enumerate(items):
+                    self.insert_row(conn, collection, username, position, item, item_key)
+                conn.execute("INSERT OR REPLACE INTO migrations (username, source, migrated_at) VALUES (?, ?, ?)",
+                             (username, source, datetime.now().isoformat()))
+            self.cache.pop((collection, username), None)
+        return len(items)
+
+# ============================================================================
+# 📦 공용 영상 저장소 (같은 영상은 1개 파일, 사용자 메타데이터 참조 수로 수명 관리)
+# ============================================================================
+
+class VideoBlobStore:
+    """(플랫폼, 영상 ID, 포맷) → 파일 1개 - 마지막 참조가 사라질 때만 삭제"""
+    
+    def __init__(self, videos_dir):
+        self.videos_dir = videos_dir
+        self.blob_dir = os.path.join(videos_dir, VIDEO_BLOBS_DIR)
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.refs = {}  # filename(VIDEOS_DIR 기준 상대 경로): {참조하는 사용자, ...}
+    
+    @staticmethod
+    def blob_key(platform, media_id, variant='best'):
+        """저장소 키 (확장자 제외)"""
+        return f"{platform}_{media_id}_{variant}"
+    
+    @staticmethod
+    def media_id(filename):
+        """blobs/<플랫폼>_<영상 ID>_<포맷>.<ext> → 영상 ID (저장소 파일이 아니면 None)"""
+        if not filename or not filename.startswith(VIDEO_BLOBS_DIR + '/'):
+            return None
+        key = os.path.splitext(filename[len(VIDEO_BLOBS_DIR) + 1:])[0]
+        platform, _, rest = key.partition('_')
+        media_id, _, variant = rest.rpartition('_')
+        return media_id if platform and media_id and variant else None
+    
+    def output_template(self, platform, variant='best'):
+        """yt-dlp outtmpl - 다운로드가 바로 저장소 파일이 되도록"""
+        return os.path.join(self.blob_dir, self.blob_key(platform, '%(id)s', variant) + '.%(ext)s')
+    
+    def find(self, key):
+        """이미 받은 파일 (VIDEOS_DIR 기준 상대 경로, 없으면 None)"""
+        for ext in VIDEO_BLOB_EXTENSIONS:
+            if os.path.exists(os.path.join(self.blob_dir, key + ext)):
+                return f"{VIDEO_BLOBS_DIR}/{key}{ext}"
+        return None
+    
+    def file_path(self, filename):
+        """상대 경로 → 절대 경로 (VIDEOS_DIR 밖이면 None)"""
+        root = os.path.realpath(self.videos_dir)
+        path = os.path.realpath(os.path.join(root, filename))
+        return path if path.startswith(root + os.sep) else None
+    
+    def rebuild(self, metadata_by_user):
+        """(사용자, metadata) 목록에서 참조 다시 계산 - 시작 시 1회"""
+        refs = {}
+        for username, metadata in metadata_by_user:
+            for item in metadata:
+                if item.get('filename'):
+                    refs.setdefault(item['filename'], set()).add(username)
+        with self.lock:
+            self.refs = refs
+        return sum(len(users) for users in refs.values())
+    
+    def add_ref(self, filename, username):
+        with self.lock:
+            self.refs.setdefault(filename, set()).add(username)
+    
+    def ref_count(self, filename):
+        with self.lock:
+            return len(self.refs.get(filename, ()))
+    
+    def release(self, filename, username):
+        """사용자 참조 해제 - 마지막 참조였으면 파일 삭제 (삭제했으면 True)"""
+        with self.lock:
+            users = self.refs.get(filename)
+            if users:
+                users.discard(username)
+                if users:
+                    return False
+            self.refs.pop(filename, None)
+            path = self.file_path(filename)
+            if not path:
+                return False
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                return False
+            return True
+
+# ============================================================================
+# 🗂️ static/videos 파일명 인덱스 (serve_video 조회 - 디렉토리 스캔 없음)
+# ============================================================================
+
+class VideoFileIndex:
+    """VIDEOS_DIR 파일명 인덱스 - 정확/유니코드 정규화(NFC·NFD)/앞부분 일치 조회, 다운로드·삭제 시 갱신"""
+    
+    def __init__(self, videos_dir, subdirs=(VIDEO_BLOBS_DIR,)):
+        self.videos_dir = videos_dir
+        self.subdirs = subdirs
+        self.lock = threading.Lock()
+        self.names = set()     # 실제 파일명 (VIDEOS_DIR 기준 상대 경로)
+        self.normalized = {}   # NFC 정규화 이름 → 실제 파일명 (macOS는 한글 파일명을 NFD로 저장하기도 함)
+        self.sorted_keys = []  # 정규화 이름 정렬 목록 (앞부분 일치 bisect)
+        self.scan()
+    
+    @staticmethod
+    def normalize(name):
+        return unicodedata.normalize('NFC', name)
+    
+    def scan(self):
+        """시작 시 1회 - 최상위 파일 + blobs/"""
+        names = set()
+        for subdir in ('',) + tuple(self.subdirs):
+            directory = os.path.join(self.videos_dir, subdir)
+            try:
+                with os.scandir(directory) as it:
+                    names.update(f"{subdir}/{entry.name}" if subdir else entry.name
+                                 for entry in it if entry.is_file())
+            except OSError:
+                continue
+        with self.lock:
+            self.names = names
+            self.normalized = {self.normalize(name): name for name in names}
+            self.sorted_keys = sorted(self.normalized)
+        return len(names)
+    
+    def add(self, name):
+        key = self.normalize(name)
+        with self.lock:
+            if name in self.names:
+                return
+            self.names.add(name)
+            if key not in self.normalized:
+                bisect.insort(self.sorted_keys, key)
+            self.normalized[key] = name
+    
+    def remove(self, name):
+        key = self.normalize(name)
+        with self.lock:
+            self.names.discard(name)
+            if self.normalized.get(key) == name:
+                del self.normalized[key]
+                index = bisect.bisect_left(self.sorted_keys, key)
+                if index < len(self.sorted_keys) and self.sorted_keys[index] == key:
+                    del self.sorted_keys[index]
+    
+    def lookup(self, name, prefix_suffix='.mp4'):
+        """실제 파일명 (정확 → 정규화 → 잘린 파일명의 앞부분 일치 순, 없으면 None)"""
+        key = self.normalize(name)
+        with self.lock:
+            if name in self.names:
+                return name
+            if key in self.normalized:
+                return self.normalized[key]
+            
+            # 파일명이 잘린 경우: '<앞부분>*.mp4'
+            base = os.path.splitext(key)[0]
+            index = bisect.bisect_left(self.sorted_keys, base)
+            while index < len(self.sorted_keys) and self.sorted_keys[index].startswith(base):
+                if self.sorted_keys[index].endswith(prefix_suffix):
+                    return self.normalized[self.sorted_keys[index]]
+                index += 1
+        return None
+
+# ============================================================================
+# 🎞️ 갤러리 영상 HLS 패키징 (해상도별 세그먼트 → 모바일 빠른 시작 + 화질 자동 조절)
+# ============================================================================
+
+class HlsPackager:
+    """영상 파일 → HLS (해상도별 세그먼트 + index.m3u8 + poster.jpg) - 완성된 패키지만 제공"""
+    
+    def __init__(self, videos_dir, workers=HLS_PACKAGE_WORKERS, enabled=HLS_PACKAGING_ENABLED, log=print):
+        self.videos_dir = videos_dir
+        self.hls_dir = os.path.join(videos_dir, HLS_DIRNAME)
+        os.makedirs(self.hls_dir, exist_ok=True)
+        self.log = log
+        self.enabled = enabled
+        self.tools_found = shutil.which('ffmpeg') is not None and shutil.which('ffprobe') is not None
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hls')
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.failed = set()  # 변환 불가 (같은 실행 중에는 재시도 안 함)
+        
+        # 완성된 패키지 (index.m3u8이 있는 디렉토리 → 포스터 유무) + 중단된 작업 정리
+        self.ready = {}
+        with os.scandir(self.hls_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.tmp'):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                elif os.path.exists(os.path.join(entry.path, 'index.m3u8')):
+                    self.ready[entry.name] = os.path.exists(os.path.join(entry.path, 'poster.jpg'))
+    
+    @property
+    def available(self):
+        """새 패키징 가능 여부 (설정 켜짐 + ffmpeg/ffprobe 있음) - 이미 만든 패키지는 꺼져 있어도 제공"""
+        return self.enabled and self.tools_found
+    
+    @staticmethod
+    def package_key(filename):
+        """영상 파일명(VIDEOS_DIR 기준 상대 경로) → 패키지 디렉토리 이름"""
+        return hashlib.sha1(filename.encode('utf-8')).hexdigest()[:16]
+    
+    def is_ready(self, key):
+        with self.lock:
+            return key in self.ready
+    
+    def urls(self, filename):
+        """완성된 패키지의 {'hls_url', 'poster_url'} (없으면 None)"""
+        key = self.package_key(filename)
+        with self.lock:
+            if key not in self.ready:
+                return None
+            has_poster = self.ready[key]
+        urls = {'hls_url': f'/api/hls/{key}/index.m3u8'}
+        if has_poster:
+            urls['poster_url'] = f'/api/hls/{key}/poster.jpg'
+        return urls
+    
+    def submit(self, filename):
+        """패키징 예약 (이미 있거나 진행 중이거나 불가능하면 False)"""
+        if not self.available:
+            return False
+        key = self.package_key(filename)
+        with self.lock:
+            if key in self.ready or key in self.pending or key in self.failed:
+                return False
+            self.pending.add(key)
+        try:
+            self.executor.submit(self.package, filename, key)
+        except RuntimeError:  # 종료 중
+            with self.lock:
+                self.pending.discard(key)
+            return False
+        return True
+    
+    @staticmethod
+    def probe_size(path):
+        """(가로, 세로) - ffprobe"""
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+             '-show_entries', 'stream=width,height', '-of', 'json', path],
+            capture_output=True, timeout=30
+        )
+        stream = json.loads(result.stdout or b'{}').get('streams', [{}])[0]
+        return int(stream['width']), int(stream['height'])
+    
+    def package(self, filename, key):
+        source = os.path.join(self.videos_dir, filename)
+        work_dir = os.path.join(self.hls_dir, key + '.tmp')
+        try:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            os.makedirs(work_dir)
+            width, height = self.probe_size(source)
+            portrait = height > width
+            short_side = min(width, height)
+            
+            # 원본보다 큰 해상도는 만들지 않음 (원본이 더 작으면 원본 크기 1개)
+            renditions = [r for r in HLS_RENDITIONS if r[0] <= short_side] \
+                or [(short_side - short_side % 2,) + HLS_RENDITIONS[-1][1:]]
+            
+            master = ['#EXTM3U', '#EXT-X-VERSION:3']
+            for side, video_kbps, audio_kbps in renditions:
+                out_dir = os.path.join(work_dir, f'{side}p')
+                os.makedirs(out_dir)
+                result = subprocess.run(
+                    ['ffmpeg', '-nostdin', '-v', 'error', '-y', '-i', source,
+                     '-map', '0:v:0', '-map', '0:a:0?',
+                     '-vf', f'scale={side}:-2' if portrait else f'scale=-2:{side}',
+                     '-c:v', 'libx264', '-preset', 'veryfast', '-profile:v', 'main',
+                     '-b:v', f'{video_kbps}k', '-maxrate', f'{video_kbps * 107 // 100}k', '-bufsize', f'{video_kbps * 2}k',
+                     '-force_key_frames', f'expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})',  # 세그먼트 경계 = 키프레임
+                     '-c:a', 'aac', '-b:a', f'{audio_kbps}k', '-ac', '2',
+                     '-f', 'hls', '-hls_time', str(HLS_SEGMENT_SECONDS), '-hls_playlist_type', 'vod',
+                     '-hls_segment_filename', os.path.join(out_dir, 'seg_%04d.ts'),
+                     os.path.join(out_dir, 'index.m3u8')],
+                    capture_output=True, timeout=HLS_PACKAGE_TIMEOUT
+                )
+                if result.returncode != 0:
+                    raise RuntimeError(result.stderr.decode('utf-8', 'replace').strip()[-200:])
+                
+                scaled = round(max(width, height) * side / short_side / 2) * 2
+                resolution = f'{side}x{scaled}' if portrait else f'{scaled}x{side}'
+                master.append(f'#EXT-X-STREAM-INF:BANDWIDTH={(video_kbps + audio_kbps) * 1000},RESOLUTION={resolution}')
+                master.append(f'{side}p/index.m3u8')
+            
+            # 🖼️ 갤러리 카드용 포스터 (영상 파일을 열지 않고 이미지 1장만)
+            poster = subprocess.run(
+                ['ffmpeg', '-nostdin', '-v', 'error', '-y', '-ss', '1', '-i', source, '-frames:v', '1',
+                 '-vf', 'scale=480:-2' if portrait else 'scale=-2:360', '-q:v', '4',
+                 os.path.join(work_dir, 'poster.jpg')],
+                capture_output=True, timeout=60
+            )
+            has_poster = poster.returncode == 0 and os.path.exists(os.path.join(work_dir, 'poster.jpg'))
+            
+            with open(os.path.join(work_dir, 'index.m3u8'), 'w', encoding='utf-8') as f:
+                f.write('\n'.join(master) + '\n')
+            
+            if not os.path.exists(source):  # 변환 중 원본이 삭제됨
+                shutil.rmtree(work_dir, ignore_errors=True)
+                return
+            final_dir = os.path.join(self.hls_dir, key)
+            shutil.rmtree(final_dir, ignore_errors=True)
+            os.rename(work_dir, final_dir)
+        except Exception as e:
+            with self.lock:
+                self.failed.add(key)
+            shutil.rmtree(work_dir, ignore_errors=True)
+            self.log(f"⚠️ HLS 변환 실패: {filename} ({str(e)[:100]})")
+            return
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+        
+        with self.lock:
+            self.ready[key] = has_poster
+        self.log(f"🎞️ HLS 변환 완료: {filename} ({', '.join(f'{r[0]}p' for r in renditions)})")
+    
+    def remove(self, filename):
+        """원본 삭제 시 패키지도 삭제"""
+        key = self.package_key(filename)
+        with self.lock:
+            self.ready.pop(key, None)
+            self.failed.discard(key)
+        shutil.rmtree(os.path.join(self.hls_dir, key), ignore_errors=True)
+    
+    def stop(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+# ============================================================================
+# 🎵 temp_audio 캐시 인덱스
+# ============================================================================
+
+class AudioCacheIndex:
+    """video_id → 캐시 파일(경로/크기/수정 시각/길이/코덱) - 시작 시 1회 스캔, 이후 다운로드/삭제 시 갱신"""
+    
+    TAG_FIELDS = ('duration', 'codec', 'bitrate', 'sample_rate')
+    
+    def __init__(self, temp_dir):
+        self.temp_dir = temp_dir
+        self.sidecar_path = os.path.join(temp_dir, AUDIO_CACHE_SIDECAR)
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # 사이드카 쓰기 직렬화 (같은 .tmp 경로를 동시에 쓰지 않도록)
+        self.entries = {}  # video_id: {'path', 'filename', 'size', 'mtime', 'duration', 'codec', 'bitrate', 'sample_rate', 'probed', 'last_played'}
+        self.dirty = False  # 저장 안 된 재생 시각 변경 있음
+        # 📊 캐시 통계
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.scan()
+    
+    @staticmethod
+    def split_name(filename):
+        """'<video_id>.<ext>' → (video_id, ext) - 캐시 파일이 아니면 (None, None)"""
+        video_id, _, ext = filename.rpartition('.')
+        if not video_id or '.' in video_id or ext not in AUDIO_CACHE_EXTENSIONS:
+            return None, None  # '<video_id>.safari.m4a' 같은 변형 파일도 제외
+        return video_id, ext
+    
+    @staticmethod
+    def probe(path):
+        """길이/코덱/비트레이트/샘플레이트 읽기 (mutagen → 실패 시 ffprobe) - 다운로드 완료 시 1회만"""
+        tags = {'duration': 0, 'codec': None, 'bitrate': 0, 'sample_rate': 0}
+        try:
+            from mutagen import File as MutagenFile
+            audio = MutagenFile(path)
+            if audio and audio.info and getattr(audio.info, 'length', 0):
+                tags['duration'] = int(audio.info.length)
+                tags['codec'] = getattr(audio.info, 'codec', None) or type(audio).__name__.lower()
+                tags['bitrate'] = int(getattr(audio.info, 'bitrate', 0) or 0)
+                tags['sample_rate'] = int(getattr(audio.info, 'sample_rate', 0) or 0)
+                return tags
+        except Exception:
+            pass
+        
+        # mutagen이 못 읽는 형식 (webm 등)
+        try:
+            result = subprocess.run(
+                ['ffprobe', '-v', 'error', '-select_streams', 'a:0',
+                 '-show_entries', 'format=duration,bit_rate:stream=codec_name,sample_rate',
+                 '-of', 'json', path],
+                capture_output=True,
+                text=True,
+                timeout=10
+            )
+            data = json.loads(result.stdout or '{}')
+            fmt = data.get('format') or {}
+            stream = (data.get('streams') or [{}])[0]
+            tags['duration'] = int(float(fmt.get('duration') or 0))
+            tags['codec'] = stream.get('codec_name')
+            tags['bitrate'] = int(fmt.get('bit_rate') or 0)
+            tags['sample_rate'] = int(stream.get('sample_rate') or 0)
+        except Exception:
+            pass
+        return tags
+    
+    def make_entry(self, path, stat, tags=None):
+        entry = {
+            'path': path,
+            'filename': os.path.basename(path),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'duration': 0,
+            'codec': None,
+            'bitrate': 0,
+            'sample_rate': 0,
+            'probed': False,
+            'last_played': stat.st_mtime,
+            'variant_size': 0  # 🍎 Safari 변형 파일 크기 (용량 계산용)
+        }
+        if tags:
+            entry.update({field: tags.get(field, entry[field]) for field in self.TAG_FIELDS})
+            entry['probed'] = True
+            entry['last_played'] = tags.get('last_played', entry['last_played'])
+        return entry
+    
+    def load_sidecar(self):
+        try:
+            with open(self.sidecar_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    def save_sidecar(self):
+        """사이드카 저장 (경로 제외 - 파일 이름/크기/수정 시각으로 유효성 확인)"""
+        with self.save_lock:
+            with self.lock:
+                data = {video_id: {key: value for key, value in entry.items() if key != 'path'}
+                        for video_id, entry in self.entries.items()}
+                self.dirty = False
+            try:
+                write_json_atomic(self.sidecar_path, data)
+            except OSError as e:
+                print(f"⚠️ 캐시 인덱스 저장 실패: {e}")
+    
+    def scan(self):
+        """디렉토리 1회 스캔으로 인덱스 재구성 (사이드카의 태그는 파일이 그대로면 재사용)"""
+        os.makedirs(self.temp_dir, exist_ok=True)
+        sidecar = self.load_sidecar()
+        entries = {}
+        variants = {}
+        with os.scandir(self.temp_dir) as it:
+            for dir_entry in it:
+                if dir_entry.name.endswith(SAFARI_AUDIO_SUFFIX):
+                    variants[dir_entry.name[:-len(SAFARI_AUDIO_SUFFIX)]] = dir_entry
+                    continue
+                video_id, ext = self.split_name(dir_entry.name)
+                if not video_id or not dir_entry.is_file():
+                    continue
+                current = entries.get(video_id)
+                if current:
+                    # 같은 video_id의 다른 확장자 파일은 우선순위가 낮은 쪽 삭제 (인덱스/용량 계산 밖에 남지 않도록)
+                    if AUDIO_CACHE_EXTENSIONS.index(current['filename'].rpartition('.')[2]) <= AUDIO_CACHE_EXTENSIONS.index(ext):
+                        shadowed = dir_entry.path
+                    else:
+                        shadowed = current['path']
+                    try:
+                        os.remove(shadowed)
+                    except OSError:
+                        pass
+                    if shadowed == dir_entry.path:
+                        continue
+                stat = dir_entry.stat()
+                saved = sidecar.get(video_id)
+                if not (saved and saved.get('filename') == dir_entry.name
+                        and saved.get('size') == stat.st_size and saved.get('mtime') == stat.st_mtime):
+                    saved = None
+                entries[video_id] = self.make_entry(dir_entry.path, stat, saved)
+        
+        # 🍎 Safari 변형은 원본 항목에 붙이고, 원본이 없으면 삭제
+        for video_id, dir_entry in variants.items():
+            if video_id in entries:
+                entries[video_id]['variant_size'] = dir_entry.stat().st_size
+                continue
+            try:
+                os.remove(dir_entry.path)
+            except OSError:
+                pass
+        
+        with self.lock:
+            self.entries = entries
+        
+        # 태그가 없는 파일(이전 버전에서 받은 파일 등)은 백그라운드에서 1회 분석
+        unprobed = [video_id for video_id, entry in entries.items() if not entry['probed']]
+        if unprobed:
+            threading.Thread(target=self.backfill, args=(unprobed,), daemon=True).start()
+        elif set(sidecar) != set(entries):
+            self.save_sidecar()
+        return len(entries)
+    
+    def backfill(self, video_ids):
+        """태그 없는 항목 분석 후 사이드카 저장"""
+        for video_id in video_ids:
+            self.probe_entry(video_id, save=False)
+        self.save_sidecar()
+    
+    def probe_entry(self, video_id, save=True):
+        """항목의 태그 분석 (이미 있으면 그대로) - 항목 반환"""
+        with self.lock:
+            entry = self.entries.get(video_id)
+            if entry is None or entry['probed']:
+                return dict(entry) if entry else None
+            path = entry['path']
+        
+        tags = self.probe(path)
+        with self.lock:
+            entry = self.entries.get(video_id)
+            if entry is None or entry['path'] != path:
+                return dict(entry) if entry else None
+            entry.update(tags)
+            entry['probed'] = True
+            entry = dict(entry)
+        if save:
+            self.save_sidecar()
+        return entry
+    
+    def get(self, video_id):
+        """캐시 항목 (없으면 None) - 외부에서 지워진 파일이면 인덱스에서도 제거"""
+        with self.lock:
+            entry = self.entries.get(video_id)
+            if entry is None:
+                return None
+            if not os.path.exists(entry['path']):
+                del self.entries[video_id]
+                return None
+            return dict(entry)
+    
+    def add_file(self, path):
+        """다운로드 완료된 파일 등록 + 태그 1회 분석"""
+        video_id, _ = self.split_name(os.path.basename(path))
+        if not video_id:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            previous = self.entries.get(video_id)
+            if previous and previous['path'] == path and previous['size'] == stat.st_size and previous['mtime'] == stat.st_mtime:
+                entry = previous
+            else:
+                entry = self.make_entry(path, stat)
+                self.entries[video_id] = entry
+            probed = entry['probed']
+        if previous and previous['path'] != path:
+            self.remove_siblings(video_id, keep=path)  # 다른 확장자로 다시 받음 - 예전 파일/변형은 더 이상 맞지 않음
+        return dict(entry) if probed else self.probe_entry(video_id)
+    
+    def refresh(self, video_id):
+        """video_id 하나만 다시 확인 (파일 이름을 모를 때)"""
+        for ext in AUDIO_CACHE_EXTENSIONS:
+            entry = self.add_file(os.path.join(self.temp_dir, f"{video_id}.{ext}"))
+            if entry:
+                return entry
+        with self.lock:
+            self.entries.pop(video_id, None)
+        return None
+    
+    def remove(self, video_id, save=True):
+        """캐시 파일 삭제 - 삭제한 항목 반환 (없으면 None)"""
+        with self.lock:
+            entry = self.entries.pop(video_id, None)
+        if entry is None:
+            return None
+        try:
+            os.remove(entry['path'])
+        except FileNotFoundError:
+            entry = None
+        except OSError:
+            with self.lock:
+                self.entries.setdefault(video_id, entry)
+            raise
+        finally:
+            if save:
+                self.save_sidecar()
+            else:
+                with self.lock:
+                    self.dirty = True  # 호출한 쪽에서 한 번에 저장
+        # 🍎 Safari 변형 + 인덱스에 안 잡힌 다른 확장자 파일도 함께 삭제
+        self.remove_siblings(video_id)
+        return entry
+    
+    def remove_siblings(self, video_id, keep=None):
+        """같은 video_id의 다른 확장자 파일 + Safari 변형 삭제 (scan은 우선순위가 높은 파일 하나만 인덱싱)"""
+        names = [f'{video_id}.{ext}' for ext in AUDIO_CACHE_EXTENSIONS] + [video_id + SAFARI_AUDIO_SUFFIX]
+        for name in names:
+            path = os.path.join(self.temp_dir, name)
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    
+    def set_variant(self, video_id, path):
+        """Safari 변형 완성 - 크기 기록"""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self.lock:
+            entry = self.entries.get(video_id)
+            if entry:
+                entry['variant_size'] = size
+                self.dirty = True
+    
+    @staticmethod
+    def entry_size(entry):
+        return entry['size'] + entry.get('variant_size', 0)
+    
+    def record_hit(self, video_id):
+        """캐시 적중 - 최근 재생 시각 갱신 (LRU)"""
+        with self.lock:
+            self.hits += 1
+            entry = self.entries.get(video_id)
+            if entry:
+                entry['last_played'] = time.time()
+                self.dirty = True
+    
+    def record_miss(self):
+        with self.lock:
+            self.misses += 1
+    
+    def total_size(self):
+        with self.lock:
+            return sum(self.entry_size(entry) for entry in self.entries.values())
+    
+    def evict(self, budget_bytes, pinned=()):
+        """용량 초과 시 오래 안 들은 파일부터 삭제 (pinned/최근 재생 제외) - 삭제한 항목 목록 반환"""
+        with self.lock:
+            total = sum(self.entry_size(entry) for entry in self.entries.values())
+            if total <= budget_bytes:
+                return []
+            protect_after = time.time() - AUDIO_CACHE_RECENT_GRACE
+            candidates = sorted(
+                ((entry['last_played'], video_id) for video_id, entry in self.entries.items()
+                 if video_id not in pinned and entry['last_played'] < protect_after)
+            )
+        
+        evicted = []
+        for _, video_id in candidates:
+            if total <= budget_bytes:
+                break
+            try:
+                entry = self.remove(video_id, save=False)
+            except OSError:
+                continue
+            if entry:
+                total -= self.entry_size(entry)
+                evicted.append(dict(entry, video_id=video_id))
+        
+        with self.lock:
+            self.evictions += len(evicted)
+            self.evicted_bytes += sum(self.entry_size(entry) for entry in evicted)
+        if evicted or self.dirty:
+            self.save_sidecar()
+        return evicted
+    
+    def stats(self):
+        """적중/미스/삭제 통계"""
+        with self.lock:
+            return {
+                'files': len(self.entries),
+                'total_bytes': sum(self.entry_size(entry) for entry in self.entries.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'evicted_bytes': self.evicted_bytes
+            }
+
+# ============================================================================
+# 🍎 Safari/iOS용 오디오 변형 (webm/opus → m4a, ffmpeg 스트림 복사)
+# ============================================================================
+
+class SafariRemuxer:
+    """캐시된 webm/opus 옆에 <video_id>.safari.m4a 생성 (재인코딩 없이 컨테이너만 변경, moov 앞쪽)"""
+    
+    def __init__(self, temp_dir, on_complete=None, workers=SAFARI_REMUX_WORKERS, log=print):
+        self.temp_dir = temp_dir
+        self.on_complete = on_complete
+        self.log = log
+        self.available = shutil.which('ffmpeg') is not None
+        # ffmpeg 자체가 별도 프로세스 → 스레드는 대기만 하므로 GIL 경쟁 없음
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='safari-remux')
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.failed = set()  # 변환 불가 (같은 실행 중에는 재시도 안 함)
+        
+        # 🧹 이전 실행에서 중단된 변환 파일 정리
+        for leftover in glob.glob(os.path.join(glob.escape(temp_dir), f"*{SAFARI_AUDIO_SUFFIX}.tmp")):
+            try:
+                os.remove(leftover)
+            except OSError:
+                pass
+    
+    def variant_path(self, video_id):
+        return os.path.join(self.temp_dir, video_id + SAFARI_AUDIO_SUFFIX)
+    
+    def submit(self, video_id, source_path):
+        """변환 예약 (이미 있거나 진행 중이거나 대상이 아니면 False)"""
+        if not self.available or source_path.rpartition('.')[2] not in SAFARI_REMUX_SOURCES:
+            return False
+        if os.path.exists(self.variant_path(video_id)):
+            return False
+        with self.lock:
+            if video_id in self.pending or video_id in self.failed:
+                return False
+            self.pending.add(video_id)
+        try:
+            self.executor.submit(self.remux, video_id, source_path)
+        except RuntimeError:  # 종료 중
+            with self.lock:
+                self.pending.discard(video_id)
+            return False
+        return True
+    
+    def remux(self, video_id, source_path):
+        target = self.variant_path(video_id)
+        temp_path = target + '.tmp'
+        try:
+            result = subprocess.run(
+                ['ffmpeg', '-nostdin', '-v', 'error', '-y', '-i', source_path,
+                 '-map', '0:a:0', '-c', 'copy', '-strict', 'experimental',  # opus in mp4 (구버전 ffmpeg)
+                 '-movflags', '+faststart', '-f', 'mp4', temp_path],
+                capture_output=True, timeout=SAFARI_REMUX_TIMEOUT
+            )
+            if result.returncode != 0 or not os.path.exists(source_path):
+                raise RuntimeError(result.stderr.decode('utf-8', 'replace').strip()[-200:] or '원본 없음')
+            os.replace(temp_path, target)
+        except Exception as e:
+            with self.lock:
+                self.failed.add(video_id)
+            self.log(f"⚠️ Safari 변환 실패: {video_id} ({str(e)[:100]})")
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+        finally:
+            with self.lock:
+                self.pending.discard(video_id)
+        
+        self.log(f"🍎 Safari 변환 완료: {os.path.basename(target)}")
+        if self.on_complete:
+            self.on_complete(video_id, target)
+    
+    def stop(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+# ============================================================================
+# 🔁 오디오 중계 (원본 1회 수신 → 브라우저 전달 + 캐시 저장)
+# ============================================================================
+
+class RelayTrack:
+    """중계 중인 오디오 1곡 (.relay 희소 파일 + 받은 구간 목록, 다 채워지면 최종 파일로 이름 변경)"""
+    
+    def __init__(self, video_id, page_url, fmt, temp_dir, refresh=None, on_complete=None):
+        self.video_id = video_id
+        self.page_url = page_url
+        self.format_id = fmt.get('format_id')
+        self.ext = fmt.get('ext') or 'm4a'
+        self.url = fmt['url']
+        self.http_headers = dict(fmt.get('http_headers') or {})
+        self.total_bytes = fmt.get('filesize') or 0  # 모르면 첫 응답의 Content-Range로 확인
+        self.final_path = os.path.join(temp_dir, f"{video_id}.{self.ext}")
+        self.relay_path = self.final_path + '.relay'
+        self.refresh = refresh  # 원본 URL 만료(403) 시 새 URL 반환
+        self.on_complete = on_complete  # 최종 파일 확정 시 경로 전달 (캐시 인덱스 갱신)
+        self.lock = threading.Lock()
+        self.ranges = []  # 받은 구간 [start, end) - 정렬 + 병합 상태 유지
+        self.fd = os.open(self.relay_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+        self.complete = False
+        self.last_relay_at = 0  # 마지막으로 재생 중계한 시각 (빈 구간 채우기 양보용)
+        self.job = None  # 진행률을 알릴 다운로드 작업
+    
+    @property
+    def mimetype(self):
+        return AUDIO_MIME_TYPES.get(f'.{self.ext}', 'audio/mpeg')
+    
+    def covered_bytes(self):
+        with self.lock:
+            return sum(end - start for start, end in self.ranges)
+    
+    def covered_until(self, offset):
+        """offset부터 연속으로 받아 둔 구간의 끝 (없으면 offset)"""
+        with self.lock:
+            for start, end in self.ranges:
+                if start <= offset < end:
+                    return end
+            return offset
+    
+    def next_covered(self, offset):
+        """offset 이후 처음으로 받아 둔 구간의 시작 (없으면 전체 크기)"""
+        with self.lock:
+            for start, _ in self.ranges:
+                if start > offset:
+                    return start
+            return self.total_bytes
+    
+    def first_gap(self):
+        """아직 안 받은 첫 구간 (start, end) - 없으면 None"""
+        with self.lock:
+            position = 0
+            for start, end in self.ranges:
+                if start > position:
+                    return position, start
+                position = max(position, end)
+            return (position, self.total_bytes) if position < self.total_bytes else None
+    
+    def write(self, offset, data):
+        """받은 바이트 저장 + 구간 병합 (전체가 채워지면 최종 파일로 확정)"""
+        finalized = False
+        with self.lock:
+            if self.complete:
+                return
+            os.pwrite(self.fd, data, offset)
+            
+            ranges = self.ranges + [[offset, offset + len(data)]]
+            ranges.sort()
+            merged = [ranges[0]]
+            for start, end in ranges[1:]:
+                if start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self.ranges = merged
+            
+            if self.total_bytes and merged == [[0, self.total_bytes]]:
+                os.fsync(self.fd)
+                os.close(self.fd)
+                os.replace(self.relay_path, self.final_path)
+                self.complete = True
+                finalized = True
+        
+        if finalized and self.on_complete:
+            self.on_complete(self.final_path)
+        
+        job = self.job
+        if job:
+            job.downloaded_bytes = self.covered_bytes()
+            job.total_bytes = self.total_bytes
+            job.touch()
+    
+    def read(self, offset, size):
+        """받아 둔 구간 읽기 (fd는 확정/삭제 시 잠금 안에서 닫히므로 같은 잠금 안에서 읽음)"""
+        with self.lock:
+            if not self.complete:
+                return os.pread(self.fd, size, offset)
+        # 최종 파일로 확정됨
+        with open(self.final_path, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+    
+    def open_upstream(self, start, end=None):
+        """원본에 Range 요청 (만료된 URL이면 1회 재해석 후 재시도)"""
+        for attempt in range(2):
+            headers = dict(self.http_headers)
+            headers['Range'] = f"bytes={start}-{'' if end is None else end}"
+            response = requests.get(self.url, headers=headers, stream=True, timeout=RELAY_TIMEOUT)
+            if response.status_code in (403, 410) and attempt == 0 and self.refresh:
+                response.close()
+                self.url = self.refresh(self)
+                continue
+            response.raise_for_status()
+            if response.status_code != 206:
+                response.close()
+                raise IOError(f"원본이 Range를 지원하지 않음 (HTTP {response.status_code})")
+            
+            content_range = response.headers.get('Content-Range', '')
+            if '/' in content_range and content_range.rsplit('/', 1)[1].isdigit():
+                self.total_bytes = int(content_range.rsplit('/', 1)[1])
+            return response
+        raise IOError('원본 URL 재해석 실패')
+    
+    def fetch(self, start, end, relaying=False):
+        """원본에서 start~end(포함) 받아 저장하면서 청크 단위로 반환"""
+        response = self.open_upstream(start, end)
+        try:
+            offset = start
+            for chunk in response.iter_content(RELAY_CHUNK_SIZE):
+                if not chunk:
+                    continue
+                chunk = chunk[:end + 1 - offset]
+                self.write(offset, chunk)
+                offset += len(chunk)
+                if relaying:
+                    self.last_relay_at = time.time()
+                yield chunk
+                if offset > end:
+                    break
+        finally:
+            response.close()
+    
+    def ensure_total(self):
+        """전체 크기를 모르면 1바이트 요청으로 확인"""
+        if not self.total_bytes:
+            for _ in self.fetch(0, 0):
+                pass
+        return self.total_bytes
+    
+    def stream(self, start, end):
+        """start~end(포함) 전달 - 받아 둔 구간은 로컬에서, 나머지는 원본에서 받아 저장하며 전달"""
+        position = start
+        while position <= end:
+            local_end = self.covered_until(position)
+            if local_end > position:
+                size = min(local_end, end + 1, position + RELAY_CHUNK_SIZE) - position
+                chunk = self.read(position, size)
+                if not chunk:
+                    break
+                position += len(chunk)
+                yield chunk
+                continue
+            
+            fetch_end = min(end, self.next_covered(position) - 1)
+            received = 0
+            for chunk in self.fetch(position, fetch_end, relaying=True):
+                received += len(chunk)
+                yield chunk
+            if not received:
+                break
+            position += received
+    
+    def fill(self, job):
+        """재생이 멈춘 동안 빈 구간을 채워 최종 파일 완성 (다운로드 작업 함수)"""
+        self.job = job
+        job.total_bytes = self.ensure_total()
+        while not self.complete:
+            job.check_cancelled()
+            # 재생 중계가 진행 중이면 양보 (같은 구간을 두 번 받지 않도록)
+            if time.time() - self.last_relay_at < RELAY_FILL_IDLE:
+                job.cancel_event.wait(1)
+                continue
+            
+            gap = self.first_gap()
+            if not gap:
+                break
+            start, end = gap
+            for _ in self.fetch(start, min(end, start + RELAY_FILL_CHUNK) - 1):
+                job.check_cancelled()
+        return f'/temp_audio/{os.path.basename(self.final_path)}'
+    
+    def discard(self):
+        """미완성 중계 파일 삭제"""
+        with self.lock:
+            if self.complete:
+                return
+            self.complete = True
+            try:
+                os.close(self.fd)
+                os.remove(self.relay_path)
+            except OSError:
+                pass
+
+
+class AudioRelay:
+    """video_id별 중계 상태 관리"""
+    
+    def __init__(self, temp_dir, refresh=None, on_complete=None):
+        self.temp_dir = temp_dir
+        self.refresh = refresh
+        self.on_complete = on_complete
+        self.lock = threading.Lock()
+        self.tracks = {}  # video_id: RelayTrack
+        
+        # 이전 실행에서 남은 미완성 중계 파일 정리 (받은 구간 정보가 없음)
+        os.makedirs(temp_dir, exist_ok=True)
+        for leftover in glob.glob(os.path.join(temp_dir, '*.relay')):
+            try:
+                os.remove(leftover)
+            except OSError:
+                pass
+    
+    def register(self, video_id, page_url, fmt):
+        """중계 등록 - 같은 포맷이 이미 있으면 URL만 갱신 (받은 구간 유지)"""
+        if not fmt.get('url') or fmt.get('protocol', 'https') not in ('http', 'https'):
+            return None  # DASH/HLS 조각 포맷은 중계 불가
+        
+        with self.lock:
+            track = self.tracks.get(video_id)
+            if track and not track.complete and track.format_id == fmt.get('format_id'):
+                track.url = fmt['url']
+                return track
+            if track:
+                track.discard()
+            track = RelayTrack(video_id, page_url, fmt, self.temp_dir, self.refresh, self.on_complete)
+            self.tracks[video_id] = track
+            return track
+    
+    def get(self, video_id):
+        """진행 중인 중계 (완료/폐기된 항목은 정리)"""
+        with self.lock:
+            track = self.tracks.get(video_id)
+            if track and track.complete:
+                del self.tracks[video_id]
+                return None
+            return track
+    
+    def remove(self, video_id):
+        with self.lock:
+            track = self.tracks.pop(video_id, None)
+        if track:
+            track.discard()
+
+# ============================================================================
+# 🎯 로컬 포맷 선택
+# ============================================================================
+
+# yt-dlp 포맷 문자열 중 이 서버가 쓰는 형태: best / bestaudio / bestvideo + [필드 비교] 필터
+FORMAT_SPEC_PATTERN = re.compile(r'^(bestaudio|bestvideo|best)((?:\[[^\]]+\])*)$')
+FORMAT_FILTER_PATTERN = re.compile(r'\[(\w+)\s*(<=|>=|!=|<|>|=)\s*([^\]]+)\]')
+
+def match_format(formats, format_spec):
+    """추출된 formats 목록에서 포맷 문자열(예: bestaudio[ext=m4a]/best)에 맞는 최고 품질 포맷 선택"""
+    for alternative in format_spec.split('/'):
+        spec_match = FORMAT_SPEC_PATTERN.match(alternative.strip())
+        if not spec_match:
+            continue
+        
+        kind, filters = spec_match.groups()
+        conditions = FORMAT_FILTER_PATTERN.findall(filters)
+        
+        candidates = []
+        for fmt in formats:
+            if not fmt.get('url'):
+                continue
+            
+            has_video = fmt.get('vcodec') != 'none'
+            has_audio = fmt.get('acodec') != 'none'
+            if kind == 'bestaudio' and (has_video or not has_audio):
+                continue
+            if kind == 'bestvideo' and (not has_video or has_audio):
+                continue
+            if kind == 'best' and not (has_video and has_audio):
+                continue
+            
+            matched = True
+            for field, op, expected in conditions:
+                value = fmt.get(field)
+                if value is None:
+                    matched = False
+                    break
+                if op in ('=', '!='):
+                    equal = str(value) == expected.strip()
+                    if equal != (op == '='):
+                        matched = False
+                        break
+                else:
+                    try:
+                        value, expected_num = float(value), float(expected)
+                    except (TypeError, ValueError):
+                        matched = False
+                        break
+                    if not {'<=': value <= expected_num, '>=': value >= expected_num,
+                            '<': value < expected_num, '>': value > expected_num}[op]:
+                        matched = False
+                        break
+            
+            if matched:
+                candidates.append(fmt)
+        
+        # yt-dlp의 formats 목록은 낮은 품질 → 높은 품질 순으로 정렬되어 있음
+        if candidates:
+            return candidates[-1]
+    
+    return None
 
 # ============================================================================
 # Flask 서버 설정
@@ -41,7 +2408,8 @@ FORMAT_HISTORY_FILE = 'format_history.json'
 class VideoDownloaderServer:
     """영상 다운로더 Flask 서버 (개선 버전)"""
     
-    def __init__(self, port=7777, gui_log_callback=None):
+    def __init__(self, port=7777, gui_log_callback=None, download_workers=DOWNLOAD_WORKERS,
+                 audio_cache_budget_gb=AUDIO_CACHE_BUDGET_GB, hls_packaging=HLS_PACKAGING_ENABLED):
         self.port = port
         self.app = Flask(__name__)
         self.app.secret_key = 'video-downloader-secret-key-2025'
@@ -55,10 +2423,17 @@ class VideoDownloaderServer:
         
         # 서버 안정성 설정
         self.app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB
-        self.app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0  # 캐시 비활성화
+        self.app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0  # 정적 파일 캐시는 apply_cache_policy에서 결정
+        self.asset_hashes = {}  # 🗄️ 정적 파일 → (수정 시각, 내용 해시)
+        
+        # 🤝 중복 방지: 같은 영상의 추출/다운로드를 동시에 여러 번 하지 않도록 병합
+        self.single_flight = SingleFlight()
+        
+        # 🔗 해석된 스트림 URL 캐시 (prefetch 후 재생 시 재해석 생략)
+        self.stream_url_cache = StreamUrlCache()
         
-        # 다운로드 중복 방지
-        self.downloading_files = set()
+        # 🎯 포맷 학습 이력 (메모리 + 저널, 요청마다 파일을 읽고 쓰지 않음)
+        self.format_history = FormatHistoryStore()
         
         # 접속자 추적
         self.active_sessions = {}  # session_id: {ip, user_agent, device, browser, last_active}
@@ -70,9 +2445,32 @@ class VideoDownloaderServer:
         # GUI 로그 콜백 함수
         self.gui_log_callback = gui_log_callback
         
+        # 📥 백그라운드 다운로드 스케줄러 (동시 다운로드 수 제한 + 우선순위)
+        self.download_scheduler = DownloadScheduler(download_workers, log=self.log)
+        
+        # 🎵 temp_audio 캐시 인덱스 (시작 시 1회 스캔, 요청마다 파일 존재 확인 안 함)
+        self.audio_cache = AudioCacheIndex(os.path.join(os.path.dirname(__file__), 'temp_audio'))
+        
+        # 🍎 Safari/iOS용 m4a 변형 (webm/opus 캐시를 백그라운드에서 스트림 복사)
+        self.safari_remuxer = SafariRemuxer(os.path.join(os.path.dirname(__file__), 'temp_audio'),
+                                            on_complete=self.audio_cache.set_variant, log=self.log)
+        
+        # 💾 캐시 용량 관리 (오래 안 들은 파일부터 백그라운드 삭제, 즐겨찾기/공유/접속 중 재생 목록은 보호)
+        self.audio_cache_budget = int(audio_cache_budget_gb * 1024 ** 3)
+        self.cache_maintenance_event = threading.Event()
+        self.cache_maintenance_stopped = False
+        self.last_pinned_count = 0
+        
+        # 🔁 오디오 중계 (원본을 한 번만 받아 브라우저 전달 + temp_audio 저장)
+        self.audio_relay = AudioRelay(os.path.join(os.path.dirname(__file__), 'temp_audio'),
+                                      refresh=self.refresh_relay_url,
+                                      on_complete=self.register_cached_audio)
+        
         # 👥 사용자 관리
         self.USERS_FILE = os.path.join(os.path.dirname(__file__), 'users.json')
         self.BLOCKED_IPS_FILE = os.path.join(os.path.dirname(__file__), 'blocked_ips.json')
+        self.users = CachedJsonFile(self.USERS_FILE, {})
+        self.blocked_ips = CachedJsonFile(self.BLOCKED_IPS_FILE, [])
         self.init_users_db()
         self.init_blocked_ips()
         
@@ -80,6 +2478,27 @@ class VideoDownloaderServer:
         self.VIDEOS_DIR = os.path.join(os.path.dirname(__file__), 'static', 'videos')
         os.makedirs(self.VIDEOS_DIR, exist_ok=True)
         
+        # 🗃️ 사용자 라이브러리 DB (기존 사용자별 JSON 파일은 처음 1회 가져옴)
+        self.library = LibraryStore(os.path.join(os.path.dirname(__file__), LIBRARY_DB_FILE))
+        self.migrate_json_library()
+        
+        # 📦 공용 영상 저장소 (같은 영상 재다운로드는 메타데이터만 추가, 마지막 참조 삭제 시 파일 삭제)
+        self.video_blobs = VideoBlobStore(self.VIDEOS_DIR)
+        self.video_blobs.rebuild(self.iter_user_metadata())
+        
+        # 🗂️ 영상 파일명 인덱스 (serve_video가 요청마다 glob/listdir 하지 않도록)
+        self.video_files = VideoFileIndex(self.VIDEOS_DIR)
+        
+        # 🎞️ 갤러리 영상 HLS 패키징 (켜져 있으면 받아 둔 영상도 백그라운드에서 변환, 있으면 갤러리/모달 재생에 사용)
+        self.hls_packager = HlsPackager(self.VIDEOS_DIR, enabled=hls_packaging, log=self.log)
+        if hls_packaging:
+            self.queue_hls_packaging()
+        
+        # 📚 video_id 카탈로그 (캐시 재생 시 재생 목록/메타데이터 검색, 네트워크 조회 생략)
+        self.media_catalog = MediaCatalog(os.path.join(os.path.dirname(__file__), MEDIA_CATALOG_FILE))
+        if not self.media_catalog.loaded_from_file:
+            threading.Thread(target=self.seed_media_catalog, daemon=True).start()
+        
         # 템플릿 디렉토리 확인/생성
         templates_dir = os.path.join(os.path.dirname(__file__), 'templates')
         os.makedirs(templates_dir, exist_ok=True)
@@ -89,6 +2508,9 @@ class VideoDownloaderServer:
         
         # 라우트 설정
         self.setup_routes()
+        
+        # 💾 캐시 용량 점검 스레드
+        threading.Thread(target=self.cache_maintenance_loop, daemon=True).start()
     
     def create_templates(self):
         """HTML 템플릿 자동 생성 - 사용하지 않음 (외부 파일 사용)"""
@@ -189,8 +2611,8 @@ class VideoDownloaderServer:
                     'created_at': datetime.now().isoformat()
                 }
             }
-            with open(self.USERS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(users_data, f, ensure_ascii=False, indent=2)
+            with self.users.edit() as users:
+                users.update(users_data)
     
     def get_user_dir(self, username):
         """사용자별 디렉토리 경로 반환"""
@@ -198,34 +2620,20 @@ class VideoDownloaderServer:
         os.makedirs(user_dir, exist_ok=True)
         return user_dir
     
-    def get_user_metadata_file(self, username):
-        """사용자별 metadata.json 경로"""
-        return os.path.join(self.get_user_dir(username), 'metadata.json')
-    
-    def get_user_playlist_file(self, username):
-        """사용자별 playlist.json 경로"""
-        return os.path.join(self.get_user_dir(username), 'playlist.json')
-    
-    def get_user_favorites_file(self, username):
-        """사용자별 즐겨찾기 파일 경로"""
-        return os.path.join(self.get_user_dir(username), 'favorites.json')
-    
     def register_user(self, username, password):
         """회원가입"""
         try:
-            with open(self.USERS_FILE, 'r', encoding='utf-8') as f:
-                users = json.load(f)
-            
-            if username in users:
-                return False, "이미 존재하는 아이디입니다"
-            
-            users[username] = {
-                'password': password,
-                'created_at': datetime.now().isoformat()
-            }
-            
-            with open(self.USERS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(users, f, ensure_ascii=False, indent=2)
+            with self.users.edit() as users:
+                if username in users:
+                    return False, "이미 존재하는 아이디입니다"
+                
+                if username in (VIDEO_BLOBS_DIR, HLS_DIRNAME):
+                    return False, "사용할 수 없는 아이디입니다"
+                
+                users[username] = {
+                    'password': password,
+                    'created_at': datetime.now().isoformat()
+                }
             
             # 사용자 디렉토리 생성
             self.get_user_dir(username)
@@ -237,8 +2645,7 @@ class VideoDownloaderServer:
     def verify_user(self, username, password):
         """로그인 검증"""
         try:
-            with open(self.USERS_FILE, 'r', encoding='utf-8') as f:
-                users = json.load(f)
+            users = self.users.load()
             
             if username not in users:
                 return False
@@ -250,15 +2657,12 @@ class VideoDownloaderServer:
     def init_blocked_ips(self):
         """차단된 IP 데이터베이스 초기화"""
         if not os.path.exists(self.BLOCKED_IPS_FILE):
-            with open(self.BLOCKED_IPS_FILE, 'w', encoding='utf-8') as f:
-                json.dump([], f)
+            write_json_atomic(self.BLOCKED_IPS_FILE, [])
     
     def is_ip_blocked(self, ip):
         """IP 차단 여부 확인"""
         try:
-            with open(self.BLOCKED_IPS_FILE, 'r', encoding='utf-8') as f:
-                blocked_ips = json.load(f)
-            return ip in blocked_ips
+            return ip in self.blocked_ips.load()
         except:
             return False
     
@@ -276,22 +2680,13 @@ class VideoDownloaderServer:
                 return False, "사용자의 IP를 찾을 수 없습니다"
             
             # IP 차단 목록에 추가
-            with open(self.BLOCKED_IPS_FILE, 'r', encoding='utf-8') as f:
-                blocked_ips = json.load(f)
-            
-            if user_ip not in blocked_ips:
-                blocked_ips.append(user_ip)
-                with open(self.BLOCKED_IPS_FILE, 'w', encoding='utf-8') as f:
-                    json.dump(blocked_ips, f, indent=2)
+            with self.blocked_ips.edit() as blocked_ips:
+                if user_ip not in blocked_ips:
+                    blocked_ips.append(user_ip)
             
             # 사용자 계정 삭제
-            with open(self.USERS_FILE, 'r', encoding='utf-8') as f:
-                users = json.load(f)
-            
-            if username in users:
-                del users[username]
-                with open(self.USERS_FILE, 'w', encoding='utf-8') as f:
-                    json.dump(users, f, ensure_ascii=False, indent=2)
+            with self.users.edit() as users:
+                users.pop(username, None)
             
             return True, f"{username} 차단 완료 (IP: {user_ip})"
         except Exception as e:
@@ -300,8 +2695,7 @@ class VideoDownloaderServer:
     def get_all_users(self):
         """모든 사용자 목록 반환"""
         try:
-            with open(self.USERS_FILE, 'r', encoding='utf-8') as f:
-                users = json.load(f)
+            users = self.users.get()
             
             # 각 사용자의 활동 정보 추가
             user_list = []
@@ -329,16 +2723,11 @@ class VideoDownloaderServer:
     def change_user_password(self, username, new_password):
         """사용자 비밀번호 강제 변경 (admin 포함)"""
         try:
-            with open(self.USERS_FILE, 'r', encoding='utf-8') as f:
-                users = json.load(f)
-            
-            if username not in users:
-                return False, "사용자를 찾을 수 없습니다"
-            
-            users[username]['password'] = new_password
-            
-            with open(self.USERS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(users, f, ensure_ascii=False, indent=2)
+            with self.users.edit() as users:
+                if username not in users:
+                    return False, "사용자를 찾을 수 없습니다"
+                
+                users[username]['password'] = new_password
             
             return True, f"{username}의 비밀번호가 변경되었습니다"
         except Exception as e:
@@ -361,83 +2750,73 @@ class VideoDownloaderServer:
         """컨텐츠 공유 (음원/영상)"""
         try:
             self.log(f"🔍 공유 시작: content_type={content_type}, video_id={video_id}")
+            self.media_catalog.update(video_id, title=title, thumbnail=thumbnail, duration=duration,
+                                      video_file=filename if content_type == 'video' else None)
             
             shared_count = 0
             for to_username in to_usernames:
                 if to_username == from_username:
                     continue  # 자신에게는 공유 안 함
                 
-                if content_type == 'audio':
-                    # 🎵 음원 공유: 재생 목록에만 추가
-                    self.log(f"🎵 음원 모드 - 재생 목록에만 추가 시작")
-                    playlist = self.load_playlist(to_username)
-                    
-                    # 이미 있는지 확인
-                    already_exists = False
-                    for item in playlist:
-                        if item.get('video_id') == video_id:
-                            already_exists = True
-                            break
-                    
-                    if not already_exists:
-                        playlist.append({
-                            'url': f'https://www.youtube.com/watch?v={video_id}',
-                            'title': title,
-                            'thumbnail': thumbnail,
-                            'duration': duration,
-                            'video_id': video_id,
-                            'added_at': datetime.now().isoformat(),
-                            'shared_from': from_username
-                        })
-                        self.save_playlist(playlist, to_username)
-                        self.log(f"✅ 🎵 음원 공유 완료 - 재생 목록에만 추가됨: {to_username} - {title}")
-                    else:
-                        self.log(f"⚠️ 이미 재생 목록에 있음: {to_username} - {title}")
-                    
-                    # 갤러리에는 절대 추가 안 함!
-                    self.log(f"✅ 갤러리 건너뜀 (음원 모드)")
-                    
-                elif content_type == 'video':
-                    # 📹 영상 공유: 갤러리에만 추가 (실제 파일명 사용)
-                    self.log(f"📹 영상 모드 - 갤러리에만 추가 시작")
-                    metadata = self.load_metadata(to_username)
-                    
-                    # metadata가 list인지 확인하고 추가
-                    if not isinstance(metadata, list):
-                        metadata = []
-                    
-                    # 이미 있는지 확인
-                    already_in_gallery = False
-                    for item in metadata:
-                        if isinstance(item, dict) and item.get('video_id') == video_id:
-                            already_in_gallery = True
-                            break
+                with self.library.user_lock(to_username):  # 확인 후 추가 사이에 끼어들지 않도록
+                    if content_type == 'audio':
+                        # 🎵 음원 공유: 재생 목록에만 추가
+                        self.log(f"🎵 음원 모드 - 재생 목록에만 추가 시작")
+                        # 이미 있는지 확인 (🗃️ 인덱스 조회)
+                        already_exists = self.library.exists('playlist', to_username, video_id=video_id)
+                        
+                        if not already_exists:
+                            self.library.insert('playlist', to_username, {
+                                'url': f'https://www.youtube.com/watch?v={video_id}',
+                                'title': title,
+                                'thumbnail': thumbnail,
+                                'duration': duration,
+                                'video_id': video_id,
+                                'added_at': datetime.now().isoformat(),
+                                'shared_from': from_username
+                            }, front=False)
+                            self.log(f"✅ 🎵 음원 공유 완료 - 재생 목록에만 추가됨: {to_username} - {title}")
+                        else:
+                            self.log(f"⚠️ 이미 재생 목록에 있음: {to_username} - {title}")
+                        
+                        # 갤러리에는 절대 추가 안 함!
+                        self.log(f"✅ 갤러리 건너뜀 (음원 모드)")
+                        
+                    elif content_type == 'video':
+                        # 📹 영상 공유: 갤러리에만 추가 (실제 파일명 사용)
+                        self.log(f"📹 영상 모드 - 갤러리에만 추가 시작")
+                        # 이미 있는지 확인 (🗃️ 인덱스 조회, 갤러리 항목만)
+                        already_in_gallery = self.library.exists('metadata', to_username, video_id=video_id, kind='video')
+                        
+                        if not already_in_gallery:
+                            # 갤러리에 추가 (실제 파일명 사용 - 공유자의 파일 직접 재생)
+                            shared_filename = (filename
+                                               or self.video_blobs.find(VideoBlobStore.blob_key('youtube', video_id))
+                                               or f'{video_id}_shared.mp4')
+                            self.library.insert('metadata', to_username, {
+                                'filename': shared_filename,  # 실제 파일명 사용!
+                                'title': title,
+                                'url': f'https://www.youtube.com/watch?v={video_id}',
+                                'platform': 'youtube',
+                                'thumbnail': thumbnail,
+                                'duration': duration,
+                                'video_id': video_id,
+                                'downloaded_at': datetime.now().isoformat(),
+                                'shared_from': from_username,
+                                'is_shared': True  # 공유받은 영상 표시
+                            })
+                            # 📦 받은 사용자도 참조 → 공유자가 지워도 파일 유지
+                            self.video_blobs.add_ref(shared_filename, to_username)
+                            self.log(f"✅ 📹 영상 공유 완료 - 갤러리에만 추가됨: {to_username} - {title} (파일: {shared_filename})")
+                        else:
+                            self.log(f"⚠️ 이미 갤러리에 있음: {to_username} - {title}")
+                        
+                        # 재생 목록에는 절대 추가 안 함!
+                        self.log(f"✅ 재생 목록 건너뜀 (영상 모드)")
                     
-                    if not already_in_gallery:
-                        # 갤러리에 추가 (실제 파일명 사용 - 공유자의 파일 직접 재생)
-                        metadata.insert(0, {
-                            'filename': filename or f'{video_id}_shared.mp4',  # 실제 파일명 사용!
-                            'title': title,
-                            'url': f'https://www.youtube.com/watch?v={video_id}',
-                            'platform': 'youtube',
-                            'thumbnail': thumbnail,
-                            'duration': duration,
-                            'video_id': video_id,
-                            'downloaded_at': datetime.now().isoformat(),
-                            'shared_from': from_username,
-                            'is_shared': True  # 공유받은 영상 표시
-                        })
-                        self.save_metadata(metadata, to_username)
-                        self.log(f"✅ 📹 영상 공유 완료 - 갤러리에만 추가됨: {to_username} - {title} (파일: {filename})")
                     else:
-                        self.log(f"⚠️ 이미 갤러리에 있음: {to_username} - {title}")
+                        self.log(f"❌ 알 수 없는 content_type: {content_type}")
                     
-                    # 재생 목록에는 절대 추가 안 함!
-                    self.log(f"✅ 재생 목록 건너뜀 (영상 모드)")
-                
-                else:
-                    self.log(f"❌ 알 수 없는 content_type: {content_type}")
-                
                 shared_count += 1
             
             content_name = '음원' if content_type == 'audio' else '영상'
@@ -500,69 +2879,25 @@ class VideoDownloaderServer:
     # ========================================================================
     
     def load_format_history(self):
-        """포맷 이력 로드"""
-        try:
-            if os.path.exists(FORMAT_HISTORY_FILE):
-                with open(FORMAT_HISTORY_FILE, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-        except Exception as e:
-            print(f"⚠️ 포맷 이력 로드 실패: {e}")
-        return {}
+        """포맷 이력 로드 (메모리 복사본 - 디스크 읽기 없음)"""
+        return self.format_history.snapshot()
     
     def save_format_history(self, history):
-        """포맷 이력 저장"""
-        try:
-            with open(FORMAT_HISTORY_FILE, 'w', encoding='utf-8') as f:
-                json.dump(history, f, indent=2, ensure_ascii=False)
-        except Exception as e:
-            print(f"⚠️ 포맷 이력 저장 실패: {e}")
+        """포맷 이력 저장 (전체 교체)"""
+        self.format_history.replace(history)
     
     def record_format_success(self, video_id, format_string, is_mobile=False):
         """포맷 성공 기록"""
-        history = self.load_format_history()
-        
-        if video_id not in history:
-            history[video_id] = {
-                'success_format': None,
-                'failed_formats': [],
-                'last_updated': None,
-                'success_count': 0,
-                'device': 'mobile' if is_mobile else 'desktop'
-            }
-        
-        history[video_id]['success_format'] = format_string
-        history[video_id]['success_count'] = history[video_id].get('success_count', 0) + 1
-        history[video_id]['last_updated'] = datetime.now().isoformat()
-        history[video_id]['device'] = 'mobile' if is_mobile else 'desktop'
-        
-        # 성공하면 failed_formats에서 제거
-        if format_string in history[video_id].get('failed_formats', []):
-            history[video_id]['failed_formats'].remove(format_string)
-        
-        self.save_format_history(history)
-        print(f"✅ 포맷 학습: {video_id} → {format_string} (성공 {history[video_id]['success_count']}회)")
+        entry = self.format_history.record('success', video_id, format_string, 'mobile' if is_mobile else 'desktop')
+        print(f"✅ 포맷 학습: {video_id} → {format_string} (성공 {entry['success_count']}회)")
     
-    def record_format_failure(self, video_id, format_string):
+    def record_format_failure(self, video_id, format_string, is_mobile=False):
         """포맷 실패 기록"""
-        history = self.load_format_history()
-        
-        if video_id not in history:
-            history[video_id] = {
-                'success_format': None,
-                'failed_formats': [],
-                'last_updated': None,
-                'success_count': 0
-            }
-        
-        if format_string not in history[video_id]['failed_formats']:
-            history[video_id]['failed_formats'].append(format_string)
-        
-        self.save_format_history(history)
+        self.format_history.record('failure', video_id, format_string, 'mobile' if is_mobile else 'desktop')
         print(f"❌ 포맷 실패 기록: {video_id} → {format_string}")
     
     def get_optimized_formats(self, video_id, is_mobile=False):
         """학습된 최적의 포맷 순서 반환"""
-        history = self.load_format_history()
         
         # 기본 포맷 순서
         if is_mobile:
@@ -582,9 +2917,16 @@ class VideoDownloaderServer:
                 'bestaudio/best'
             ]
         
+        # 🌐 전체 통계로 기본 순서 정렬 (처음 보는 영상도 성공 확률 높은 포맷부터)
+        device = 'mobile' if is_mobile else 'desktop'
+        ranked_formats = self.format_history.rank_formats(default_formats, device, 'audio')
+        if ranked_formats != default_formats:
+            print(f"🌐 전체 통계 기반 포맷 순서 ({device}): {ranked_formats[0]} 우선")
+        default_formats = ranked_formats
+        
         # 해당 video_id의 이력이 있으면 최적화
-        if video_id in history:
-            info = history[video_id]
+        info = self.format_history.get(video_id)
+        if info:
             success_format = info.get('success_format')
             failed_formats = info.get('failed_formats', [])
             
@@ -606,6 +2948,373 @@ class VideoDownloaderServer:
         
         return default_formats
     
+    def extract_media_info(self, url, content='audio'):
+        """전체 포맷 목록을 한 번만 추출 (포맷 선택은 select_format에서 로컬로)"""
+        info_opts = {
+            # 추출 자체가 실패하지 않도록 느슨한 포맷 지정 (실제 선택은 로컬)
+            'format': 'bestaudio/best' if content == 'audio' else 'best/bestvideo+bestaudio',
+            'quiet': True,
+            'no_warnings': True,
+            'extract_flat': False,
+            'socket_timeout': 10,  # 10초 타임아웃
+            'nocheckcertificate': True,  # SSL 인증서 체크 생략 (빠름)
+            'no_check_certificate': True,
+            'prefer_insecure': False,
+            'http_chunk_size': 10485760,  # 10MB 청크
+            'youtube_include_dash_manifest': False,  # DASH manifest 생략 (빠름!)
+            'youtube_include_hls_manifest': False,   # HLS manifest 생략 (빠름!)
+            'skip_unavailable_fragments': True,      # 없는 조각 건너뛰기
+        }
+        with yt_dlp.YoutubeDL(info_opts) as ydl:
+            return ydl.extract_info(url, download=False)
+    
+    def select_format(self, info, format_options, history_id=None, is_mobile=False):
+        """학습된 순서대로 후보를 확인해 첫 번째로 맞는 포맷 선택 (네트워크 요청 없음)"""
+        formats = info.get('formats') or [info]
+        
+        for i, format_str in enumerate(format_options):
+            chosen = match_format(formats, format_str)
+            if chosen:
+                # 🎯 성공한 포맷 기록
+                if history_id:
+                    self.record_format_success(history_id, format_str, is_mobile)
+                return format_str, chosen
+            
+            print(f"❌ 포맷 없음 {i+1}/{len(format_options)}: {format_str}")
+            # 🎯 실패한 포맷 기록
+            if history_id:
+                self.record_format_failure(history_id, format_str, is_mobile)
+        
+        return None, None
+    
+    def register_cached_audio(self, path):
+        """다운로드 완료된 오디오를 캐시 인덱스 + 카탈로그에 등록"""
+        entry = self.audio_cache.add_file(path)
+        if entry:
+            video_id, _ = AudioCacheIndex.split_name(entry['filename'])
+            self.media_catalog.update(video_id, audio_file=entry['filename'], duration=entry['duration'])
+            self.safari_remuxer.submit(video_id, entry['path'])  # 🍎 Safari용 변형 준비
+            self.cache_maintenance_event.set()  # 💾 용량 점검
+        return entry
+    
+    def is_webkit_client(self, user_agent):
+        """Safari 또는 iOS 브라우저 (iOS는 모든 브라우저가 WebKit)"""
+        client = self.parse_user_agent(user_agent)
+        return client['browser'] == '🌐 Safari' or client['device'] in ('📱 iPhone', '📱 iPad')
+    
+    def item_video_id(self, item):
+        """재생 목록/즐겨찾기 항목의 video_id (없으면 URL에서 추출)"""
+        return item.get('video_id') or extract_video_id(item.get('url'))
+    
+    def collect_pinned_audio(self):
+        """삭제하면 안 되는 캐시: 즐겨찾기, 접속 중인 사용자의 재생 목록, 다른 사용자에게 공유된 음원"""
+        active_users = {info.get('username') for info in list(self.active_sessions.values())}
+        pinned = set()
+        for username in self.library.usernames():
+            for item in self.load_favorites(username):
+                if isinstance(item, dict):
+                    pinned.add(self.item_video_id(item))
+            for item in self.load_playlist(username):
+                if isinstance(item, dict) and (username in active_users or item.get('shared_from')):
+                    pinned.add(self.item_video_id(item))
+        pinned.discard(None)
+        return pinned
+    
+    def run_cache_eviction(self):
+        """용량 초과분 삭제 (오래 안 들은 순)"""
+        if self.audio_cache.total_size() <= self.audio_cache_budget:
+            if self.audio_cache.dirty:
+                self.audio_cache.save_sidecar()
+            return []
+        
+        pinned = self.collect_pinned_audio()
+        self.last_pinned_count = len(pinned)
+        evicted = self.audio_cache.evict(self.audio_cache_budget, pinned)
+        for entry in evicted:
+            self.media_catalog.discard_field(entry['video_id'], 'audio_file')
+        if evicted:
+            freed_mb = sum(entry['size'] for entry in evicted) / (1024 * 1024)
+            self.log(f"💾 캐시 정리: {len(evicted)}개 파일 삭제 ({freed_mb:.1f}MB, 보호 {len(pinned)}개)")
+        if self.audio_cache.total_size() > self.audio_cache_budget:
+            self.log(f"⚠️ 보호된 파일만으로 캐시 용량 초과 ({self.audio_cache.total_size()/1024**3:.1f}GB)")
+        return evicted
+    
+    def cache_maintenance_loop(self):
+        """주기적으로 + 다운로드 완료 시 캐시 용량 점검"""
+        while not self.cache_maintenance_stopped:
+            self.cache_maintenance_event.wait(AUDIO_CACHE_EVICT_INTERVAL)
+            self.cache_maintenance_event.clear()
+            if self.cache_maintenance_stopped:
+                break
+            try:
+                self.run_cache_eviction()
+            except Exception as e:
+                self.log(f"⚠️ 캐시 정리 실패: {e}")
+    
+    def set_audio_cache_budget(self, budget_gb):
+        """캐시 용량 변경 (즉시 점검)"""
+        self.audio_cache_budget = int(budget_gb * 1024 ** 3)
+        self.cache_maintenance_event.set()
+    
+    def set_hls_packaging(self, enabled):
+        """HLS 패키징 켜기/끄기 (켜면 받아 둔 영상 변환 예약, 끄면 새 예약만 중단)"""
+        self.hls_packager.enabled = enabled
+        if enabled:
+            self.queue_hls_packaging()
+    
+    def queue_hls_packaging(self):
+        """받아 둔 갤러리 영상 중 패키지가 없는 것 변환 예약 (영상 요청 경로에서는 예약하지 않음)"""
+        if not self.hls_packager.available:
+            return 0
+        with self.video_files.lock:
+            names = [name for name in self.video_files.names if name.endswith(VIDEO_BLOB_EXTENSIONS)]
+        queued = sum(1 for name in names if self.hls_packager.submit(name))
+        if queued:
+            self.log(f"🎞️ HLS 변환 예약: {queued}개")
+        return queued
+    
+    def cache_stats(self):
+        """캐시 통계 (API/GUI)"""
+        return dict(self.audio_cache.stats(), budget_bytes=self.audio_cache_budget, pinned=self.last_pinned_count)
+    
+    def iter_user_metadata(self):
+        """(사용자, 메타데이터) - 라이브러리의 모든 사용자"""
+        for username in self.library.usernames():
+            yield username, self.load_metadata(username)
+    
+    def migrate_json_library(self):
+        """static/videos/<사용자>/*.json → library.db (1회, 원본은 .migrated로 이름만 바꿔 보관)"""
+        sources = {'metadata': 'metadata.json', 'playlist': 'playlist.json', 'favorites': 'favorites.json'}
+        try:
+            user_dirs = [entry for entry in os.scandir(self.VIDEOS_DIR)
+                         if entry.is_dir() and entry.name not in (VIDEO_BLOBS_DIR, HLS_DIRNAME)]
+        except OSError:
+            return
+        
+        migrated = 0
+        for entry in user_dirs:
+            for collection, name in sources.items():
+                path = os.path.join(entry.path, name)
+                if not os.path.exists(path) or self.library.is_migrated(entry.name, name):
+                    continue
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                except (OSError, ValueError) as e:
+                    self.log(f"⚠️ 라이브러리 가져오기 실패 (파일 유지): {path} - {e}")
+                    continue
+                migrated += self.library.import_json(collection, entry.name, data, name)
+                os.replace(path, path + '.migrated')
+        
+        if migrated:
+            self.log(f"🗃️ 기존 JSON 라이브러리 가져오기 완료: {migrated}개 항목 → {LIBRARY_DB_FILE}")
+    
+    def seed_media_catalog(self):
+        """카탈로그 최초 생성 - 모든 사용자의 재생 목록/갤러리/즐겨찾기에서 1회 수집"""
+        count = 0
+        for username in self.library.usernames():
+            for collection in ('playlist', 'metadata', 'favorites'):
+                for _, item in self.library.load(collection, username):
+                    video_id = self.item_video_id(item)
+                    if not video_id:
+                        continue
+                    video_file = item.get('filename') if not item.get('is_shared') else None
+                    self.media_catalog.update(video_id, title=item.get('title'), thumbnail=item.get('thumbnail'),
+                                              duration=item.get('duration'), video_file=video_file)
+                    count += 1
+        
+        for video_id, entry in list(self.audio_cache.entries.items()):
+            self.media_catalog.update(video_id, audio_file=entry['filename'])
+        
+        self.media_catalog.flush()
+        self.log(f"📚 미디어 카탈로그 생성: {len(self.media_catalog.entries)}개 (항목 {count}개 수집)")
+    
+    def refresh_relay_url(self, track):
+        """중계 중 원본 URL 만료(403) - 같은 포맷의 새 URL 재해석"""
+        self.log(f"🔄 중계 원본 URL 만료 - 재해석: {track.video_id}")
+        self.stream_url_cache.invalidate(track.video_id)
+        info = self.single_flight.do(('extract', track.video_id, 'audio'), self.extract_media_info, track.page_url, 'audio')
+        for fmt in info.get('formats') or [info]:
+            if fmt.get('format_id') == track.format_id and fmt.get('url'):
+                return fmt['url']
+        raise IOError(f"포맷 {track.format_id}을 다시 찾을 수 없음")
+    
+    def serve_partial_audio(self, file_path):
+        """다운로드 중인 오디오를 .part 파일에서 서빙 (받은 구간은 바로, 안 받은 구간은 잠시 대기 후 원본으로)
+        - 전체 크기가 정확할 때만 (추정치로 Content-Length/Content-Range를 보내면 재생이 끊김)"""
+        video_id = os.path.splitext(os.path.basename(file_path))[0]
+        job = self.download_scheduler.find(video_id)
+        if (not job or job.state != 'running' or not job.filename or not job.tmpfilename
+                or not job.total_bytes_exact or os.path.abspath(job.filename) != os.path.abspath(file_path)):
+            return None
+        
+        total = job.total_bytes
+        mimetype = AUDIO_MIME_TYPES.get(os.path.splitext(file_path)[1].lower(), 'audio/mpeg')
+        
+        byte_range = single_byte_range(request.headers.get('Range'), total)
+        if byte_range is None:
+            response = Response(status=416)
+            response.headers['Content-Range'] = f'bytes */{total}'
+            return response
+        start, end, status = byte_range
+        
+        def written_bytes():
+            try:
+                return os.path.getsize(job.tmpfilename)
+            except OSError:
+                return 0
+        
+        # 아직 안 받은 구간이면 잠시 대기
+        deadline = time.time() + PARTIAL_AUDIO_WAIT
+        while written_bytes() <= start and job.state == 'running' and time.time() < deadline:
+            job.wait_for_update(job.version, timeout=max(0, deadline - time.time()))
+        
+        try:
+            f = open(job.tmpfilename, 'rb')
+        except OSError:
+            f = None  # 방금 다운로드 완료 (.part → 최종 파일로 이름 변경)
+        
+        if f is None or written_bytes() <= start:
+            if f:
+                f.close()
+            if os.path.exists(file_path):
+                return None  # 완료된 파일로 일반 서빙
+            if job.source_url:
+                self.log(f"↪️ 아직 안 받은 구간 → 원본 리다이렉트: {video_id} ({start}/{total})")
+                response = redirect(job.source_url, 302)
+            else:
+                response = Response(status=503)
+                response.headers['Retry-After'] = '1'
+            response.headers['Cache-Control'] = 'no-store'
+            return response
+        
+        length = end - start + 1
+        if start == 0:
+            self.log(f"🎵 다운로드 중 파일 스트리밍: {video_id} ({written_bytes()/1024/1024:.1f}/{total/1024/1024:.1f}MB)")
+        
+        def generate():
+            # 받는 속도를 따라가며 읽기 (tail-follow)
+            with f:
+                f.seek(start)
+                remaining = length
+                chunk_size = 256 * 1024  # 256KB 청크
+                while remaining > 0:
+                    chunk = f.read(min(chunk_size, remaining))
+                    if chunk:
+                        remaining -= len(chunk)
+                        yield chunk
+                        continue
+                    if job.state != 'running':
+                        break
+                    version = job.version
+                    if job.wait_for_update(version, timeout=PARTIAL_AUDIO_STALL) == version:
+                        break  # 다운로드 멈춤 - 클라이언트가 다시 요청하도록 종료
+        
+        response = Response(generate(), status, mimetype=mimetype, direct_passthrough=True)
+        response.headers['Content-Length'] = str(length)
+        response.headers['Accept-Ranges'] = 'bytes'
+        if status == 206:
+            response.headers['Content-Range'] = f'bytes {start}-{end}/{total}'
+        response.headers['Cache-Control'] = 'no-store'  # 받는 중인 파일은 캐시 금지
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Access-Control-Expose-Headers'] = 'Content-Length, Content-Range'
+        return response
+    
+    def asset_hash(self, filename):
+        """정적 파일(js/css) 내용 해시 - 수정 시각이 바뀔 때만 다시 계산 (대상이 아니면 None)"""
+        if not filename.endswith(STATIC_ASSET_EXTENSIONS):
+            return None
+        path = os.path.join(self.app.static_folder, filename)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        cached = self.asset_hashes.get(filename)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()[:12]
+        self.asset_hashes[filename] = (mtime, digest)
+        return digest
+    
+    def asset_url(self, filename):
+        """템플릿용 정적 파일 URL (?v=<내용 해시> → 내용이 바뀌면 URL도 바뀜)"""
+        return url_for('static', filename=filename, v=self.asset_hash(filename))
+    
+    def send_media_file(self, file_path, mimetype, log_label=None):
+        """미디어 파일 응답 - ETag/Last-Modified 조건부 요청(304), Range(접미사/다중 구간/If-Range/416), 본문은 sendfile"""
+        stat = os.stat(file_path)
+        file_size = stat.st_size
+        etag = f'"{file_size:x}-{stat.st_mtime_ns:x}"'  # 강한 ETag (크기 + 수정 시각)
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
+        
+        def finish(response):
+            response.headers['ETag'] = etag
+            response.headers['Last-Modified'] = last_modified
+            response.headers['Accept-Ranges'] = 'bytes'
+            # Cache-Control은 apply_cache_policy에서 (미디어는 private, no-cache - 강한 ETag로 재검증)
+            # 🍎 Safari/iOS 추가 헤더
+            response.headers['Access-Control-Allow-Origin'] = '*'
+            response.headers['Access-Control-Expose-Headers'] = 'Content-Length, Content-Range, Accept-Ranges, ETag'
+            return response
+        
+        def unchanged_since(header):
+            try:
+                return int(stat.st_mtime) <= parsedate_to_datetime(header).timestamp()
+            except (TypeError, ValueError):
+                return False
+        
+        # ✅ 이미 가진 파일이면 304 (If-None-Match 우선, 없을 때만 If-Modified-Since)
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match:
+            tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+            not_modified = '*' in tags or etag in tags
+        else:
+            if_modified_since = request.headers.get('If-Modified-Since')
+            not_modified = bool(if_modified_since) and unchanged_since(if_modified_since)
+        if not_modified:
+            return finish(Response(status=304))
+        
+        # Range 요청 (If-Range가 현재 파일과 다르면 무시하고 전체 전송)
+        ranges = None
+        range_header = request.headers.get('Range')
+        if range_header:
+            if_range = request.headers.get('If-Range', '').strip()
+            if not if_range or if_range == etag or (not if_range.startswith(('"', 'W/')) and unchanged_since(if_range)):
+                ranges = parse_byte_ranges(range_header, file_size)
+        
+        if ranges == []:
+            response = Response(status=416)
+            response.headers['Content-Range'] = f'bytes */{file_size}'
+            return finish(response)
+        
+        if not ranges:
+            if log_label:
+                self.log(f"🎵 전체 파일 서빙: {log_label} (크기: {file_size/1024/1024:.1f}MB)")
+            response = Response(file_range_body(request.environ, file_path, 0, file_size), 200,
+                                mimetype=mimetype, direct_passthrough=True)
+            response.headers['Content-Length'] = str(file_size)
+            return finish(response)
+        
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            # Safari는 Range 요청을 미친듯이 보내서 첫 요청만 로그 출력
+            if log_label and start == 0:
+                self.log(f"🎵 Range 스트리밍 시작: {log_label} (크기: {file_size/1024/1024:.1f}MB)")
+            response = Response(file_range_body(request.environ, file_path, start, end - start + 1), 206,
+                                mimetype=mimetype, direct_passthrough=True)  # 🍎 정확한 MIME type!
+            response.headers['Content-Range'] = f'bytes {start}-{end}/{file_size}'
+            response.headers['Content-Length'] = str(end - start + 1)
+            return finish(response)
+        
+        # 다중 구간 → multipart/byteranges
+        boundary = os.urandom(12).hex()
+        body, total = multipart_range_body(request.environ, file_path, ranges, boundary, mimetype, file_size)
+        response = Response(body, 206, content_type=f'multipart/byteranges; boundary={boundary}',
+                            direct_passthrough=True)
+        response.headers['Content-Length'] = str(total)
+        return finish(response)
+    
     def login_required(self, f):
         """로그인 필요 데코레이터"""
         @wraps(f)
@@ -618,16 +3327,27 @@ class VideoDownloaderServer:
     def setup_routes(self):
         """Flask 라우트 설정"""
         
-        # JavaScript 파일 캐시 방지
+        # 🗄️ 브라우저 캐시 정책 (해시 붙은 정적 파일/미디어는 오래, HTML/API는 매번 재검증)
         @self.app.after_request
-        def add_no_cache_headers(response):
-            """JavaScript 파일 캐시 방지"""
-            if request.path.endswith('.js'):
-                response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-                response.headers['Pragma'] = 'no-cache'
-                response.headers['Expires'] = '0'
+        def apply_cache_policy(response):
+            """경로별 Cache-Control - 응답이 직접 정한 값(no-store 등)은 유지"""
+            success = response.status_code in (200, 206, 304)
+            if request.path.startswith('/static/'):
+                filename = request.path[len('/static/'):]
+                version = request.args.get('v')
+                hashed = success and version and version == self.asset_hash(filename)
+                response.headers['Cache-Control'] = CACHE_STATIC_IMMUTABLE if hashed else CACHE_REVALIDATE
+                response.headers.pop('Expires', None)
+            elif 'Cache-Control' not in response.headers:
+                media = (success and request.path.startswith(CACHE_MEDIA_PREFIXES)
+                         and response.mimetype != 'application/json')  # 로그인 필요 등 오류 응답은 제외
+                response.headers['Cache-Control'] = CACHE_MEDIA_REVALIDATE if media else CACHE_REVALIDATE
             return response
         
+        @self.app.context_processor
+        def inject_asset_url():
+            return {'asset_url': self.asset_url}
+        
         @self.app.before_request
         def track_session():
             """접속자 추적 및 IP 차단 검사"""
@@ -784,6 +3504,11 @@ class VideoDownloaderServer:
                 url = data.get('url', '').strip()
                 is_mobile = data.get('is_mobile', False)  # 모바일 여부
                 streaming_mode = data.get('streaming_mode', False)  # 테슬라 스트리밍 모드
+                force_refresh = data.get('force_refresh', False)  # 캐시된 URL 만료(403) 시 재해석
+                download_priority = data.get('priority', 'now_playing')  # now_playing / prefetch / bulk
+                if download_priority not in DOWNLOAD_PRIORITIES:
+                    download_priority = 'now_playing'
+                device_class = 'mobile' if is_mobile else 'desktop'
                 
                 # 디버깅: 받은 파라미터 로그 출력
                 self.log(f"🔍 요청 파라미터: url={url[:50]}..., is_mobile={is_mobile}, streaming_mode={streaming_mode}")
@@ -837,69 +3562,47 @@ class VideoDownloaderServer:
                         })
                 
                 # 🚀 일반 모드: 빠른 캐시 확인
-                import re
-                # 쇼츠 URL 지원: /shorts/, /v=, /youtu.be/
-                video_id_match = re.search(r'(?:v=|youtu\.be/|shorts/)([a-zA-Z0-9_-]{11})', url)
-                if video_id_match:
-                    quick_video_id = video_id_match.group(1)
+                # 🔗 watch/shorts/embed/youtu.be 모두 지원
+                quick_video_id = extract_video_id(url)
+                if quick_video_id:
                     
-                    # 캐시 파일이 있는지 빠르게 확인
-                    for ext in ['m4a', 'webm', 'opus', 'mp3', 'mp4']:
-                        cached_file = os.path.join(temp_dir, f"{quick_video_id}.{ext}")
-                        if os.path.exists(cached_file):
-                            self.log(f"⚡ 캐시 즉시 사용: {quick_video_id}.{ext} (YouTube 확인 생략)")
-                            
-                            # Duration 읽기
-                            file_duration = 0
-                            try:
-                                try:
-                                    from mutagen import File
-                                    audio = File(cached_file)
-                                    if audio and audio.info and hasattr(audio.info, 'length'):
-                                        file_duration = int(audio.info.length)
-                                except:
-                                    import subprocess
-                                    result = subprocess.run(
-                                        ['ffprobe', '-v', 'error', '-show_entries', 
-                                         'format=duration', '-of', 
-                                         'default=noprint_wrappers=1:nokey=1', cached_file],
-                                        capture_output=True,
-                                        text=True,
-                                        timeout=3
-                                    )
-                                    file_duration = int(float(result.stdout.strip()))
-                            except:
-                                file_duration = 0
-                            
-                            # 🎵 실제 제목 가져오기 (playlist 우선, 없으면 metadata.json, 마지막으로 YouTube API)
-                            cached_title = None
-                            cached_thumbnail = ''
-                            cached_duration_from_meta = 0
-                            
+                    # 캐시 파일이 있는지 빠르게 확인 (🎵 인덱스 조회)
+                    cache_entry = self.audio_cache.get(quick_video_id)
+                    if cache_entry:
+                        self.audio_cache.record_hit(quick_video_id)
+                        cached_file = cache_entry['path']
+                        self.log(f"⚡ 캐시 즉시 사용: {cache_entry['filename']} (YouTube 확인 생략)")
+                        
+                        # Duration (🎵 다운로드 완료 시 분석해 둔 값 - 파일 파싱/ffprobe 없음)
+                        file_duration = cache_entry['duration']
+                        if not file_duration:
+                            probed_entry = self.audio_cache.probe_entry(quick_video_id)
+                            file_duration = probed_entry['duration'] if probed_entry else 0
+                        
+                        # 🎵 실제 제목 가져오기 (📚 카탈로그 우선, 없으면 playlist → metadata.json → YouTube API)
+                        cached_title = None
+                        cached_thumbnail = ''
+                        cached_duration_from_meta = 0
+                        
+                        catalog_entry = self.media_catalog.get(quick_video_id)
+                        if catalog_entry and catalog_entry.get('title'):
+                            cached_title = catalog_entry['title']
+                            cached_thumbnail = catalog_entry.get('thumbnail', '')
+                            cached_duration_from_meta = catalog_entry.get('duration', 0)
+                            self.log(f"📚 카탈로그에서 찾음: {cached_title}")
+                        else:
                             try:
-                                # 1순위: 재생 목록에서 찾기
-                                playlist = self.load_playlist()
-                                self.log(f"🔍 재생 목록 검색 중... (video_id: {quick_video_id}, 항목 수: {len(playlist)})")
-                                for item in playlist:
-                                    item_video_id = item.get('video_id', '')
-                                    item_url = item.get('url', '')
-                                    if item_video_id == quick_video_id or quick_video_id in item_url:
+                                # 1순위: 재생 목록, 2순위: 메타데이터 (🗃️ video_id 색인 조회)
+                                username = session.get('username', 'admin')
+                                for collection in ('playlist', 'metadata'):
+                                    item = self.library.find(collection, username, video_id=quick_video_id)
+                                    if item and item.get('title'):
                                         cached_title = item.get('title', '')
                                         cached_thumbnail = item.get('thumbnail', '')
                                         cached_duration_from_meta = item.get('duration', 0)
-                                        self.log(f"✅ 재생 목록에서 찾음: {cached_title}")
+                                        self.log(f"✅ {collection}에서 찾음: {cached_title}")
                                         break
-                                
-                                # 2순위: 메타데이터에서 찾기 (재생 목록에 없으면)
-                                if not cached_title:
-                                    metadata = self.load_metadata()
-                                    self.log(f"🔍 메타데이터 검색 중... (video_id: {quick_video_id}, 키 수: {len(metadata)})")
-                                    if quick_video_id in metadata:
-                                        cached_title = metadata[quick_video_id].get('title', '')
-                                        cached_thumbnail = metadata[quick_video_id].get('thumbnail', '')
-                                        cached_duration_from_meta = metadata[quick_video_id].get('duration', 0)
-                                        self.log(f"✅ 메타데이터에서 찾음: {cached_title}")
-                                
+                            
                                 # 3순위: YouTube API로 직접 가져오기 (빠른 조회)
                                 if not cached_title:
                                     self.log(f"🌐 YouTube API로 제목 조회 시도...")
@@ -923,85 +3626,91 @@ class VideoDownloaderServer:
                                 import traceback
                                 self.log(f"상세 오류: {traceback.format_exc()}")
                             
-                            # 최종 제목 설정
-                            if not cached_title:
-                                cached_title = 'Cached Audio'
-                                self.log(f"❌ 제목을 찾을 수 없음 - 기본값 사용")
-                            
-                            # duration은 파일에서 읽은 값 우선, 없으면 메타데이터 값
-                            if file_duration == 0 and cached_duration_from_meta > 0:
-                                file_duration = cached_duration_from_meta
-                            
-                            file_name = os.path.basename(cached_file)
-                            return jsonify({
-                                'success': True,
-                                'audio_url': f'/temp_audio/{file_name}',
-                                'title': cached_title,
-                                'duration': file_duration,
-                                'thumbnail': cached_thumbnail,
-                                'video_id': quick_video_id,
-                                'local_file': True,
-                                'from_cache': True
-                            })
+                            # 다음 재생부터는 카탈로그에서 바로
+                            self.media_catalog.update(quick_video_id, title=cached_title, thumbnail=cached_thumbnail,
+                                                      duration=cached_duration_from_meta, audio_file=cache_entry['filename'])
+                        
+                        # 최종 제목 설정
+                        if not cached_title:
+                            cached_title = 'Cached Audio'
+                            self.log(f"❌ 제목을 찾을 수 없음 - 기본값 사용")
+                        
+                        # duration은 파일에서 읽은 값 우선, 없으면 메타데이터 값
+                        if file_duration == 0 and cached_duration_from_meta > 0:
+                            file_duration = cached_duration_from_meta
+                        
+                        file_name = os.path.basename(cached_file)
+                        return jsonify({
+                            'success': True,
+                            'audio_url': f'/temp_audio/{file_name}',
+                            'title': cached_title,
+                            'duration': file_duration,
+                            'thumbnail': cached_thumbnail,
+                            'video_id': quick_video_id,
+                            'local_file': True,
+                            'from_cache': True
+                        })
                 
                 # 캐시 없음 - 정보 가져오기 (학습 기반 최적화 포맷)
+                self.audio_cache.record_miss()
                 # 🎯 학습된 최적 포맷 순서 가져오기
-                format_options = self.get_optimized_formats(quick_video_id if video_id_match else 'unknown', is_mobile)
+                format_options = self.get_optimized_formats(quick_video_id or 'unknown', is_mobile)
                 
                 if is_mobile:
                     print(f"📱 모바일 모드: 학습 기반 포맷 순서 ({len(format_options)}개)")
                 else:
                     print(f"💻 데스크톱 모드: 학습 기반 포맷 순서 ({len(format_options)}개)")
                 
-                # 포맷별로 시도
                 info = None
                 stream_url = None
                 video_id = 'unknown'
                 actual_duration = 0
                 successful_format = None
+                relay_track = None
                 
-                for i, format_str in enumerate(format_options):
+                # 🔗 해석된 URL 캐시 확인 (prefetch 직후 재생 등 - YouTube 재해석 생략)
+                if quick_video_id:
+                    if force_refresh:
+                        self.stream_url_cache.invalidate(quick_video_id)
+                        self.log(f"🔄 스트림 URL 재해석 요청: {quick_video_id}")
+                    else:
+                        cached_stream = self.stream_url_cache.lookup(quick_video_id, format_options, device_class)
+                        if cached_stream:
+                            info = {
+                                'id': quick_video_id,
+                                'title': cached_stream['title'],
+                                'duration': cached_stream['duration'],
+                                'thumbnail': cached_stream['thumbnail']
+                            }
+                            video_id = quick_video_id
+                            stream_url = cached_stream['url']
+                            successful_format = cached_stream['format']
+                            relay_track = self.audio_relay.get(quick_video_id)
+                            self.log(f"⚡ 스트림 URL 캐시 사용: {quick_video_id} ({successful_format})")
+                
+                # 🎯 포맷 목록을 한 번만 추출하고 학습된 순서대로 로컬에서 선택
+                if not stream_url:
                     try:
-                        info_opts = {
-                            'format': format_str,
-                            'quiet': True,
-                            'no_warnings': True,
-                            'extract_flat': False,
-                            'socket_timeout': 10,  # 10초 타임아웃
-                            'nocheckcertificate': True,  # SSL 인증서 체크 생략 (빠름)
-                            'no_check_certificate': True,
-                            'prefer_insecure': False,
-                            'http_chunk_size': 10485760,  # 10MB 청크
-                            'youtube_include_dash_manifest': False,  # DASH manifest 생략 (빠름!)
-                            'youtube_include_hls_manifest': False,   # HLS manifest 생략 (빠름!)
-                            'skip_unavailable_fragments': True,      # 없는 조각 건너뛰기
-                        }
+                        print(f"🔄 포맷 목록 추출 (1회): 후보 {len(format_options)}개")
+                        # 🤝 같은 영상을 동시에 요청하면 (prefetch + 재생, 여러 사용자) 추출 1회만
+                        extract_key = ('extract', quick_video_id or url, 'audio')
+                        info = self.single_flight.do(extract_key, self.extract_media_info, url, 'audio')
+                        video_id = info.get('id', 'unknown')
+                        self.media_catalog.update_from_info(info)
+                        successful_format, chosen_format = self.select_format(info, format_options, video_id, is_mobile)
                         
-                        print(f"🔄 포맷 시도 {i+1}/{len(format_options)}: {format_str}")
-                        
-                        with yt_dlp.YoutubeDL(info_opts) as ydl:
-                            info = ydl.extract_info(url, download=False)
-                            video_id = info.get('id', 'unknown')
-                            stream_url = info.get('url')
-                            
-                            if stream_url:
-                                print(f"✅ 포맷 성공: {format_str} (최적화 모드)")
-                                successful_format = format_str
-                                # 🎯 성공한 포맷 기록
-                                self.record_format_success(video_id, format_str, is_mobile)
-                                break
-                            else:
-                                print(f"❌ 포맷 실패: {format_str} - URL 없음")
-                                # 🎯 실패한 포맷 기록
-                                if video_id != 'unknown':
-                                    self.record_format_failure(video_id, format_str)
-                                
+                        if chosen_format:
+                            stream_url = chosen_format.get('url')
+                            print(f"✅ 포맷 성공: {successful_format} (최적화 모드)")
+                            # 🔗 해석된 URL 캐시 저장 (expire= 기준 만료)
+                            self.stream_url_cache.put(video_id, successful_format, device_class, stream_url, info)
+                            # 🔁 서버 중계 등록 (브라우저와 캐시가 같은 원본 수신을 공유)
+                            try:
+                                relay_track = self.audio_relay.register(video_id, url, chosen_format)
+                            except OSError as relay_error:
+                                self.log(f"⚠️ 중계 준비 실패 (원본 URL 직접 재생): {relay_error}")
                     except Exception as e:
-                        print(f"❌ 포맷 실패: {format_str} - {str(e)}")
-                        # 🎯 실패한 포맷 기록
-                        if video_id != 'unknown':
-                            self.record_format_failure(video_id, format_str)
-                        continue
+                        print(f"❌ 포맷 추출 실패: {str(e)}")
                 
                 if not info or not stream_url:
                     return jsonify({
@@ -1017,30 +3726,24 @@ class VideoDownloaderServer:
                 # 실제 사용할 duration
                 actual_duration = raw_duration
                 
-                # 이미 다운로드된 파일 확인
+                # 이미 다운로드된 파일 확인 (🎵 인덱스 조회)
                 downloaded_file = None
-                for ext in ['m4a', 'webm', 'opus', 'mp3', 'mp4']:
-                    file_path = os.path.join(temp_dir, f"{video_id}.{ext}")
-                    if os.path.exists(file_path):
-                        downloaded_file = file_path
-                        print(f"💾 캐시된 파일 사용: {file_path}")
-                        break
+                downloaded_entry = self.audio_cache.get(video_id)
+                if downloaded_entry:
+                    self.audio_cache.record_hit(video_id)
+                    downloaded_file = downloaded_entry['path']
+                    print(f"💾 캐시된 파일 사용: {downloaded_file}")
                     
                 # 캐시된 파일이 있으면 로컬 파일로 즉시 반환
                 if downloaded_file:
-                    # 실제 파일에서 duration 읽기
-                    try:
-                        try:
-                            from mutagen import File as MutagenFile
-                            audio = MutagenFile(downloaded_file)
-                            if audio and audio.info and hasattr(audio.info, 'length'):
-                                file_duration = audio.info.length
-                                actual_duration = int(file_duration)
-                                print(f"📊 캐시 파일 Duration: {actual_duration}초 ({actual_duration/60:.1f}분)")
-                        except:
-                            pass
-                    except:
-                        pass
+                    # Duration (🎵 다운로드 완료 시 분석해 둔 값 - 파일 파싱 없음)
+                    cached_duration = downloaded_entry['duration']
+                    if not cached_duration:
+                        probed_entry = self.audio_cache.probe_entry(video_id)
+                        cached_duration = probed_entry['duration'] if probed_entry else 0
+                    if cached_duration:
+                        actual_duration = cached_duration
+                        print(f"📊 캐시 파일 Duration: {actual_duration}초 ({actual_duration/60:.1f}분)")
                     
                     file_name = os.path.basename(downloaded_file)
                     print(f"✅ 캐시 사용 - Duration: {actual_duration}초")
@@ -1057,73 +3760,118 @@ class VideoDownloaderServer:
                 
                 # 🚀 모든 플랫폼: 즉시 재생 + 백그라운드 다운로드 (서버가 중계!)
                 if stream_url:
-                    # 백그라운드 다운로드 시작 (중복 방지)
-                    if video_id not in self.downloading_files:
-                        self.downloading_files.add(video_id)
-                        import threading
-                        def background_download():
-                            try:
-                                bg_download_format_options = [
-                                    'bestaudio[ext=webm]',  # 🍎 Safari duration 버그 없음!
-                                    'bestaudio[ext=opus]',
-                                    'bestaudio[ext=m4a]',
-                                    'bestaudio[ext=mp4]',
-                                    'bestaudio/best'
-                                ]
-                                
-                                self.log(f"🚀 백그라운드 다운로드 시작: {video_id}")
-                                
-                                download_success = False
-                                for fmt in bg_download_format_options:
+                    # 📥 백그라운드 다운로드 예약 (스케줄러가 동시 다운로드 수 제한, 같은 영상은 하나만)
+                    # 🎯 추출한 info 재사용 (URL 캐시 적중 시에는 formats가 없음 → 기존 방식)
+                    extracted_info = info if info.get('formats') else None
+                    def downloaded_audio_url():
+                        # 🎵 완료된 파일을 캐시 인덱스 + 카탈로그에 등록
+                        entry = self.audio_cache.refresh(video_id)
+                        if not entry:
+                            return True
+                        self.media_catalog.update(video_id, audio_file=entry['filename'], duration=entry['duration'])
+                        self.safari_remuxer.submit(video_id, entry['path'])  # 🍎 Safari용 변형 준비
+                        self.cache_maintenance_event.set()  # 💾 용량 점검
+                        return f"/temp_audio/{entry['filename']}"
+                    
+                    def background_download(job):
+                        bg_download_format_options = [
+                            'bestaudio[ext=webm]',  # 🍎 Safari duration 버그 없음!
+                            'bestaudio[ext=opus]',
+                            'bestaudio[ext=m4a]',
+                            'bestaudio[ext=mp4]',
+                            'bestaudio/best'
+                        ]
+                        base_download_opts = {
+                            'quiet': True,
+                            'no_warnings': True,
+                            'outtmpl': os.path.join(temp_dir, '%(id)s.%(ext)s'),
+                            'nocheckcertificate': True,
+                            'no_check_certificate': True,
+                            'socket_timeout': 30,  # 타임아웃 줄임
+                            'retries': 5,  # 재시도 늘림
+                            'http_chunk_size': 10485760,  # 10MB 청크 (더 빠름!)
+                            'fragment_retries': 10,  # 조각 재시도 늘림
+                            'extractor_retries': 5,
+                            'concurrent_fragment_downloads': 5,  # 🚀 병렬 다운로드 5개!
+                            'buffersize': 16384,  # 버퍼 크기 증가
+                            'throttledratelimit': None,  # 속도 제한 없음
+                            'progress_hooks': [job.progress_hook],  # 진행률 + 취소 확인
+                        }
+                        
+                        self.log(f"🚀 백그라운드 다운로드 시작: {video_id}")
+                        
+                        try:
+                            # 1차: 추출된 info로 로컬 포맷 선택 후 바로 다운로드 (재추출 없음)
+                            if extracted_info:
+                                bg_format, bg_chosen = self.select_format(extracted_info, bg_download_format_options)
+                                if bg_chosen:
                                     try:
-                                        download_opts = {
-                                            'format': fmt,
-                                            'quiet': True,
-                                            'no_warnings': True,
-                                            'outtmpl': os.path.join(temp_dir, '%(id)s.%(ext)s'),
-                                            'nocheckcertificate': True,
-                                            'no_check_certificate': True,
-                                            'socket_timeout': 30,  # 타임아웃 줄임
-                                            'retries': 5,  # 재시도 늘림
-                                            'http_chunk_size': 10485760,  # 10MB 청크 (더 빠름!)
-                                            'fragment_retries': 10,  # 조각 재시도 늘림
-                                            'extractor_retries': 5,
-                                            'concurrent_fragment_downloads': 5,  # 🚀 병렬 다운로드 5개!
-                                            'buffersize': 16384,  # 버퍼 크기 증가
-                                            'throttledratelimit': None,  # 속도 제한 없음
-                                        }
+                                        download_opts = dict(base_download_opts, format=bg_chosen['format_id'])
                                         with yt_dlp.YoutubeDL(download_opts) as ydl:
-                                            ydl.download([url])
-                                            self.log(f"✅ 백그라운드 다운로드 완료: {video_id} (포맷: {fmt})")
-                                            download_success = True
-                                            break
-                                    except Exception as fmt_error:
-                                        self.log(f"⚠️ 포맷 {fmt} 다운로드 실패: {str(fmt_error)[:100]}...")
-                                        continue
-                                
-                                if not download_success:
-                                    self.log(f"❌ 백그라운드 다운로드 완전 실패: {video_id} (모든 포맷 실패)")
-                                    
-                            except Exception as e:
-                                self.log(f"❌ 백그라운드 다운로드 오류: {e}")
-                            finally:
-                                self.downloading_files.discard(video_id)
+                                            ydl.process_ie_result(copy.deepcopy(extracted_info), download=True)
+                                        self.log(f"✅ 백그라운드 다운로드 완료: {video_id} (포맷: {bg_format}, 재추출 없음)")
+                                        return downloaded_audio_url()
+                                    except DownloadCancelled:
+                                        raise
+                                    except Exception as info_error:
+                                        job.check_cancelled()
+                                        self.log(f"⚠️ 추출 정보 재사용 다운로드 실패, 기존 방식으로 재시도: {str(info_error)[:100]}...")
+                            
+                            # 2차: 포맷별 다운로드 (URL 만료 등으로 1차 실패 시)
+                            for fmt in bg_download_format_options:
+                                job.check_cancelled()
+                                try:
+                                    download_opts = dict(base_download_opts, format=fmt)
+                                    with yt_dlp.YoutubeDL(download_opts) as ydl:
+                                        ydl.download([url])
+                                        self.log(f"✅ 백그라운드 다운로드 완료: {video_id} (포맷: {fmt})")
+                                        return downloaded_audio_url()
+                                except DownloadCancelled:
+                                    raise
+                                except Exception as fmt_error:
+                                    job.check_cancelled()
+                                    self.log(f"⚠️ 포맷 {fmt} 다운로드 실패: {str(fmt_error)[:100]}...")
+                                    continue
+                        except DownloadCancelled:
+                            # 🧹 취소된 작업의 임시 파일 정리
+                            for part_file in glob.glob(os.path.join(temp_dir, f"{glob.escape(video_id)}.*.part")):
+                                try:
+                                    os.remove(part_file)
+                                except OSError:
+                                    pass
+                            raise
                         
-                        thread = threading.Thread(target=background_download, daemon=True)
-                        thread.start()
+                        self.log(f"❌ 백그라운드 다운로드 완전 실패: {video_id} (모든 포맷 실패)")
+                        return False
+                    
+                    def relay_fill(job):
+                        # 🔁 중계가 못 받은 구간만 채워서 완성 (원본을 두 번 받지 않음)
+                        try:
+                            result = relay_track.fill(job)
+                            self.log(f"✅ 중계 캐시 완성: {video_id}")
+                            return result
+                        except DownloadCancelled:
+                            raise
+                        except Exception as relay_error:
+                            self.log(f"⚠️ 중계 캐시 채우기 실패, 기존 다운로드로 전환: {str(relay_error)[:100]}...")
+                            self.audio_relay.remove(video_id)
+                            return background_download(job)
+                    
+                    download_fn = relay_fill if relay_track else background_download
+                    download_job, queued = self.download_scheduler.submit(video_id, download_fn, download_priority)
+                    if queued:
+                        self.log(f"📥 다운로드 예약: {video_id} ({download_priority})")
                     else:
                         self.log(f"⏳ 이미 다운로드 중: {video_id} (중복 방지)")
                     
                     # 🎵 사용자별 메타데이터 저장
                     try:
-                        metadata = self.load_metadata()
-                        metadata[video_id] = {
+                        self.library.put_keyed('metadata', session.get('username', 'admin'), video_id, {
                             'title': info.get('title', 'Unknown'),
                             'duration': actual_duration,
                             'thumbnail': info.get('thumbnail', ''),
                             'added_at': datetime.now().isoformat()
-                        }
-                        self.save_metadata(metadata)
+                        })
                     except Exception as e:
                         self.log(f"⚠️ 메타데이터 저장 실패: {e}")
                     
@@ -1131,13 +3879,16 @@ class VideoDownloaderServer:
                     print(f"⚡ {instant_play_message} - Duration: {actual_duration}초 (서버 중계 + 백그라운드 다운로드)")
                     return jsonify({
                         'success': True,
-                        'audio_url': stream_url,
+                        'audio_url': f'/api/relay/{video_id}' if relay_track else stream_url,
+                        'youtube_url': stream_url,
+                        'relay': bool(relay_track),
                         'title': info.get('title', 'Unknown'),
                         'duration': actual_duration,
                         'thumbnail': info.get('thumbnail', ''),
                         'video_id': video_id,
                         'local_file': False,
                         'downloading': True,
+                        'download_state': download_job.state,
                         'instant_play': True
                     })
                 else:
@@ -1157,122 +3908,191 @@ class VideoDownloaderServer:
             temp_dir = os.path.join(os.path.dirname(__file__), 'temp_audio')
             file_path = os.path.join(temp_dir, filename)
             
-            if not os.path.exists(file_path):
+            # 🔒 temp_audio 밖을 가리키는 경로(..%2F 등) 차단
+            root = os.path.realpath(temp_dir)
+            if not os.path.realpath(file_path).startswith(root + os.sep):
                 return jsonify({'success': False, 'message': '파일을 찾을 수 없습니다'}), 404
             
-            file_size = os.path.getsize(file_path)
+            if not os.path.exists(file_path):
+                # 📥 다운로드 중이면 이미 받은 구간부터 서빙
+                partial_response = self.serve_partial_audio(file_path)
+                if partial_response is not None:
+                    return partial_response
+                if not os.path.exists(file_path):
+                    return jsonify({'success': False, 'message': '파일을 찾을 수 없습니다'}), 404
+            
+            # 🍎 Safari/iOS: webm/opus 대신 미리 만들어 둔 m4a 변형 (탐색 빠름, Range 요청 감소)
+            # URL마다 내용이 하나로 고정되도록 변형은 자기 URL로 리다이렉트 (ETag 재검증이 URL별로 맞도록)
+            variant_pending = False
+            video_id, ext = AudioCacheIndex.split_name(filename)
+            if ext in SAFARI_REMUX_SOURCES and self.is_webkit_client(request.headers.get('User-Agent', '')):
+                variant_path = self.safari_remuxer.variant_path(video_id)
+                if os.path.exists(variant_path):
+                    response = redirect(f'/temp_audio/{os.path.basename(variant_path)}', 302)
+                    response.headers['Cache-Control'] = CACHE_REVALIDATE
+                    return response
+                variant_pending = self.safari_remuxer.submit(video_id, file_path) or video_id in self.safari_remuxer.pending
             
             # 🍎 Safari를 위한 정확한 MIME type 설정
             ext = os.path.splitext(filename)[1].lower()
-            mime_types = {
-                '.m4a': 'audio/mp4',      # Safari 필수!
-                '.mp4': 'audio/mp4',
-                '.mp3': 'audio/mpeg',
-                '.webm': 'audio/webm',
-                '.opus': 'audio/ogg',
-                '.ogg': 'audio/ogg'
-            }
-            mimetype = mime_types.get(ext, 'audio/mpeg')
-            
-            # 첫 요청만 로그 출력 (Range 요청이 아닌 경우만)
-            # Safari는 Range 요청을 미친듯이 보내서 로그가 도배됨
-            
-            # Range 요청 처리 (모든 플랫폼 지원 - Safari 필수!)
-            range_header = request.headers.get('Range', None)
-            user_agent = request.headers.get('User-Agent', '').lower()
-            is_mobile_request = 'mobile' in user_agent or 'iphone' in user_agent or 'android' in user_agent or 'ipad' in user_agent
-            
-            if range_header:
-                # Range 요청: bytes=start-end
-                import re
-                match = re.search(r'bytes=(\d+)-(\d*)', range_header)
-                if match:
-                    start = int(match.group(1))
-                    end = int(match.group(2)) if match.group(2) else file_size - 1
-                    end = min(end, file_size - 1)
-                    length = end - start + 1
-                    
-                    # 첫 Range 요청만 로그 출력
-                    if start == 0:
-                        self.log(f"🎵 Range 스트리밍 시작: {filename} (크기: {file_size/1024/1024:.1f}MB)")
-                    
-                    def generate():
-                        with open(file_path, 'rb') as f:
-                            f.seek(start)
-                            remaining = length
-                            chunk_size = 256 * 1024  # 256KB 청크
-                            while remaining > 0:
-                                chunk = f.read(min(chunk_size, remaining))
-                                if not chunk:
-                                    break
-                                remaining -= len(chunk)
-                                yield chunk
-                    
-                    response = Response(
-                        generate(),
-                        206,  # Partial Content
-                        mimetype=mimetype,  # 🍎 정확한 MIME type!
-                        direct_passthrough=True
-                    )
-                    response.headers['Content-Range'] = f'bytes {start}-{end}/{file_size}'
-                    response.headers['Content-Length'] = str(length)
-                    response.headers['Accept-Ranges'] = 'bytes'
-                    response.headers['Cache-Control'] = 'no-cache'  # Safari: no-cache 권장
-                    # 🍎 Safari/iOS 추가 헤더
-                    response.headers['Access-Control-Allow-Origin'] = '*'
-                    response.headers['Access-Control-Expose-Headers'] = 'Content-Length, Content-Range'
-                    
-                    # Range 서빙 완료 로그도 제거 (너무 많음)
-                    # self.log(f"✅ Range 서빙 완료: {filename}")
-                    return response
+            mimetype = AUDIO_MIME_TYPES.get(ext, 'audio/mpeg')
+            
+            # Range 요청 처리 (모든 플랫폼 지원 - Safari 필수!) - 본문은 sendfile
+            # Safari는 Range 요청을 미친듯이 보내서 첫 요청만 로그 출력
+            response = self.send_media_file(file_path, mimetype, log_label=filename)
+            if variant_pending:
+                response.headers['Cache-Control'] = CACHE_REVALIDATE  # 변형이 준비되면 다음 재생부터 전환
+            return response
+        
+        @self.app.route('/api/downloads', methods=['GET'])
+        def get_downloads():
+            """백그라운드 다운로드 큐 상태 (대기/진행 중 작업 + 최근 기록)"""
+            if not session.get('logged_in'):
+                return jsonify({'success': False, 'message': '로그인 필요'})
+            
+            return jsonify({'success': True, **self.download_scheduler.status()})
+        
+        @self.app.route('/api/downloads/<video_id>', methods=['DELETE'])
+        def cancel_download(video_id):
+            """더 이상 필요 없는 다운로드 취소 (?priority=prefetch 면 재생 중인 작업은 유지)"""
+            if not session.get('logged_in'):
+                return jsonify({'success': False, 'message': '로그인 필요'})
+            
+            priority = request.args.get('priority')
+            if priority is not None and priority not in DOWNLOAD_PRIORITIES:
+                return jsonify({'success': False, 'message': '알 수 없는 우선순위'})
+            
+            cancelled = self.download_scheduler.cancel(video_id, priority)
+            return jsonify({'success': True, 'cancelled': cancelled})
+        
+        @self.app.route('/api/relay/<video_id>')
+        def relay_audio(video_id):
+            """🔁 서버 중계 - 원본을 Range 그대로 받아 전달하면서 temp_audio에 저장"""
+            if not session.get('logged_in'):
+                return jsonify({'success': False, 'message': '로그인 필요'})
+            
+            track = self.audio_relay.get(video_id)
+            if not track:
+                # 이미 완성된 파일이면 로컬 파일로 (Range 유지되도록 307)
+                cache_entry = self.audio_cache.get(video_id)
+                if cache_entry:
+                    return redirect(f"/temp_audio/{cache_entry['filename']}", 307)
+                return jsonify({'success': False, 'message': '중계 정보가 없습니다'}), 404
+            
+            try:
+                total = track.ensure_total()
+            except Exception as e:
+                self.log(f"❌ 중계 원본 연결 실패: {video_id} - {e}")
+                return jsonify({'success': False, 'message': '원본 연결 실패'}), 502
+            
+            byte_range = single_byte_range(request.headers.get('Range'), total)
+            if byte_range is None:
+                response = Response(status=416)
+                response.headers['Content-Range'] = f'bytes */{total}'
+                return response
+            start, end, status = byte_range
+            
+            if start == 0:
+                self.log(f"🔁 중계 시작: {video_id} (캐시 {track.covered_bytes()/1024/1024:.1f}/{total/1024/1024:.1f}MB)")
+            
+            def generate():
+                try:
+                    yield from track.stream(start, end)
+                except Exception as e:
+                    self.log(f"⚠️ 중계 중단: {video_id} - {str(e)[:100]}")
+            
+            response = Response(generate(), status, mimetype=track.mimetype, direct_passthrough=True)
+            response.headers['Content-Length'] = str(end - start + 1)
+            response.headers['Accept-Ranges'] = 'bytes'
+            if status == 206:
+                response.headers['Content-Range'] = f'bytes {start}-{end}/{total}'
+            response.headers['Cache-Control'] = 'no-store'
+            response.headers['Access-Control-Allow-Origin'] = '*'
+            response.headers['Access-Control-Expose-Headers'] = 'Content-Length, Content-Range'
+            return response
+        
+        @self.app.route('/api/download-events/<video_id>')
+        def download_events(video_id):
+            """다운로드 진행률 SSE (진행 바이트/속도/ETA → 완료 시 로컬 URL, check-download 폴링 대체)"""
+            if not session.get('logged_in'):
+                return jsonify({'success': False, 'message': '로그인 필요'})
             
-            # 전체 파일 서빙 (Range 요청 없음)
-            self.log(f"🎵 전체 파일 서빙: {filename}")
-            
-            def generate_full():
-                with open(file_path, 'rb') as f:
-                    # 🍎 Safari 즉시 재생을 위해 작은 청크 사용
-                    chunk_size = 64 * 1024  # 64KB 청크 (Safari 최적화)
-                    while True:
-                        chunk = f.read(chunk_size)
-                        if not chunk:
-                            break
-                        yield chunk
+            def sse(event, payload):
+                return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
             
-            response = Response(
-                generate_full(),
-                200,
-                mimetype=mimetype,  # 🍎 정확한 MIME type!
-                direct_passthrough=True
-            )
-            response.headers['Content-Length'] = str(file_size)
-            response.headers['Accept-Ranges'] = 'bytes'
-            response.headers['Cache-Control'] = 'no-cache'  # Safari: no-cache 권장
-            # 🍎 Safari/iOS 추가 헤더
-            response.headers['Access-Control-Allow-Origin'] = '*'
-            response.headers['Access-Control-Expose-Headers'] = 'Content-Length, Accept-Ranges'
+            def local_audio_url():
+                cache_entry = self.audio_cache.get(video_id)
+                return f"/temp_audio/{cache_entry['filename']}" if cache_entry else None
+            
+            def generate():
+                job = self.download_scheduler.find(video_id)
+                if not job or job.state == 'done':
+                    audio_url = job.result if job and isinstance(job.result, str) else local_audio_url()
+                    if audio_url:
+                        yield sse('done', {'video_id': video_id, 'audio_url': audio_url})
+                    else:
+                        yield sse('idle', {'video_id': video_id})
+                    return
+                
+                version = -1
+                while True:
+                    if job.state == 'done':
+                        audio_url = job.result if isinstance(job.result, str) else local_audio_url()
+                        yield sse('done', {'video_id': video_id, 'audio_url': audio_url})
+                        return
+                    if job.state in ('failed', 'cancelled'):
+                        yield sse(job.state, {'video_id': video_id, 'error': job.error})
+                        return
+                    
+                    if version != job.version:
+                        version = job.version
+                        progress = {
+                            'video_id': video_id,
+                            'state': job.state,
+                            'downloaded_bytes': job.downloaded_bytes,
+                            'total_bytes': job.total_bytes,
+                            'speed': job.speed,
+                            'eta': job.eta
+                        }
+                        # 🎵 앞부분을 충분히 받았으면 받는 중인 파일로 바로 재생 가능
+                        if job.filename and job.total_bytes_exact and job.downloaded_bytes >= PARTIAL_AUDIO_MIN_BYTES:
+                            progress['partial_url'] = f'/temp_audio/{os.path.basename(job.filename)}'
+                        yield sse('progress', progress)
+                    else:
+                        yield ': keep-alive\n\n'  # 프록시 연결 유지
+                    
+                    sent_at = time.time()
+                    job.wait_for_update(version, timeout=15)
+                    # 진행률은 최대 초당 2회만 전송
+                    time.sleep(max(0, 0.5 - (time.time() - sent_at)))
             
-            self.log(f"✅ 파일 서빙 완료: {filename}")
+            response = Response(generate(), mimetype='text/event-stream')
+            response.headers['Cache-Control'] = 'no-cache'
+            response.headers['X-Accel-Buffering'] = 'no'
             return response
         
+        @self.app.route('/api/cache-stats', methods=['GET'])
+        def get_cache_stats():
+            """💾 temp_audio 캐시 통계 (용량/적중/미스/삭제)"""
+            if not session.get('logged_in'):
+                return jsonify({'success': False, 'message': '로그인 필요'})
+            
+            return jsonify({'success': True, **self.cache_stats()})
+        
         @self.app.route('/api/check-download/<video_id>')
         def check_download(video_id):
             """다운로드 완료 여부 확인"""
             if not session.get('logged_in'):
                 return jsonify({'success': False, 'message': '로그인 필요'})
             
-            temp_dir = os.path.join(os.path.dirname(__file__), 'temp_audio')
-            
-            # 다운로드된 파일 확인
-            for ext in ['m4a', 'webm', 'opus', 'mp3', 'mp4']:
-                file_path = os.path.join(temp_dir, f"{video_id}.{ext}")
-                if os.path.exists(file_path):
-                    file_name = os.path.basename(file_path)
-                    return jsonify({
-                        'success': True,
-                        'ready': True,
-                        'audio_url': f'/temp_audio/{file_name}'
-                    })
+            # 다운로드된 파일 확인 (🎵 인덱스 조회)
+            cache_entry = self.audio_cache.get(video_id)
+            if cache_entry:
+                return jsonify({
+                    'success': True,
+                    'ready': True,
+                    'audio_url': f"/temp_audio/{cache_entry['filename']}"
+                })
             
             return jsonify({
                 'success': True,
@@ -1288,14 +4108,13 @@ class VideoDownloaderServer:
             try:
                 data = request.get_json()
                 url = data.get('url', '').strip()
+                force_refresh = data.get('force_refresh', False)  # 캐시된 URL 만료(403) 시 재해석
                 
                 if not url:
                     return jsonify({'success': False, 'message': 'URL을 입력해주세요'})
                 
                 # video_id 추출
-                import re
-                video_id_match = re.search(r'(?:v=|youtu\.be/)([a-zA-Z0-9_-]{11})', url)
-                video_id = video_id_match.group(1) if video_id_match else 'unknown'
+                video_id = extract_video_id(url) or 'unknown'
                 
                 # 🎯 학습된 최적 비디오 포맷 순서 가져오기 (비디오는 모바일/데스크톱 구분 없음)
                 default_video_formats = [
@@ -1305,13 +4124,14 @@ class VideoDownloaderServer:
                     'best[ext=mp4]',
                     'best'
                 ]
+                # 🌐 전체 통계로 기본 순서 정렬 (처음 보는 영상도 성공 확률 높은 포맷부터)
+                default_video_formats = self.format_history.rank_formats(default_video_formats, 'desktop', 'video')
                 
                 # 비디오용 이력 키는 'video_' 접두사 추가
                 video_history_id = f"video_{video_id}"
-                history = self.load_format_history()
+                info = self.format_history.get(video_history_id)
                 
-                if video_history_id in history:
-                    info = history[video_history_id]
+                if info:
                     success_format = info.get('success_format')
                     failed_formats = info.get('failed_formats', [])
                     
@@ -1330,48 +4150,43 @@ class VideoDownloaderServer:
                 
                 print(f"🎬 비디오 포맷 학습 기반 최적화 ({len(format_options)}개)")
                 
-                # 포맷별로 시도
+                # 🔗 해석된 URL 캐시 확인 (비디오는 기기 구분 없음)
+                if video_id != 'unknown':
+                    if force_refresh:
+                        self.stream_url_cache.invalidate(video_history_id)
+                        self.log(f"🔄 비디오 URL 재해석 요청: {video_id}")
+                    else:
+                        cached_stream = self.stream_url_cache.lookup(video_history_id, format_options, 'desktop')
+                        if cached_stream:
+                            self.log(f"⚡ 비디오 URL 캐시 사용: {video_id} ({cached_stream['format']})")
+                            return jsonify({
+                                'success': True,
+                                'video_url': cached_stream['url'],
+                                'title': cached_stream['title'],
+                                'duration': cached_stream['duration'],
+                                'thumbnail': cached_stream['thumbnail']
+                            })
+                
                 info = None
                 video_url = None
                 successful_format = None
                 
-                for i, format_str in enumerate(format_options):
-                    try:
-                        ydl_opts = {
-                            'format': format_str,
-                            'quiet': True,
-                            'no_warnings': True,
-                            'socket_timeout': 10,  # 10초 타임아웃
-                            'nocheckcertificate': True,  # SSL 인증서 체크 생략 (빠름)
-                            'no_check_certificate': True,
-                            'http_chunk_size': 10485760,  # 10MB 청크
-                            'youtube_include_dash_manifest': False,  # DASH manifest 생략 (빠름!)
-                            'youtube_include_hls_manifest': False,   # HLS manifest 생략 (빠름!)
-                            'skip_unavailable_fragments': True,      # 없는 조각 건너뛰기
-                        }
-                        
-                        print(f"🔄 비디오 포맷 시도 {i+1}/{len(format_options)}: {format_str}")
-                        
-                        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                            info = ydl.extract_info(url, download=False)
-                            video_url = info.get('url')
-                            
-                            if video_url:
-                                print(f"✅ 비디오 포맷 성공: {format_str}")
-                                successful_format = format_str
-                                # 🎯 성공한 비디오 포맷 기록
-                                self.record_format_success(video_history_id, format_str, is_mobile=False)
-                                break
-                            else:
-                                print(f"❌ 비디오 포맷 실패: {format_str} - URL 없음")
-                                # 🎯 실패한 비디오 포맷 기록
-                                self.record_format_failure(video_history_id, format_str)
-                                
-                    except Exception as e:
-                        print(f"❌ 비디오 포맷 실패: {format_str} - {str(e)}")
-                        # 🎯 실패한 비디오 포맷 기록
-                        self.record_format_failure(video_history_id, format_str)
-                        continue
+                # 🎯 포맷 목록을 한 번만 추출하고 학습된 순서대로 로컬에서 선택
+                try:
+                    # 🤝 같은 영상을 동시에 요청하면 추출 1회만
+                    extract_key = ('extract', video_id if video_id != 'unknown' else url, 'video')
+                    info = self.single_flight.do(extract_key, self.extract_media_info, url, 'video')
+                    self.media_catalog.update_from_info(info)
+                    successful_format, chosen_format = self.select_format(info, format_options, video_history_id if video_id != 'unknown' else None)
+                    
+                    if chosen_format:
+                        video_url = chosen_format.get('url')
+                        print(f"✅ 비디오 포맷 성공: {successful_format}")
+                        # 🔗 해석된 URL 캐시 저장
+                        if video_id != 'unknown':
+                            self.stream_url_cache.put(video_history_id, successful_format, 'desktop', video_url, info)
+                except Exception as e:
+                    print(f"❌ 비디오 포맷 추출 실패: {str(e)}")
                 
                 if not info or not video_url:
                     return jsonify({
@@ -1433,6 +4248,9 @@ class VideoDownloaderServer:
                                 'channel': entry.get('uploader', 'Unknown'),
                                 'view_count': entry.get('view_count', 0)
                             })
+                            # 📚 검색 결과도 카탈로그에 (나중에 재생/공유 시 재조회 불필요)
+                            self.media_catalog.update(video_id, title=entry.get('title'), thumbnail=thumbnail,
+                                                      duration=entry.get('duration'), channel=entry.get('uploader'))
                     
                     return jsonify({
                         'success': True,
@@ -1452,34 +4270,13 @@ class VideoDownloaderServer:
                 username = session.get('username', 'admin')
                 metadata = self.load_metadata(username)
                 
-                # metadata가 리스트인지 확인
-                if not isinstance(metadata, list):
-                    metadata = []
-                
-                # 각 영상에 video_id 추가 (URL에서 추출)
-                import re
+                # video_id는 저장할 때 채워져 있음 (🗃️ LibraryStore - 여기서는 정규식 없음)
                 for video in metadata:
                     if isinstance(video, dict):
-                        if 'video_id' not in video and 'url' in video:
-                            url = video.get('url', '')
-                            # YouTube video_id 추출
-                            patterns = [
-                                r'(?:youtube\.com\/watch\?v=|youtu\.be\/)([a-zA-Z0-9_-]{11})',
-                                r'youtube\.com\/embed\/([a-zA-Z0-9_-]{11})',
-                                r'youtube\.com\/shorts\/([a-zA-Z0-9_-]{11})',
-                            ]
-                            for pattern in patterns:
-                                match = re.search(pattern, url)
-                                if match:
-                                    video['video_id'] = match.group(1)
-                                    break
-                            
-                            # video_id가 없으면 파일명에서 추출 시도
-                            if 'video_id' not in video:
-                                filename = video.get('filename', '')
-                                match = re.search(r'[a-zA-Z0-9_-]{11}', filename)
-                                if match:
-                                    video['video_id'] = match.group(0)
+                        # 🎞️ HLS 패키지가 있으면 재생/포스터 URL 추가
+                        hls_urls = self.hls_packager.urls(video['filename']) if video.get('filename') else None
+                        if hls_urls:
+                            video.update(hls_urls)
                 
                 return jsonify({'success': True, 'videos': metadata})
             except Exception as e:
@@ -1498,34 +4295,44 @@ class VideoDownloaderServer:
             
             self.log(f"📹 영상 요청: {filename}")
             
-            # 정확한 파일명으로 찾기 (공용 videos 폴더)
-            filepath = os.path.join(self.VIDEOS_DIR, filename)
-            self.log(f"🔍 파일 경로 확인: {filepath}")
+            # 🗂️ 인덱스 조회 (정확한 파일명 → 유니코드 정규화 → 잘린 파일명의 앞부분 일치)
+            actual_filename = self.video_files.lookup(filename)
+            if actual_filename is None:
+                # 인덱스 이후 직접 넣은 파일 (stat 1회) - VIDEOS_DIR 안(최상위/blobs)의 정규 경로만 인덱스에 추가
+                candidate = self.video_blobs.file_path(filename)
+                if (candidate and os.path.isfile(candidate)
+                        and os.path.relpath(candidate, os.path.realpath(self.VIDEOS_DIR)) == filename
+                        and os.path.dirname(filename) in ('',) + tuple(self.video_files.subdirs)):
+                    actual_filename = filename
+                    self.video_files.add(filename)
             
-            if os.path.exists(filepath):
-                self.log(f"✅ 파일 발견! 전송 시작: {filename}")
-                return send_from_directory(self.VIDEOS_DIR, filename)
+            filepath = self.video_blobs.file_path(actual_filename) if actual_filename else None
+            if not filepath or not os.path.isfile(filepath):
+                if actual_filename:
+                    self.video_files.remove(actual_filename)  # 외부에서 지워진 파일
+                self.log(f"❌ 파일을 찾을 수 없음: {filename}")
+                return jsonify({'error': 'File not found', 'filename': filename}), 404
             
-            # 파일명이 잘린 경우 유연하게 찾기
-            import glob
-            # 파일명의 앞부분으로 검색
-            base_name = os.path.splitext(filename)[0]
-            pattern = os.path.join(self.VIDEOS_DIR, f"{base_name}*.mp4")
-            matching_files = glob.glob(pattern)
+            if actual_filename != filename:
+                self.log(f"✅ 파일명 매칭: '{filename}' → '{actual_filename}'")
+            return self.send_media_file(filepath, mimetypes.guess_type(actual_filename)[0] or 'video/mp4')
+        
+        @self.app.route('/api/hls/<key>/<path:name>')
+        def serve_hls(key, name):
+            """HLS 패키지 (index.m3u8 / 해상도별 세그먼트 / 포스터)"""
+            if not session.get('logged_in'):
+                return jsonify({'success': False, 'message': '로그인 필요'}), 401
             
-            self.log(f"🔍 패턴 검색: {pattern}")
-            self.log(f"🔍 매칭 결과: {len(matching_files)}개 파일")
+            if not self.hls_packager.is_ready(key):
+                return jsonify({'error': 'HLS package not found'}), 404
             
-            if matching_files:
-                # 가장 유사한 파일명 찾기
-                actual_filename = os.path.basename(matching_files[0])
-                self.log(f"✅ 파일명 매칭: '{filename}' → '{actual_filename}'")
-                return send_from_directory(self.VIDEOS_DIR, actual_filename)
+            package_dir = os.path.join(self.hls_packager.hls_dir, key)
+            file_path = os.path.realpath(os.path.join(package_dir, name))
+            if not file_path.startswith(os.path.realpath(package_dir) + os.sep) or not os.path.isfile(file_path):
+                return jsonify({'error': 'File not found'}), 404
             
-            # 파일을 찾을 수 없음
-            self.log(f"❌ 파일을 찾을 수 없음: {filename}")
-            self.log(f"📂 VIDEOS_DIR 내용: {os.listdir(self.VIDEOS_DIR) if os.path.exists(self.VIDEOS_DIR) else '폴더 없음'}")
-            return jsonify({'error': 'File not found', 'filename': filename}), 404
+            mimetype = HLS_MIME_TYPES.get(os.path.splitext(name)[1].lower(), 'application/octet-stream')
+            return self.send_media_file(file_path, mimetype)
         
         @self.app.route('/api/delete/<path:filename>', methods=['DELETE'])
         def delete_video(filename):
@@ -1535,16 +4342,21 @@ class VideoDownloaderServer:
             try:
                 import urllib.parse
                 filename = urllib.parse.unquote(filename)
-                filepath = os.path.join(self.VIDEOS_DIR, filename)
+                username = session.get('username', 'admin')
                 
-                if os.path.exists(filepath):
-                    os.remove(filepath)
+                removed = self.library.delete('metadata', username, filename=filename, kind='video')
                 
-                metadata = self.load_metadata()
-                metadata = [m for m in metadata if m.get('filename') != filename]
-                self.save_metadata(metadata)
+                # 📦 내 참조만 해제 - 다른 사용자(공유받은 사람)가 쓰고 있으면 파일 유지
+                if self.video_blobs.release(filename, username):
+                    self.video_files.remove(filename)
+                    self.hls_packager.remove(filename)
+                    for item in removed:
+                        if item.get('video_id'):
+                            self.media_catalog.discard_field(item['video_id'], 'video_file')
+                    return jsonify({'success': True, 'message': '삭제 완료'})
                 
-                return jsonify({'success': True, 'message': '삭제 완료'})
+                self.log(f"📦 다른 사용자가 사용 중 - 파일 유지: {filename} (참조 {self.video_blobs.ref_count(filename)}명)")
+                return jsonify({'success': True, 'message': '내 갤러리에서 삭제했습니다 (다른 사용자가 사용 중이라 파일은 유지)'})
             except Exception as e:
                 return jsonify({'success': False, 'message': f'삭제 실패: {str(e)}'})
         
@@ -1566,22 +4378,20 @@ class VideoDownloaderServer:
                 self.log(f"📤 공유받은 영상 삭제 요청: {username} - video_id={video_id}")
                 
                 # 메타데이터(갤러리)에서 삭제 (파일은 보존)
-                metadata = self.load_metadata(username)
-                if isinstance(metadata, list):
-                    original_count = len(metadata)
-                    metadata = [m for m in metadata if m.get('video_id') != video_id]
-                    removed_from_gallery = len(metadata) < original_count
-                    self.save_metadata(metadata, username)
-                    if removed_from_gallery:
-                        self.log(f"✅ 갤러리에서 메타데이터 제거: {username} - video_id={video_id}")
+                removed = self.library.delete('metadata', username, video_id=video_id, kind='video')
+                if removed:
+                    self.log(f"✅ 갤러리에서 메타데이터 제거: {username} - video_id={video_id}")
+                
+                # 📦 참조 해제 (원본 소유자가 이미 지웠고 내가 마지막이면 파일도 삭제)
+                for filename in {m.get('filename') for m in removed if m.get('filename')}:
+                    if self.video_blobs.release(filename, username):
+                        self.video_files.remove(filename)
+                        self.hls_packager.remove(filename)
+                        self.media_catalog.discard_field(video_id, 'video_file')
+                        self.log(f"🗑️ 마지막 참조 - 파일 삭제: {filename}")
                 
                 # 재생 목록에서도 삭제 (파일은 보존)
-                playlist = self.load_playlist(username)
-                original_count = len(playlist)
-                playlist = [p for p in playlist if p.get('video_id') != video_id]
-                removed_from_playlist = len(playlist) < original_count
-                self.save_playlist(playlist, username)
-                if removed_from_playlist:
+                if self.library.delete('playlist', username, video_id=video_id):
                     self.log(f"✅ 재생 목록에서 메타데이터 제거: {username} - video_id={video_id}")
                 
                 self.log(f"✅ 공유받은 영상 삭제 완료 (원본 파일 보호됨): {username}")
@@ -1604,61 +4414,19 @@ class VideoDownloaderServer:
                 playlist = self.load_playlist(username)
                 favorites = self.load_favorites(username)
                 
-                # playlist가 리스트인지 확인
-                if not isinstance(playlist, list):
-                    playlist = []
-                
-                # 즐겨찾기 상태 추가 (최적화)
-                needs_save = False  # video_id 추가로 변경되었는지 추적
+                # 즐겨찾기 상태 추가 (video_id는 저장할 때 채워져 있음 - 정규식/저장 없음)
+                favorite_video_ids = {fav.get('video_id') for fav in favorites if fav.get('video_id')}
+                favorite_count = 0
+                for item in playlist:
+                    is_fav = bool(item.get('video_id')) and item['video_id'] in favorite_video_ids
+                    item['is_favorite'] = is_fav
+                    if is_fav:
+                        favorite_count += 1
                 
-                if len(favorites) > 0:
-                    favorite_video_ids = {fav.get('video_id') for fav in favorites if fav.get('video_id')}
-                    
-                    import re
-                    favorite_count = 0
-                    
-                    # video_id 추출 및 즐겨찾기 매칭
-                    for item in playlist:
-                        if isinstance(item, dict):
-                            # video_id가 이미 있으면 추출 스킵 (성능 향상)
-                            video_id = item.get('video_id')
-                            if not video_id and item.get('url'):
-                                url = item.get('url', '')
-                                # 간단한 정규식으로 최적화
-                                match = re.search(r'(?:v=|youtu\.be\/)([a-zA-Z0-9_-]{11})', url)
-                                if match:
-                                    video_id = match.group(1)
-                                    item['video_id'] = video_id
-                                    needs_save = True  # playlist.json 업데이트 필요
-                            
-                            # 즐겨찾기 여부 확인
-                            is_fav = video_id and video_id in favorite_video_ids
-                            item['is_favorite'] = is_fav
-                            if is_fav:
-                                favorite_count += 1
-                    
-                    # 즐겨찾기 우선 정렬 (즐겨찾기가 있을 때만)
-                    if favorite_count > 0:
-                        playlist.sort(key=lambda x: (not x.get('is_favorite', False), x.get('title', '')))
-                        self.log(f"⭐ 즐겨찾기 {favorite_count}개")
-                else:
-                    # 즐겨찾기가 없으면 즐겨찾기 매칭만 스킵 (video_id는 추출)
-                    import re
-                    for item in playlist:
-                        if isinstance(item, dict):
-                            item['is_favorite'] = False
-                            # video_id가 없으면 추출 후 저장
-                            if not item.get('video_id') and item.get('url'):
-                                url = item.get('url', '')
-                                match = re.search(r'(?:v=|youtu\.be\/)([a-zA-Z0-9_-]{11})', url)
-                                if match:
-                                    item['video_id'] = match.group(1)
-                                    needs_save = True
-                
-                # video_id가 새로 추가된 항목이 있으면 저장 (다음부터는 빠름)
-                if needs_save:
-                    self.save_playlist(playlist, username)
-                    self.log(f"💾 video_id 자동 저장 완료 (다음부터 빠른 로딩)")
+                # 즐겨찾기 우선 정렬 (즐겨찾기가 있을 때만)
+                if favorite_count > 0:
+                    playlist.sort(key=lambda x: (not x.get('is_favorite', False), x.get('title', '')))
+                    self.log(f"⭐ 즐겨찾기 {favorite_count}개")
                 
                 return jsonify({'success': True, 'playlist': playlist})
             except Exception as e:
@@ -1681,43 +4449,35 @@ class VideoDownloaderServer:
                 return jsonify({'success': False, 'message': 'video_id 필요'})
             
             username = session.get('username', 'admin')
-            favorites = self.load_favorites(username)
-            
-            # 이미 즐겨찾기에 있는지 확인
-            existing_favorite = None
-            for fav in favorites:
-                if fav.get('video_id') == video_id:
-                    existing_favorite = fav
-                    break
             
-            if existing_favorite:
-                # 즐겨찾기에서 제거
-                favorites = [fav for fav in favorites if fav.get('video_id') != video_id]
-                self.save_favorites(favorites, username)
-                self.log(f"⭐ 즐겨찾기 제거: {title}")
-                return jsonify({
-                    'success': True,
-                    'message': '즐겨찾기에서 제거했습니다',
-                    'is_favorite': False,
-                    'favorites_count': len(favorites)
-                })
-            else:
-                # 즐겨찾기에 추가
-                favorite_item = {
-                    'video_id': video_id,
-                    'title': title,
-                    'url': url,
-                    'added_at': datetime.now().isoformat()
-                }
-                favorites.insert(0, favorite_item)  # 상단에 추가
-                self.save_favorites(favorites, username)
-                self.log(f"⭐ 즐겨찾기 추가: {title}")
-                return jsonify({
-                    'success': True,
-                    'message': '즐겨찾기에 추가했습니다',
-                    'is_favorite': True,
-                    'favorites_count': len(favorites)
-                })
+            with self.library.user_lock(username):
+                # 이미 즐겨찾기에 있는지 확인 (🗃️ 인덱스 조회)
+                if self.library.exists('favorites', username, video_id=video_id):
+                    # 즐겨찾기에서 제거
+                    self.library.delete('favorites', username, video_id=video_id)
+                    self.log(f"⭐ 즐겨찾기 제거: {title}")
+                    return jsonify({
+                        'success': True,
+                        'message': '즐겨찾기에서 제거했습니다',
+                        'is_favorite': False,
+                        'favorites_count': self.library.count('favorites', username)
+                    })
+                else:
+                    # 즐겨찾기에 추가
+                    favorite_item = {
+                        'video_id': video_id,
+                        'title': title,
+                        'url': url,
+                        'added_at': datetime.now().isoformat()
+                    }
+                    self.library.insert('favorites', username, favorite_item)  # 상단에 추가
+                    self.log(f"⭐ 즐겨찾기 추가: {title}")
+                    return jsonify({
+                        'success': True,
+                        'message': '즐겨찾기에 추가했습니다',
+                        'is_favorite': True,
+                        'favorites_count': self.library.count('favorites', username)
+                    })
         
         @self.app.route('/api/favorites', methods=['GET'])
         def get_favorites():
@@ -1738,114 +4498,106 @@ class VideoDownloaderServer:
             if not session.get('logged_in'):
                 return jsonify({'success': False, 'message': '로그인 필요'})
             
-            data = request.get_json()
-            url = data.get('url')
-            title = data.get('title')
-            thumbnail = data.get('thumbnail', '')
-            duration = data.get('duration', 0)
-            
-            if not url or not title:
+            item = self.make_playlist_entry(request.get_json() or {})
+            if not item:
                 return jsonify({'success': False, 'message': '필수 정보 누락'})
             
-            playlist = self.load_playlist()
+            username = session.get('username', 'admin')
+            with self.library.user_lock(username):  # 중복 확인 후 추가 사이에 끼어들지 않도록
+                if self.library.exists('playlist', username, url=item['url']):
+                    return jsonify({'success': False, 'message': '이미 목록에 있습니다'})
+                item = self.library.insert('playlist', username, item)
+            self.media_catalog.update(item['video_id'], title=item['title'], thumbnail=item['thumbnail'],
+                                      duration=item['duration'])
+            return jsonify({'success': True, 'message': '재생 목록에 추가됨', 'item': item})
+        
+        @self.app.route('/api/playlist/items/<item_id>', methods=['DELETE'])
+        def delete_from_playlist(item_id):
+            if not session.get('logged_in'):
+                return jsonify({'success': False, 'message': '로그인 필요'})
             
-            if any(item['url'] == url for item in playlist):
-                return jsonify({'success': False, 'message': '이미 목록에 있습니다'})
+            try:
+                # 🗃️ item_id로 해당 행만 삭제 (다른 기기에서 목록이 바뀌어도 같은 항목)
+                removed = self.library.delete('playlist', session.get('username', 'admin'), item_id=item_id)
+                if not removed:
+                    return jsonify({'success': False, 'message': '이미 삭제되었거나 없는 항목입니다'})
+                deleted_item = removed[0]
+                
+                # 🔒 공유받은 항목인지 확인
+                if deleted_item.get('shared_from') is not None:
+                    # 공유받은 음원: 목록에서만 삭제, 캐시 파일은 유지
+                    self.log(f"📤 공유받은 음원 삭제 (캐시 유지): {deleted_item.get('title', '')}")
+                    
+                    return jsonify({
+                        'success': True, 
+                        'message': '공유받은 음원을 목록에서 제거했습니다 (캐시 파일은 유지됨)',
+                        'cache_deleted': False,
+                        'cache_size': 0
+                    })
+                
+                # 본인이 추가한 음원: 캐시 파일도 함께 삭제
+                cache_size_mb = self.release_playlist_audio(deleted_item)
+                return jsonify({
+                    'success': True, 
+                    'message': '삭제 완료',
+                    'cache_deleted': cache_size_mb is not None,
+                    'cache_size': cache_size_mb or 0
+                })
+            except Exception as e:
+                return jsonify({'success': False, 'message': f'삭제 실패: {str(e)}'})
+        
+        @self.app.route('/api/playlist/batch', methods=['POST'])
+        def batch_playlist():
+            """추가/이동/삭제 여러 개를 한 번에 (item_id 기준, 바뀐 행만 저장)"""
+            if not session.get('logged_in'):
+                return jsonify({'success': False, 'message': '로그인 필요'})
             
-            # video_id 추출 (저장해두면 나중에 재추출 안 해도 됨 - 성능 향상)
-            import re
-            video_id = None
-            match = re.search(r'(?:v=|youtu\.be\/)([a-zA-Z0-9_-]{11})', url)
-            if match:
-                video_id = match.group(1)
+            data = request.get_json() or {}
+            username = session.get('username', 'admin')
+            try:
+                with self.library.user_lock(username):
+                    ops = []
+                    batch_urls = set()
+                    for op in data.get('ops') or []:
+                        if op.get('op') == 'insert':
+                            item = self.make_playlist_entry(op.get('item') or {})
+                            # 필수 정보 누락 / 이미 목록에 있음 → 건너뜀
+                            if not item or item['url'] in batch_urls or self.library.exists('playlist', username, url=item['url']):
+                                continue
+                            batch_urls.add(item['url'])
+                            op = dict(op, item=item)
+                        ops.append(op)
+                    inserted, deleted = self.library.apply('playlist', username, ops)
+            except (ValueError, AttributeError) as e:
+                return jsonify({'success': False, 'message': f'적용 실패: {str(e)}'})
             
-            playlist.insert(0, {
-                'url': url,
-                'title': title,
-                'thumbnail': thumbnail,
-                'duration': duration,
-                'video_id': video_id,  # video_id 미리 저장 (성능 최적화)
-                'added_at': datetime.now().isoformat()
+            for item in inserted:
+                self.media_catalog.update(item['video_id'], title=item['title'], thumbnail=item['thumbnail'],
+                                          duration=item['duration'])
+            cache_sizes = [size for size in (self.release_playlist_audio(item, save=False) for item in deleted)
+                           if size is not None]
+            if self.audio_cache.dirty:
+                self.audio_cache.save_sidecar()
+            return jsonify({
+                'success': True,
+                'inserted': inserted,
+                'deleted': len(deleted),
+                'cache_deleted': len(cache_sizes),
+                'cache_size': round(sum(cache_sizes), 1)
             })
-            
-            self.save_playlist(playlist)
-            return jsonify({'success': True, 'message': '재생 목록에 추가됨'})
         
-        @self.app.route('/api/playlist/<int:index>', methods=['DELETE'])
-        def delete_from_playlist(index):
+        @self.app.route('/api/playlist/order', methods=['PUT'])
+        def reorder_playlist():
+            """item_id 순서대로 재배치 (position이 바뀐 항목만 저장)"""
             if not session.get('logged_in'):
                 return jsonify({'success': False, 'message': '로그인 필요'})
             
-            try:
-                # URL에서 video_id 추출 함수
-                def extract_video_id(url):
-                    import re
-                    patterns = [
-                        r'(?:youtube\.com\/watch\?v=|youtu\.be\/)([a-zA-Z0-9_-]{11})',
-                        r'youtube\.com\/embed\/([a-zA-Z0-9_-]{11})',
-                    ]
-                    for pattern in patterns:
-                        match = re.search(pattern, url)
-                        if match:
-                            return match.group(1)
-                    return None
-                
-                playlist = self.load_playlist()
-                cache_deleted = False
-                cache_size_mb = 0
-                
-                if 0 <= index < len(playlist):
-                    deleted_item = playlist.pop(index)
-                    
-                    # 🔒 공유받은 항목인지 확인
-                    is_shared = deleted_item.get('shared_from') is not None
-                    
-                    if is_shared:
-                        # 공유받은 음원: 목록에서만 삭제, 캐시 파일은 유지
-                        self.log(f"📤 공유받은 음원 삭제 (캐시 유지): {deleted_item.get('title', '')}")
-                        self.save_playlist(playlist)
-                        
-                        return jsonify({
-                            'success': True, 
-                            'message': '공유받은 음원을 목록에서 제거했습니다 (캐시 파일은 유지됨)',
-                            'cache_deleted': False,
-                            'cache_size': 0
-                        })
-                    else:
-                        # 본인이 추가한 음원: 캐시 파일도 함께 삭제
-                        # URL에서 video_id 추출
-                        data = request.get_json() or {}
-                        url = data.get('url', '') or deleted_item.get('url', '')
-                        
-                        if url:
-                            video_id = extract_video_id(url)
-                            if video_id:
-                                # temp_audio 폴더에서 해당 파일 찾아서 삭제
-                                temp_dir = os.path.join(os.path.dirname(__file__), 'temp_audio')
-                                for ext in ['m4a', 'webm', 'opus', 'mp3', 'mp4']:
-                                    file_path = os.path.join(temp_dir, f"{video_id}.{ext}")
-                                    if os.path.exists(file_path):
-                                        try:
-                                            file_size = os.path.getsize(file_path) / (1024 * 1024)  # MB
-                                            os.remove(file_path)
-                                            cache_deleted = True
-                                            cache_size_mb = round(file_size, 1)
-                                            self.log(f"🗑️ 캐시 파일 삭제: {file_path} ({cache_size_mb}MB)")
-                                        except Exception as e:
-                                            self.log(f"⚠️ 캐시 파일 삭제 실패: {e}")
-                        
-                        self.save_playlist(playlist)
-                        
-                        return jsonify({
-                            'success': True, 
-                            'message': '삭제 완료',
-                            'cache_deleted': cache_deleted,
-                            'cache_size': cache_size_mb
-                        })
-                else:
-                    return jsonify({'success': False, 'message': '잘못된 인덱스'})
-            except Exception as e:
-                return jsonify({'success': False, 'message': f'삭제 실패: {str(e)}'})
+            item_ids = (request.get_json() or {}).get('item_ids')
+            if not isinstance(item_ids, list):
+                return jsonify({'success': False, 'message': '필수 정보 누락'})
+            
+            changed = self.library.reorder('playlist', session.get('username', 'admin'), item_ids)
+            return jsonify({'success': True, 'changed': changed})
         
         @self.app.route('/api/playlist/clear', methods=['DELETE'])
         def clear_playlist():
@@ -1853,53 +4605,32 @@ class VideoDownloaderServer:
                 return jsonify({'success': False, 'message': '로그인 필요'})
             
             try:
-                # URL에서 video_id 추출 함수
-                def extract_video_id(url):
-                    import re
-                    patterns = [
-                        r'(?:youtube\.com\/watch\?v=|youtu\.be\/)([a-zA-Z0-9_-]{11})',
-                        r'youtube\.com\/embed\/([a-zA-Z0-9_-]{11})',
-                    ]
-                    for pattern in patterns:
-                        match = re.search(pattern, url)
-                        if match:
-                            return match.group(1)
-                    return None
-                
-                # 플레이리스트 항목의 캐시 파일 삭제 (공유받은 항목 제외)
-                playlist = self.load_playlist()
-                cache_deleted_count = 0
-                total_cache_size_mb = 0
-                shared_items_count = 0
-                
-                temp_dir = os.path.join(os.path.dirname(__file__), 'temp_audio')
-                
-                for item in playlist:
-                    # 🔒 공유받은 항목은 캐시 삭제 안 함
-                    is_shared = item.get('shared_from') is not None
-                    if is_shared:
-                        shared_items_count += 1
-                        self.log(f"📤 공유받은 음원 캐시 유지: {item.get('title', '')}")
-                        continue
+                with self.library.user_lock(session.get('username', 'admin')):
+                    # 플레이리스트 항목의 캐시 파일 삭제 (공유받은 항목 제외)
+                    playlist = self.load_playlist()
+                    cache_deleted_count = 0
+                    total_cache_size_mb = 0
+                    shared_items_count = 0
                     
-                    # 본인이 추가한 항목만 캐시 삭제
-                    url = item.get('url', '')
-                    if url:
-                        video_id = extract_video_id(url)
-                        if video_id:
-                            for ext in ['m4a', 'webm', 'opus', 'mp3', 'mp4']:
-                                file_path = os.path.join(temp_dir, f"{video_id}.{ext}")
-                                if os.path.exists(file_path):
-                                    try:
-                                        file_size = os.path.getsize(file_path) / (1024 * 1024)  # MB
-                                        os.remove(file_path)
-                                        cache_deleted_count += 1
-                                        total_cache_size_mb += file_size
-                                        self.log(f"🗑️ 캐시 파일 삭제: {file_path} ({file_size:.1f}MB)")
-                                    except Exception as e:
-                                        self.log(f"⚠️ 캐시 파일 삭제 실패: {e}")
+                    for item in playlist:
+                        # 🔒 공유받은 항목은 캐시 삭제 안 함
+                        is_shared = item.get('shared_from') is not None
+                        if is_shared:
+                            shared_items_count += 1
+                            self.log(f"📤 공유받은 음원 캐시 유지: {item.get('title', '')}")
+                            continue
+                        
+                        # 본인이 추가한 항목만 캐시 삭제 (🎵 인덱스 조회 - 캐시에 없는 항목은 파일 확인 없이 넘어감)
+                        file_size = self.release_playlist_audio(item, save=False)
+                        if file_size is not None:
+                            cache_deleted_count += 1
+                            total_cache_size_mb += file_size
+                    
+                    self.save_playlist([])
                 
-                self.save_playlist([])
+                # 🎵 캐시 인덱스는 항목마다가 아니라 한 번만 저장 (사용자 잠금 밖에서)
+                if self.audio_cache.dirty:
+                    self.audio_cache.save_sidecar()
                 
                 message = '재생 목록 비움'
                 if shared_items_count > 0:
@@ -2019,73 +4750,93 @@ class VideoDownloaderServer:
                 return jsonify({'success': False, 'message': f'공유 실패: {str(e)}'})
     
     def load_metadata(self, username=None):
-        """메타데이터 로드 (사용자별)"""
+        """갤러리 영상 메타데이터 로드 (사용자별) - 항상 [정보] (kind='video')"""
         if username is None:
             username = session.get('username', 'admin')
         
-        metadata_file = self.get_user_metadata_file(username)
-        if os.path.exists(metadata_file):
-            try:
-                with open(metadata_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except:
-                return {}
-        return {}
+        return [item for _, item in self.library.load('metadata', username, kind='video')]
+    
+    def load_audio_metadata(self, username=None):
+        """음원 메타데이터 로드 (사용자별) - [정보] (kind='audio', 항목마다 video_id 포함)"""
+        if username is None:
+            username = session.get('username', 'admin')
+        
+        return [item for _, item in self.library.load('metadata', username, kind='audio')]
     
     def save_metadata(self, metadata, username=None):
-        """메타데이터 저장 (사용자별)"""
+        """갤러리 영상 메타데이터 저장 (사용자별) - 전체 교체, 부분 변경은 self.library 사용"""
         if username is None:
             username = session.get('username', 'admin')
         
-        metadata_file = self.get_user_metadata_file(username)
-        with open(metadata_file, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        self.library.replace('metadata', username, [(None, item) for item in metadata if isinstance(item, dict)],
+                             kind='video')
     
     def load_playlist(self, username=None):
         """재생 목록 로드 (사용자별)"""
         if username is None:
             username = session.get('username', 'admin')
         
-        playlist_file = self.get_user_playlist_file(username)
-        if os.path.exists(playlist_file):
-            try:
-                with open(playlist_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except:
-                return []
-        return []
+        return [item for _, item in self.library.load('playlist', username)]
     
     def save_playlist(self, playlist, username=None):
-        """재생 목록 저장 (사용자별)"""
+        """재생 목록 저장 (사용자별) - 전체 교체"""
         if username is None:
             username = session.get('username', 'admin')
         
-        playlist_file = self.get_user_playlist_file(username)
-        with open(playlist_file, 'w', encoding='utf-8') as f:
-            json.dump(playlist, f, ensure_ascii=False, indent=2)
+        self.library.replace('playlist', username, [(None, item) for item in playlist])
     
     def load_favorites(self, username=None):
         """사용자별 즐겨찾기 목록 로드"""
         if username is None:
             username = session.get('username', 'admin')
         
-        favorites_file = self.get_user_favorites_file(username)
-        if os.path.exists(favorites_file):
-            try:
-                with open(favorites_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except:
-                return []
-        return []
+        return [item for _, item in self.library.load('favorites', username)]
     
     def save_favorites(self, favorites, username=None):
-        """사용자별 즐겨찾기 목록 저장"""
+        """사용자별 즐겨찾기 목록 저장 - 전체 교체"""
         if username is None:
             username = session.get('username', 'admin')
         
-        favorites_file = self.get_user_favorites_file(username)
-        with open(favorites_file, 'w', encoding='utf-8') as f:
-            json.dump(favorites, f, ensure_ascii=False, indent=2)
+        self.library.replace('favorites', username, [(None, item) for item in favorites])
+    
+    def make_playlist_entry(self, data):
+        """요청 데이터 → 재생 목록 항목 (url/title이 없으면 None)"""
+        url = data.get('url')
+        title = data.get('title')
+        if not url or not title:
+            return None
+        
+        return {
+            'url': url,
+            'title': title,
+            'thumbnail': data.get('thumbnail', ''),
+            'duration': data.get('duration', 0),
+            'video_id': extract_video_id(url),  # video_id 미리 저장 (성능 최적화)
+            'added_at': datetime.now().isoformat()
+        }
+    
+    def release_playlist_audio(self, item, save=True):
+        """삭제한 재생 목록 항목의 temp_audio 캐시 삭제 (공유받은 항목은 유지) - 삭제한 크기(MB), 없으면 None
+        (여러 항목을 지울 때는 save=False로 부르고 끝에 audio_cache.save_sidecar() 한 번)"""
+        if item.get('shared_from') is not None:
+            return None
+        
+        video_id = self.item_video_id(item)
+        if not video_id:
+            return None
+        
+        # temp_audio 캐시에서 해당 파일 삭제 (🎵 인덱스 조회)
+        try:
+            removed = self.audio_cache.remove(video_id, save=save)
+        except Exception as e:
+            self.log(f"⚠️ 캐시 파일 삭제 실패: {e}")
+            return None
+        if not removed:
+            return None
+        self.media_catalog.discard_field(video_id, 'audio_file')
+        cache_size_mb = round(removed['size'] / (1024 * 1024), 1)  # MB
+        self.log(f"🗑️ 캐시 파일 삭제: {removed['path']} ({cache_size_mb}MB)")
+        return cache_size_mb
     
     def sanitize_filename(self, filename):
         """파일명 정리"""
@@ -2095,72 +4846,29 @@ class VideoDownloaderServer:
     def download_youtube(self, url):
         """유튜브 영상 다운로드 (고화질) - 쇼츠/일반 영상 모두 지원"""
         try:
-            # 다운로드 전 파일 목록 확인
-            before_files = set(os.listdir(self.VIDEOS_DIR)) if os.path.exists(self.VIDEOS_DIR) else set()
-            
-            # 🎬 최고 화질 다운로드 설정 (쇼츠 최적화)
-            ydl_opts = {
-                # 🚀 원본 최고 화질 다운로드 (화질 제한 없음!)
-                # 1순위: 영상+음성 분리 다운로드 후 병합 (최고 화질, 쇼츠 포함)
-                # 2순위: 통합 파일 중 최고 화질
-                # webm 포맷도 포함 (쇼츠는 webm이 더 고화질인 경우가 많음)
-                'format': (
-                    'bestvideo[ext=mp4]+bestaudio[ext=m4a]/'  # 1순위: mp4 영상+음성
-                    'bestvideo+bestaudio/'                     # 2순위: 모든 포맷 최고화질
-                    'best[ext=mp4]/'                           # 3순위: mp4 통합 파일
-                    'best'                                     # 4순위: 모든 포맷 최고
-                ),
-                'outtmpl': os.path.join(self.VIDEOS_DIR, '%(title)s.%(ext)s'),
-                'quiet': True,
-                'merge_output_format': 'mp4',  # 영상+음성 합칠 때 mp4로
-                'postprocessors': [{
-                    'key': 'FFmpegVideoConvertor',
-                    'preferedformat': 'mp4',
-                }],
-                # 쇼츠 최적화 옵션
-                'nocheckcertificate': True,
-                'prefer_free_formats': False,  # 유료 포맷(고화질) 우선
-                'youtube_include_dash_manifest': True,  # DASH 매니페스트 포함 (고화질)
-            }
+            username = session.get('username', 'admin')
+            video_id = extract_video_id(url)
             
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                
-                title = info.get('title', 'Unknown')
-                
-                # 다운로드 후 파일 목록 확인하여 실제 파일명 찾기
-                after_files = set(os.listdir(self.VIDEOS_DIR))
-                new_files = after_files - before_files
-                
-                # 실제 다운로드된 파일명 찾기
-                actual_filename = None
-                for f in new_files:
-                    if f.endswith(('.mp4', '.webm', '.mkv')):
-                        actual_filename = f
-                        break
-                
-                # 파일명을 찾지 못하면 기존 방식 사용
-                if not actual_filename:
-                    actual_filename = f"{self.sanitize_filename(title)}.{info.get('ext', 'mp4')}"
-                
-                metadata = self.load_metadata()
-                metadata.insert(0, {
-                    'filename': actual_filename,
-                    'title': title,
-                    'url': url,
-                    'platform': 'youtube',
-                    'thumbnail': info.get('thumbnail', ''),
-                    'duration': info.get('duration', 0),
-                    'downloaded_at': datetime.now().isoformat()
-                })
-                self.save_metadata(metadata)
-                
-                return {
-                    'success': True,
-                    'filename': actual_filename,
-                    'title': title,
-                    'message': '유튜브 다운로드 완료!'
-                }
+            # ♻️ 이미 저장소에 있는 영상 → 다운로드 없이 메타데이터만 추가
+            existing = self.video_blobs.find(VideoBlobStore.blob_key('youtube', video_id)) if video_id else None
+            if existing:
+                entry = self.media_catalog.get(video_id) or {}
+                if not entry.get('title'):
+                    info = self.extract_media_info(url, content='video')
+                    self.media_catalog.update_from_info(info, video_file=existing)
+                    entry = self.media_catalog.get(video_id) or {}
+                self.log(f"♻️ 이미 받은 영상 - 메타데이터만 추가: {existing}")
+                return self.add_video_to_gallery(username, existing, entry.get('title', 'Unknown'), url, 'youtube',
+                                                 entry.get('thumbnail', ''), entry.get('duration', 0), video_id)
+            
+            # 🤝 같은 영상을 동시에 다운로드하면 실제 다운로드는 1회만, 결과 공유
+            download_key = ('download_youtube', video_id or url)
+            info, actual_filename = self.single_flight.do(download_key, self.fetch_youtube_video, url)
+            self.media_catalog.update_from_info(info, video_file=actual_filename)
+            
+            # 메타데이터는 요청한 사용자마다 저장
+            return self.add_video_to_gallery(username, actual_filename, info.get('title', 'Unknown'), url, 'youtube',
+                                             info.get('thumbnail', ''), info.get('duration', 0), info.get('id'))
         except Exception as e:
             return {
                 'success': False,
@@ -2168,55 +4876,107 @@ class VideoDownloaderServer:
                 'message': f'다운로드 실패: {str(e)}'
             }
     
+    def add_video_to_gallery(self, username, filename, title, url, platform, thumbnail, duration, video_id=None):
+        """사용자 갤러리에 추가 + 저장소 참조 등록 (이미 있으면 건너뜀)"""
+        with self.library.user_lock(username):
+            already_in_gallery = self.library.exists('metadata', username, filename=filename, kind='video')
+            if not already_in_gallery:
+                self.library.insert('metadata', username, {
+                    'filename': filename,
+                    'title': title,
+                    'url': url,
+                    'platform': platform,
+                    'thumbnail': thumbnail,
+                    'duration': duration,
+                    'video_id': video_id,
+                    'downloaded_at': datetime.now().isoformat()
+                })
+            self.video_blobs.add_ref(filename, username)
+        self.video_files.add(filename)
+        self.hls_packager.submit(filename)  # 🎞️ HLS 변환 예약 (설정이 켜져 있을 때만)
+        
+        platform_name = '유튜브' if platform == 'youtube' else '인스타그램'
+        return {
+            'success': True,
+            'filename': filename,
+            'title': title,
+            'message': f'{platform_name} 다운로드 완료!' if not already_in_gallery else '이미 갤러리에 있습니다'
+        }
+    
+    def fetch_youtube_video(self, url):
+        """yt-dlp로 공용 저장소에 실제 다운로드 후 (info, 실제 파일명) 반환"""
+        # 🎬 최고 화질 다운로드 설정 (쇼츠 최적화)
+        ydl_opts = {
+            # 🚀 원본 최고 화질 다운로드 (화질 제한 없음!)
+            # 1순위: 영상+음성 분리 다운로드 후 병합 (최고 화질, 쇼츠 포함)
+            # 2순위: 통합 파일 중 최고 화질
+            # webm 포맷도 포함 (쇼츠는 webm이 더 고화질인 경우가 많음)
+            'format': (
+                'bestvideo[ext=mp4]+bestaudio[ext=m4a]/'  # 1순위: mp4 영상+음성
+                'bestvideo+bestaudio/'                     # 2순위: 모든 포맷 최고화질
+                'best[ext=mp4]/'                           # 3순위: mp4 통합 파일
+                'best'                                     # 4순위: 모든 포맷 최고
+            ),
+            # 📦 blobs/youtube_<video_id>_best.mp4 (제목과 무관하게 영상당 1개 파일)
+            'outtmpl': self.video_blobs.output_template('youtube'),
+            'quiet': True,
+            'merge_output_format': 'mp4',  # 영상+음성 합칠 때 mp4로
+            'postprocessors': [{
+                'key': 'FFmpegVideoConvertor',
+                'preferedformat': 'mp4',
+            }],
+            # 쇼츠 최적화 옵션
+            'nocheckcertificate': True,
+            'prefer_free_formats': False,  # 유료 포맷(고화질) 우선
+            'youtube_include_dash_manifest': True,  # DASH 매니페스트 포함 (고화질)
+        }
+        
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(url, download=True)
+            
+            # 저장소 키로 실제 파일명 찾기 (변환 후 확장자가 바뀔 수 있음)
+            key = VideoBlobStore.blob_key('youtube', info.get('id'))
+            actual_filename = self.video_blobs.find(key) or f"{VIDEO_BLOBS_DIR}/{key}.{info.get('ext', 'mp4')}"
+            
+            return info, actual_filename
+    
     def download_instagram(self, url):
         """인스타그램 영상 다운로드"""
         try:
+            shortcode = extract_video_id(url, platform='instagram')
+            if not shortcode:
+                return {'success': False, 'message': '잘못된 인스타그램 URL'}
+            
+            key = VideoBlobStore.blob_key('instagram', shortcode)
+            
+            # 📦 blobs/instagram_<shortcode>_best.mp4 (캡션/메타 파일은 저장 안 함)
             L = instaloader.Instaloader(
-                dirname_pattern=self.VIDEOS_DIR,
-                filename_pattern='{date_utc}_UTC',
+                dirname_pattern=self.video_blobs.blob_dir,
+                filename_pattern=key,
                 download_pictures=False,
                 download_videos=True,
                 download_video_thumbnails=False,
+                save_metadata=False,
+                post_metadata_txt_pattern='',
             )
-            
-            shortcode_match = re.search(r'/(p|reel|tv)/([A-Za-z0-9_-]+)', url)
-            if not shortcode_match:
-                return {'success': False, 'message': '잘못된 인스타그램 URL'}
-            
-            shortcode = shortcode_match.group(2)
             post = instaloader.Post.from_shortcode(L.context, shortcode)
             
             if post.is_video:
-                before_files = set(os.listdir(self.VIDEOS_DIR))
-                L.download_post(post, target=self.VIDEOS_DIR)
-                after_files = set(os.listdir(self.VIDEOS_DIR))
-                new_files = after_files - before_files
-                
-                video_file = None
-                for f in new_files:
-                    if f.endswith(('.mp4', '.mov')):
-                        video_file = f
-                        break
+                video_file = self.video_blobs.find(key)
+                if video_file:
+                    # ♻️ 이미 받은 영상 → 메타데이터만 추가
+                    self.log(f"♻️ 이미 받은 영상 - 메타데이터만 추가: {video_file}")
+                else:
+                    self.single_flight.do(('download_instagram', shortcode), L.download_post, post,
+                                          target=self.video_blobs.blob_dir)
+                    video_file = self.video_blobs.find(key)
                 
                 if video_file:
-                    metadata = self.load_metadata()
-                    metadata.insert(0, {
-                        'filename': video_file,
-                        'title': post.caption[:100] if post.caption else 'Instagram Video',
-                        'url': url,
-                        'platform': 'instagram',
-                        'thumbnail': post.url,
-                        'duration': 0,
-                        'downloaded_at': datetime.now().isoformat()
-                    })
-                    self.save_metadata(metadata)
-                    
-                    return {
-                        'success': True,
-                        'filename': video_file,
-                        'title': 'Instagram Video',
-                        'message': '인스타그램 다운로드 완료!'
-                    }
+                    return self.add_video_to_gallery(
+                        session.get('username', 'admin'), video_file,
+                        post.caption[:100] if post.caption else 'Instagram Video',
+                        url, 'instagram', post.url, 0, shortcode
+                    )
             
             return {'success': False, 'message': '영상이 없습니다'}
         except Exception as e:
@@ -2252,6 +5012,20 @@ class VideoDownloaderServer:
         # 🔋 macOS 잠금 방지 해제
         self.allow_sleep()
         
+        # 📥 대기/진행 중 다운로드 정리
+        self.download_scheduler.stop()
+        
+        # 🍎 대기 중인 Safari/HLS 변환 취소
+        self.safari_remuxer.stop()
+        self.hls_packager.stop()
+        
+        # 📚 카탈로그 남은 변경 저장
+        self.media_catalog.flush()
+        
+        # 💾 캐시 점검 스레드 종료
+        self.cache_maintenance_stopped = True
+        self.cache_maintenance_event.set()
+        
         if hasattr(self, 'server_instance') and self.server_instance:
             self.server_instance.shutdown()
 
@@ -2268,9 +5042,13 @@ class ServerWorker(QThread):
     error_signal = pyqtSignal(str)
     stopped_signal = pyqtSignal()
     
-    def __init__(self, port):
+    def __init__(self, port, download_workers=DOWNLOAD_WORKERS, audio_cache_budget_gb=AUDIO_CACHE_BUDGET_GB,
+                 hls_packaging=HLS_PACKAGING_ENABLED):
         super().__init__()
         self.port = port
+        self.download_workers = download_workers
+        self.audio_cache_budget_gb = audio_cache_budget_gb
+        self.hls_packaging = hls_packaging
         self.server = None
         self.should_stop = False
     
@@ -2283,7 +5061,10 @@ class ServerWorker(QThread):
             def gui_log_callback(message):
                 self.log_signal.emit(message)
             
-            self.server = VideoDownloaderServer(self.port, gui_log_callback=gui_log_callback)
+            self.server = VideoDownloaderServer(self.port, gui_log_callback=gui_log_callback,
+                                                download_workers=self.download_workers,
+                                                audio_cache_budget_gb=self.audio_cache_budget_gb,
+                                                hls_packaging=self.hls_packaging)
             
             self.log_signal.emit(f"✅ 서버 시작: {self.port}번 포트")
             self.log_signal.emit(f"🌐 http://localhost:{self.port}")
@@ -2503,9 +5284,8 @@ class ContentShareDialog(QDialog):
     def load_content(self):
         """컨텐츠 로드"""
         self.all_content = []
-        metadata = self.server.load_metadata(self.from_username)
-        
-        for video_id, info in metadata.items():
+        for info in self.server.load_audio_metadata(self.from_username):
+            video_id = info.get('video_id')
             title = info.get('title', 'Unknown')
             duration = info.get('duration', 0)
             thumbnail = info.get('thumbnail', '')
@@ -2866,6 +5646,60 @@ class ServerControllerWindow(QMainWindow):
         port_layout.addStretch()
         
         settings_layout.addLayout(port_layout)
+        
+        # 📥 동시 다운로드 수 (실행 중에도 변경 가능)
+        workers_layout = QHBoxLayout()
+        workers_label = QLabel('동시 다운로드:')
+        workers_label.setMinimumWidth(80)
+        workers_layout.addWidget(workers_label)
+        
+        self.download_workers_input = QSpinBox()
+        self.download_workers_input.setMinimum(1)
+        self.download_workers_input.setMaximum(8)
+        self.download_workers_input.setValue(DOWNLOAD_WORKERS)
+        self.download_workers_input.setStyleSheet("""
+            QSpinBox {
+                padding: 8px;
+                font-size: 14px;
+                border: 2px solid #e0e0e0;
+                border-radius: 6px;
+            }
+        """)
+        self.download_workers_input.valueChanged.connect(self.change_download_workers)
+        workers_layout.addWidget(self.download_workers_input)
+        workers_layout.addStretch()
+        
+        settings_layout.addLayout(workers_layout)
+        
+        # 💾 음원 캐시 용량 (넘으면 오래 안 들은 파일부터 삭제)
+        cache_budget_layout = QHBoxLayout()
+        cache_budget_label = QLabel('캐시 용량(GB):')
+        cache_budget_label.setMinimumWidth(80)
+        cache_budget_layout.addWidget(cache_budget_label)
+        
+        self.cache_budget_input = QSpinBox()
+        self.cache_budget_input.setMinimum(1)
+        self.cache_budget_input.setMaximum(500)
+        self.cache_budget_input.setValue(AUDIO_CACHE_BUDGET_GB)
+        self.cache_budget_input.setStyleSheet("""
+            QSpinBox {
+                padding: 8px;
+                font-size: 14px;
+                border: 2px solid #e0e0e0;
+                border-radius: 6px;
+            }
+        """)
+        self.cache_budget_input.valueChanged.connect(self.change_cache_budget)
+        cache_budget_layout.addWidget(self.cache_budget_input)
+        cache_budget_layout.addStretch()
+        
+        settings_layout.addLayout(cache_budget_layout)
+        
+        # 🎞️ 갤러리 영상 HLS 변환 (기본 꺼짐 - 켜면 영상마다 ffmpeg로 여러 해상도 인코딩)
+        self.hls_packaging_checkbox = QCheckBox('갤러리 영상 HLS 변환 (ffmpeg, CPU/디스크 사용)')
+        self.hls_packaging_checkbox.setChecked(HLS_PACKAGING_ENABLED)
+        self.hls_packaging_checkbox.toggled.connect(self.change_hls_packaging)
+        settings_layout.addWidget(self.hls_packaging_checkbox)
         settings_group.setLayout(settings_layout)
         main_layout.addWidget(settings_group)
         
@@ -3032,6 +5866,32 @@ class ServerControllerWindow(QMainWindow):
         sleep_prevent_layout.addStretch()
         status_layout.addLayout(sleep_prevent_layout)
         
+        # 📥 다운로드 큐 상태
+        self.download_status_label = QLabel('📥 다운로드: 서버 중지됨')
+        self.download_status_label.setStyleSheet("""
+            QLabel {
+                font-size: 14px;
+                color: #666;
+                padding: 5px;
+            }
+        """)
+        status_layout.addWidget(self.download_status_label)
+        
+        # 💾 음원 캐시 상태
+        self.cache_status_label = QLabel('💾 캐시: 서버 중지됨')
+        self.cache_status_label.setStyleSheet("""
+            QLabel {
+                font-size: 14px;
+                color: #666;
+                padding: 5px;
+            }
+        """)
+        status_layout.addWidget(self.cache_status_label)
+        
+        self.download_status_timer = QTimer(self)
+        self.download_status_timer.timeout.connect(self.update_download_status)
+        self.download_status_timer.start(1000)
+        
         self.log_text = QTextEdit()
         self.log_text.setReadOnly(True)
         self.log_text.setStyleSheet("""
@@ -3101,6 +5961,54 @@ class ServerControllerWindow(QMainWindow):
                 }
             """)
     
+    def update_download_status(self):
+        """다운로드 큐 + 캐시 상태 표시 (1초마다)"""
+        server = self.server_worker.server if self.server_worker else None
+        if not server or not server.is_running:
+            self.download_status_label.setText('📥 다운로드: 서버 중지됨')
+            self.cache_status_label.setText('💾 캐시: 서버 중지됨')
+            return
+        
+        cache = server.cache_stats()
+        self.cache_status_label.setText(
+            f"💾 캐시: {cache['total_bytes']/1024**3:.1f}/{cache['budget_bytes']/1024**3:.0f}GB "
+            f"({cache['files']}개) · 적중 {cache['hits']} · 미스 {cache['misses']} · 정리 {cache['evictions']}"
+        )
+        
+        status = server.download_scheduler.status()
+        running = [job for job in status['jobs'] if job['state'] == 'running']
+        text = f"📥 다운로드: 진행 {status['running']}/{status['workers']} · 대기 {status['queued']}"
+        if running:
+            details = []
+            for job in running:
+                if job['total_bytes']:
+                    details.append(f"{job['key']} {job['downloaded_bytes'] * 100 // job['total_bytes']}%")
+                else:
+                    details.append(job['key'])
+            text += f"  ({', '.join(details)})"
+        self.download_status_label.setText(text)
+    
+    def change_cache_budget(self, value):
+        """캐시 용량 변경 (실행 중이면 즉시 점검)"""
+        server = self.server_worker.server if self.server_worker else None
+        if server:
+            server.set_audio_cache_budget(value)
+            self.add_log(f"💾 캐시 용량: {value}GB")
+    
+    def change_hls_packaging(self, checked):
+        """HLS 변환 켜기/끄기 (실행 중이면 즉시 반영)"""
+        server = self.server_worker.server if self.server_worker else None
+        if server:
+            server.set_hls_packaging(checked)
+            self.add_log(f"🎞️ HLS 변환: {'켜짐' if checked else '꺼짐'}")
+    
+    def change_download_workers(self, value):
+        """동시 다운로드 수 변경 (실행 중이면 즉시 반영)"""
+        server = self.server_worker.server if self.server_worker else None
+        if server:
+            server.download_scheduler.set_workers(value)
+            self.add_log(f"📥 동시 다운로드 수: {value}")
+    
     def add_log(self, message):
         """로그 추가"""
         self.log_text.append(f"[{datetime.now().strftime('%H:%M:%S')}] {message}")
@@ -3123,7 +6031,9 @@ class ServerControllerWindow(QMainWindow):
         self.start_btn.setEnabled(False)
         self.port_input.setEnabled(False)
         
-        self.server_worker = ServerWorker(self.server_port)
+        self.server_worker = ServerWorker(self.server_port, self.download_workers_input.value(),
+                                          self.cache_budget_input.value(),
+                                          self.hls_packaging_checkbox.isChecked())
         self.server_worker.log_signal.connect(self.add_log)
         self.server_worker.started_signal.connect(self.on_server_started)
         self.server_worker.error_signal.connect(self.on_server_error)
@@ -7,7 +7,8 @@ let displayedSearchCount = 20; // 현재 표시된 검색 결과 수
 let isListView = false; // 목록 보기 상태
 let audioElement = null; // 오디오 엘리먼트
 let currentVideoId = null; // 현재 재생 중인 video_id
-let downloadCheckInterval = null; // 다운로드 체크 인터벌
+let downloadCheckInterval = null; // 다운로드 체크 인터벌 (SSE 미지원 시 폴백)
+let downloadEventSource = null; // 다운로드 진행률 SSE 연결
 let currentPlaylistIndex = -1; // 현재 재생 중인 플레이리스트 인덱스
 let nextTrackPrefetch = null; // 다음 곡 미리 준비된 데이터
 let isStreamingMode = false; // 실시간 스트리밍 모드 (테슬라용) - 기본값: false (캐시 사용)
@@ -545,6 +546,20 @@ function extractVideoIdFromFilename(filename) {
     return result;
 }
 
+// 🎞️ HLS 패키지가 있고 브라우저가 HLS를 직접 재생하면 (Safari/iOS 등) HLS 사용, 아니면 원본 MP4
+const nativeHlsSupported = !!document.createElement('video').canPlayType('application/vnd.apple.mpegurl');
+
+function setGalleryVideoSource(sourceElement, video) {
+    if (video.hls_url && nativeHlsSupported) {
+        sourceElement.type = 'application/vnd.apple.mpegurl';
+        sourceElement.src = video.hls_url;
+    } else {
+        sourceElement.type = 'video/mp4';
+        sourceElement.src = `/api/video/${encodeURIComponent(video.filename)}`;
+    }
+    return sourceElement.src;
+}
+
 // 비디오 카드 생성
 function createVideoCard(video) {
     const card = document.createElement('div');
@@ -571,7 +586,10 @@ function createVideoCard(video) {
         const encodedThumbnail = isLocalThumbnail ? encodeURIComponent(video.thumbnail) : '';
         const encodedFilename = encodeURIComponent(video.filename);
         
-        thumbnailContent = isLocalThumbnail 
+        // 🖼️ HLS 포스터가 있으면 이미지 1장만 (영상 파일 Range 요청 없음)
+        thumbnailContent = video.poster_url
+            ? `<img src="${escapeHtml(video.poster_url)}" alt="${escapeHtml(video.title)}" loading="lazy" style="width: 100%; height: 100%; object-fit: cover;">`
+            : isLocalThumbnail 
             ? `<img src="/api/video/${encodedThumbnail}" alt="${escapeHtml(video.title)}" style="width: 100%; height: 100%; object-fit: cover;">`
             : `<video preload="metadata" muted playsinline>
                 <source src="/api/video/${encodedFilename}#t=0.5" type="video/mp4">
@@ -607,7 +625,7 @@ function browserDownload(filename) {
     // a 태그로 다운로드 (브라우저 기본 다운로드 창 사용)
     const a = document.createElement('a');
     a.href = videoUrl;
-    a.download = filename;
+    a.download = filename.split('/').pop();  // blobs/ 경로는 빼고 파일명만
     a.style.display = 'none';
     
     document.body.appendChild(a);
@@ -652,13 +670,10 @@ async function openVideoSimple(video) {
         const modalVideoSource = document.getElementById('modalVideoSource');
         
         // 공유자의 실제 파일 사용 (다운로드 없이 바로 재생!)
-        const encodedFilename = encodeURIComponent(video.filename);
-        const videoUrl = `/api/video/${encodedFilename}`;
+        const videoUrl = setGalleryVideoSource(modalVideoSource, video);
         
         console.log('🔗 영상 URL:', videoUrl);
         
-        modalVideoSource.src = videoUrl;
-        
         // 비디오 리셋 후 로드
         modalVideo.pause();
         modalVideo.currentTime = 0;
@@ -695,9 +710,8 @@ async function openVideoSimple(video) {
         const modalVideo = document.getElementById('modalVideo');
         const modalVideoSource = document.getElementById('modalVideoSource');
         
-        // URL 인코딩 (특수문자 처리)
-        const encodedFilename = encodeURIComponent(video.filename);
-        modalVideoSource.src = `/api/video/${encodedFilename}`;
+        // 🎞️ HLS 있으면 HLS, 없으면 원본 (URL 인코딩은 함수 안에서)
+        setGalleryVideoSource(modalVideoSource, video);
         
         // 비디오 리셋 후 로드
         modalVideo.pause();
@@ -821,10 +835,7 @@ async function streamAudio() {
     }
     
     // 기존 다운로드 체크 중지
-    if (downloadCheckInterval) {
-        clearInterval(downloadCheckInterval);
-        downloadCheckInterval = null;
-    }
+    stopDownloadCheck();
     
     // ⚡ 로딩창을 버튼 클릭 즉시 표시 (이미 표시된 경우는 스킵)
     const loadingPopup = document.getElementById('loadingPopup');
@@ -1062,6 +1073,9 @@ async function streamAudio() {
                 currentVideoId = data.video_id;
             }
             
+            // 🔗 캐시된 YouTube URL이 만료(403)되면 재해석 후 이어서 재생
+            attachStreamRecovery(audioEl, url, data);
+            
             // 백그라운드 다운로드 중이면 완료 체크 시작 (데스크톱만)
             if (data.downloading && data.video_id && !data.mobile_optimized) {
                 startDownloadCheck(data.video_id);
@@ -1112,15 +1126,136 @@ function setupMediaSession() {
     }
 }
 
-// 다운로드 완료 체크 시작
-function startDownloadCheck(videoId) {
-    // 기존 체크 중지
+// 🔗 원격 스트림 URL 만료(403) 시 서버에 재해석 요청 후 같은 위치부터 이어서 재생
+function attachStreamRecovery(audioEl, url, data) {
+    if (!url || data.local_file || !data.video_id) return;
+    
+    audioEl.addEventListener('error', async function onStreamError() {
+        // 이미 다른 곡으로 넘어갔으면 무시
+        if (currentVideoId !== data.video_id) return;
+        
+        const resumeAt = audioEl.currentTime;
+        console.log('🔄 스트림 URL 오류 - 서버에 재해석 요청:', data.video_id);
+        
+        try {
+            const response = await fetch('/api/stream', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({
+                    url: url,
+                    is_mobile: isMobileDevice(),
+                    force_refresh: true
+                })
+            });
+            const fresh = await response.json();
+            
+            if (!fresh.success || !fresh.audio_url || currentVideoId !== data.video_id) return;
+            
+            audioEl.src = fresh.audio_url;
+            audioEl.currentTime = resumeAt;
+            audioEl.play().catch(err => console.log('재생 재개 실패:', err));
+        } catch (error) {
+            console.error('스트림 재해석 실패:', error);
+        }
+    }, { once: true });
+}
+
+// 다운로드 완료 체크 중지 (SSE + 폴링 모두)
+function stopDownloadCheck() {
+    if (downloadEventSource) {
+        downloadEventSource.close();
+        downloadEventSource = null;
+    }
     if (downloadCheckInterval) {
         clearInterval(downloadCheckInterval);
+        downloadCheckInterval = null;
+    }
+}
+
+// 다운로드 완료 → 로컬 파일로 전환 (재생 위치 유지)
+function switchToLocalFile(videoId, audioUrl) {
+    console.log('✅ 다운로드 완료! 로컬 파일로 전환');
+    
+    // 현재 재생 중인 video_id와 같으면 전환
+    if (currentVideoId !== videoId || !audioUrl) {
+        return;
+    }
+    
+    const audioEl = document.getElementById('audioElement');
+    // 받는 중인 파일로 이미 전환했으면 그대로 (완료 후에도 같은 URL)
+    if (audioEl.src.endsWith(audioUrl)) {
+        return;
     }
+    const currentTime = audioEl.currentTime;
+    const wasPaused = audioEl.paused;
+    
+    // 로컬 파일로 전환
+    audioEl.src = audioUrl;
+    audioEl.currentTime = currentTime;
+    
+    if (!wasPaused) {
+        audioEl.play().catch(err => {
+            console.log('재생 재개 실패:', err);
+        });
+    }
+    
+    showStatus('고속 탐색 모드 활성화! ⚡', 'success');
+}
+
+// 다운로드 완료 체크 시작 (📡 SSE로 진행률 수신, 미지원/연결 실패 시 폴링)
+function startDownloadCheck(videoId) {
+    // 기존 체크 중지
+    stopDownloadCheck();
     
     console.log('🔍 다운로드 완료 체크 시작:', videoId);
     
+    if (!window.EventSource) {
+        startDownloadPolling(videoId);
+        return;
+    }
+    
+    const source = new EventSource(`/api/download-events/${encodeURIComponent(videoId)}`);
+    let received = false;
+    downloadEventSource = source;
+    
+    source.addEventListener('progress', (event) => {
+        received = true;
+        const progress = JSON.parse(event.data);
+        // 🎵 앞부분을 받았으면 다운로드 완료를 기다리지 않고 로컬 URL로 전환
+        if (progress.partial_url) {
+            switchToLocalFile(videoId, progress.partial_url);
+        }
+        if (progress.total_bytes) {
+            const percent = Math.floor(progress.downloaded_bytes * 100 / progress.total_bytes);
+            console.log(`📥 다운로드 ${percent}% (ETA ${progress.eta ?? '-'}초)`);
+        }
+    });
+    
+    source.addEventListener('done', (event) => {
+        const result = JSON.parse(event.data);
+        stopDownloadCheck();
+        switchToLocalFile(videoId, result.audio_url);
+    });
+    
+    ['failed', 'cancelled', 'idle'].forEach(type => {
+        source.addEventListener(type, () => {
+            console.log(`⚠️ 다운로드 ${type}:`, videoId);
+            stopDownloadCheck();
+        });
+    });
+    
+    source.onerror = () => {
+        // 한 번도 응답을 못 받았으면 SSE가 막힌 환경 → 폴링으로 전환
+        if (!received && downloadEventSource === source) {
+            console.log('⚠️ SSE 연결 실패 - 폴링으로 전환');
+            stopDownloadCheck();
+            startDownloadPolling(videoId);
+        }
+    };
+}
+
+// 다운로드 완료 폴링 (SSE 폴백)
+function startDownloadPolling(videoId) {
     // 5초마다 체크
     downloadCheckInterval = setInterval(async () => {
         try {
@@ -1128,30 +1263,9 @@ function startDownloadCheck(videoId) {
             const data = await response.json();
             
             if (data.success && data.ready) {
-                console.log('✅ 다운로드 완료! 로컬 파일로 전환');
-                
-                // 현재 재생 중인 video_id와 같으면 전환
-                if (currentVideoId === videoId) {
-                    const audioEl = document.getElementById('audioElement');
-                    const currentTime = audioEl.currentTime;
-                    const wasPaused = audioEl.paused;
-                    
-                    // 로컬 파일로 전환
-                    audioEl.src = data.audio_url;
-                    audioEl.currentTime = currentTime;
-                    
-                    if (!wasPaused) {
-                        audioEl.play().catch(err => {
-                            console.log('재생 재개 실패:', err);
-                        });
-                    }
-                    
-                    showStatus('고속 탐색 모드 활성화! ⚡', 'success');
-                }
-                
                 // 체크 중지
-                clearInterval(downloadCheckInterval);
-                downloadCheckInterval = null;
+                stopDownloadCheck();
+                switchToLocalFile(videoId, data.audio_url);
             }
         } catch (error) {
             console.error('다운로드 체크 오류:', error);
@@ -1182,10 +1296,7 @@ function closePlayer() {
     playerSection.style.display = 'none';
     
     // 다운로드 체크 중지
-    if (downloadCheckInterval) {
-        clearInterval(downloadCheckInterval);
-        downloadCheckInterval = null;
-    }
+    stopDownloadCheck();
     currentVideoId = null;
 }
 
@@ -1514,12 +1625,12 @@ function displayPlaylist(playlist) {
     playlistContainer.innerHTML = '';
     emptySearch.style.display = 'none';
     
+    // 실제 인덱스 (item_id → 전체 목록 위치, 한 번만 계산)
+    const indexById = new Map(allPlaylist.map((p, i) => [p.item_id, i]));
+    
     playlist.forEach((item, index) => {
-        // 실제 인덱스를 찾기 위해 전체 목록에서 검색
-        const realIndex = allPlaylist.findIndex(p => 
-            p.url === item.url && p.title === item.title
-        );
-        const playlistItem = createPlaylistItem(item, realIndex >= 0 ? realIndex : index);
+        const realIndex = indexById.get(item.item_id);
+        const playlistItem = createPlaylistItem(item, realIndex !== undefined ? realIndex : index);
         playlistContainer.appendChild(playlistItem);
     });
 }
@@ -1604,7 +1715,7 @@ function createPlaylistItem(item, index) {
     const deleteBtn = div.querySelector('.delete-playlist-btn');
     deleteBtn.addEventListener('click', async (e) => {
         e.stopPropagation();
-        await deleteFromPlaylist(index, item.title, item.url, item.shared_from);
+        await deleteFromPlaylist(item.item_id, item.title, item.shared_from);
     });
     
     return div;
@@ -1763,7 +1874,8 @@ async function prefetchNextTrack(index) {
             headers: {'Content-Type': 'application/json'},
             body: JSON.stringify({ 
                 url: nextTrack.url,
-                is_mobile: isMobile
+                is_mobile: isMobile,
+                priority: 'prefetch'  // 📥 재생 중인 곡 다운로드보다 뒤로
             }),
             signal: controller.signal
         });
@@ -1792,6 +1904,22 @@ async function prefetchNextTrack(index) {
     }
 }
 
+// 📥 더 이상 필요 없는 prefetch 다운로드 취소 (재생 중인 다운로드는 서버가 유지)
+function cancelPrefetchDownload(data) {
+    if (!data || !data.video_id || !data.downloading) {
+        return;
+    }
+    
+    fetch(`/api/downloads/${encodeURIComponent(data.video_id)}?priority=prefetch`, { method: 'DELETE' })
+        .then(response => response.json())
+        .then(result => {
+            if (result.cancelled) {
+                console.log(`🛑 prefetch 다운로드 취소: ${data.video_id}`);
+            }
+        })
+        .catch(error => console.log('⚠️ prefetch 다운로드 취소 실패:', error));
+}
+
 async function playFromPlaylist(url, index) {
     // 현재 인덱스 저장
     currentPlaylistIndex = index;
@@ -1817,6 +1945,10 @@ async function playFromPlaylist(url, index) {
     
     // 🚀 항상 서버에서 최신 데이터 가져오기 (prefetch 비활성화)
     // prefetch는 YouTube URL이 만료될 수 있어서 사용 안 함!
+    // 📥 다른 곡으로 건너뛰면 미리 받던 다운로드는 취소 (같은 곡이면 재생 요청이 우선순위를 올림)
+    if (nextTrackPrefetch && nextTrackPrefetch.index !== index) {
+        cancelPrefetchDownload(nextTrackPrefetch.data);
+    }
     nextTrackPrefetch = null; // prefetch 무시
     
     console.log('🚀 서버에서 최신 스트리밍 데이터 가져오는 중...');
@@ -1904,7 +2036,7 @@ async function toggleFavorite(item) {
     }
 }
 
-async function deleteFromPlaylist(index, title, url, sharedFrom) {
+async function deleteFromPlaylist(itemId, title, sharedFrom) {
     // 공유받은 음원인지 확인
     const isShared = sharedFrom ? true : false;
     
@@ -1920,10 +2052,8 @@ async function deleteFromPlaylist(index, title, url, sharedFrom) {
     }
     
     try {
-        const response = await fetch(`/api/playlist/${index}`, {
-            method: 'DELETE',
-            headers: {'Content-Type': 'application/json'},
-            body: JSON.stringify({ url: url })
+        const response = await fetch(`/api/playlist/items/${encodeURIComponent(itemId)}`, {
+            method: 'DELETE'
         });
         
         const data = await response.json();
@@ -2270,7 +2400,7 @@ async function watchVideoFromSearch(url, title) {
         if (data.success) {
             // 로딩 팝업 숨기기 (성공 시)
             hideLoadingPopup();
-            openWatchModal(data);
+            openWatchModal(data, url);
             showStatus('영상 재생 시작! 광고 없이 재생됩니다 🎬', 'success');
         }
     } catch (error) {
@@ -2280,17 +2410,59 @@ async function watchVideoFromSearch(url, title) {
 }
 
 // 바로보기 모달 열기
-function openWatchModal(data) {
+// 바로보기 모달의 재해석 핸들러 (다시 열거나 닫을 때 제거 - 이전 영상 핸들러가 남지 않도록)
+let watchVideoErrorHandler = null;
+let watchVideoUrl = null;
+
+function detachWatchErrorHandler() {
+    if (watchVideoErrorHandler) {
+        document.getElementById('watchVideoSource').removeEventListener('error', watchVideoErrorHandler);
+        watchVideoErrorHandler = null;
+    }
+    watchVideoUrl = null;
+}
+
+function openWatchModal(data, url) {
     const modal = document.getElementById('watchModal');
     const video = document.getElementById('watchVideo');
     const source = document.getElementById('watchVideoSource');
     const title = document.getElementById('watchTitle');
     const info = document.getElementById('watchInfo');
     
+    detachWatchErrorHandler();
+    watchVideoUrl = url || null;
+    
     // 직접 URL 사용
     source.src = data.video_url;
     video.load();
     
+    // 🔗 캐시된 YouTube URL이 만료(403)되면 한 번 재해석
+    if (url) {
+        watchVideoErrorHandler = async function onVideoError() {
+            source.removeEventListener('error', onVideoError);
+            watchVideoErrorHandler = null;
+            if (watchVideoUrl !== url) return;  // 다른 영상으로 바뀜
+            const resumeAt = video.currentTime;
+            try {
+                const response = await fetch('/api/video-stream', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({ url: url, force_refresh: true })
+                });
+                const fresh = await response.json();
+                if (!fresh.success || modal.style.display === 'none' || watchVideoUrl !== url) return;
+                
+                source.src = fresh.video_url;
+                video.load();
+                video.currentTime = resumeAt;
+                video.play().catch(err => console.log('재생 재개 실패:', err));
+            } catch (error) {
+                console.error('비디오 재해석 실패:', error);
+            }
+        };
+        source.addEventListener('error', watchVideoErrorHandler);
+    }
+    
     title.textContent = data.title;
     const duration = formatDuration(data.duration);
     info.textContent = `⚡ 재생 중 | 광고 없음 | ${duration}`;
@@ -2306,6 +2478,7 @@ function closeWatchModal() {
     
     modal.style.display = 'none';
     video.pause();
+    detachWatchErrorHandler();
     document.body.style.overflow = 'auto';
 }
 